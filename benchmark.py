@@ -0,0 +1,1272 @@
+#!/usr/bin/python
+
+"""
+COMP360 Assignment 3: Distributed Hashtable and Distributed Commit
+
+Benchmarks
+
+Takes one of the arguments:
+
+    listen: Requests/sec served by each common.listen backend as the number
+            of concurrent clients goes from 1 to 256.
+            --delay simulates a handler that blocks (e.g. on a heartbeat).
+        $ ./benchmark.py listen --delay 0.001
+
+    codec:  Size and encode/decode time of typical messages with the json
+            and binary codecs, and with the old nested JSON view.
+        $ ./benchmark.py codec
+
+    receive: Memory allocated and time taken per received frame, by the
+             receive path and by the old one that allocated a new string
+             for every read. Needs Python 3 for tracemalloc.
+        $ python3 benchmark.py receive
+
+    rebalance: Time to find the keys a server sends when another server
+               joins a view of --servers servers, in a store of --keys keys,
+               by hashing every key as rebalancing used to, and with the
+               ring index of kvstore.Store.
+        $ ./benchmark.py rebalance --keys 1000000
+
+    wal: Writes/sec with --writers concurrent writers under each fsync
+         policy, and time to recover --keys keys from the log alone and
+         from a snapshot.
+        $ ./benchmark.py wal --writers 16 --keys 100000
+
+    store: Sets/sec and slowest set with --writers concurrent writers while
+           another thread keeps scanning the arcs rebalancing sends, in a
+           store of --keys keys, with one lock around the whole store as
+           the server used to have and with the striped locks of
+           kvstore.Store.
+        $ ./benchmark.py store --writers 16 --keys 1000000
+
+    antientropy: Bytes two replicas of --keys keys exchange to find and
+                 repair the keys that differ, as the number of differing
+                 keys grows, next to the size of the whole store.
+        $ ./benchmark.py antientropy --keys 1000000
+
+    ring: Time to find the servers holding a key, by sorting the view and
+          scanning it as the client used to, and with a ring.Ring built once
+          for the view, for 4, 64 and 1024 servers. Also the load skew of
+          each number of virtual nodes: the most keys a server holds
+          copies of, over the mean.
+        $ ./benchmark.py ring
+
+    fanout: Time taken by the two phases of a setr on 3 servers, sending to
+            one server after another as the client used to, and to all of
+            them at once with common.send_receive_all. Each server takes
+            --delay seconds to respond, to stand for the round trip.
+        $ ./benchmark.py fanout --delay 0.002
+
+    reads: p50 and p99 latency of getr's order, hedged and quorum reads
+           from 3 servers, each answering after --delay seconds, the first
+           one taking --slow seconds more on --fraction of the requests.
+           The hedge delay is the 95th percentile of the reads so far, so
+           hedging only cuts the tail when --fraction is below 0.05.
+           Needs Python 2, like client.py.
+        $ ./benchmark.py reads --slow 0.05 --fraction 0.03
+
+    writes: p50 and p99 latency of setr's 2pc and quorum writes to 3
+            servers, each answering after --delay seconds, the last one
+            taking --slow seconds more on --fraction of the requests.
+            Needs Python 2, like client.py.
+        $ ./benchmark.py writes --slow 0.05 --fraction 0.1
+
+    commit: 2PC commits/sec and their p50 and p99 latency on a server with
+            --writers concurrent writers, under the group and always fsync
+            policies, applying and logging each commit on its own as the
+            server used to, and with group commit, with no window and a
+            1ms one. Needs Python 2, like server.py.
+        $ ./benchmark.py commit --writers 64
+
+    locks: Time per lock operation with the lists the viewleader used to
+           keep, and with locktable.LockTable: taking and releasing each of
+           --locks locks, then on a lock with 10 to --depth requesters
+           waiting, a waiter asking again (retry), a waiter giving up and
+           queueing again (cancel), and the holder handing the lock over
+           and queueing again (handoff).
+        $ ./benchmark.py locks --locks 100000 --depth 10000
+
+    deadlock: Time per lock_get of a requester waiting at the end of a chain
+              of 10 to --chain requesters, each holding a lock the one
+              before it waits for, asking again (retry) and of a new
+              requester (wait), with a depth-first search from the
+              requester on every denied lock_get as the viewleader used to
+              run, and with the search locktable.LockTable runs only when a
+              lock gains a waiter. Also the time to search for a cycle
+              through a requester queued behind 10 to --depth waiters,
+              shared and exclusive in turn, which finds none.
+        $ ./benchmark.py deadlock --chain 10000 --depth 10000
+
+    handoff: Time from a lock_release to the next waiter learning it holds
+             the lock, and lock_gets sent per handoff, as --waiters
+             requesters queued for a lock take it one after another, each
+             releasing it once granted. Waiters ask again every --poll
+             seconds as the client used to, and have their lock_gets held
+             by the viewleader. Needs Python 2, like viewleader.py.
+        $ ./benchmark.py handoff --waiters 8
+
+    sharing: Lock acquisitions/sec, and how many requesters hold the lock at
+             once on average, as --clients requesters each keep taking one
+             lock, holding it for --hold seconds and releasing it, --reads
+             of the time to read and otherwise to write, with every lock
+             exclusive as the viewleader used to grant them, and with reads
+             sharing the lock. Needs Python 2, like viewleader.py.
+        $ ./benchmark.py sharing --clients 16 --reads 0.9
+
+    multilock: Transactions/sec, lock requests sent per transaction and
+               deadlocks reported, as --clients requesters each keep taking
+               --size locks picked at random out of --locks, holding them
+               for --hold seconds and releasing them. The locks are taken
+               one lock_get after another, in the order they were picked,
+               the requester releasing those it holds and starting over on
+               a deadlock, and with a single lock_get_many.
+               Needs Python 2, like viewleader.py.
+        $ ./benchmark.py multilock --clients 8 --locks 16 --size 3
+
+    bulk: Keys/sec and RPCs sent when writing --keys keys to 3 servers
+          with one 2PC per key as setr does, and with one per batch of
+          client.BATCH_SIZE keys as setr_many does, one batch after
+          another and client.BATCH_WORKERS at once. Each server takes
+          --delay seconds to respond, to stand for the round trip.
+          Needs Python 2, like client.py.
+        $ ./benchmark.py bulk --keys 100000 --delay 0.001
+
+
+@author Han Yang, Tay
+"""
+
+import argparse
+import codec
+import collections
+import common
+import json
+import kvstore
+import merkle
+import os
+import random
+import ring
+import shutil
+import socket
+import struct
+import sys
+import tempfile
+import threading
+import time
+import wal
+
+BENCH_PORT = 37000
+
+#runs common.listen on port in the background, and returns once a warm-up
+#request has been answered
+#exits if the port can't be bound or doesn't answer, which would otherwise
+#leave the benchmark measuring refused connections
+def start_server(port, handler, timeout=None, backend="threads", workers=common.WORKERS):
+    result = []
+    thread = threading.Thread(target = lambda: result.append(
+        common.listen(port, handler, timeout, backend, workers)))
+    thread.daemon = True
+    thread.start()
+    #every handler answers the timeout command, without side effects
+    deadline = time.time() + 5
+    while True:
+        response = common.send_receive("localhost", port, {"cmd": "timeout"}, 1)
+        if result:
+            sys.exit("port {}: {}".format(port, result[0]))
+        if "Error" not in response:
+            return
+        if time.time() > deadline:
+            sys.exit("port {}: {}".format(port, response["Error"]))
+        time.sleep(0.1)
+
+### listen ###
+
+#echo handler, optionally blocking for delay seconds per request
+def echo_handler(delay):
+    def handler(msg, addr):
+        if msg["cmd"] in ("init", "timeout"):
+            return {}
+        if delay:
+            time.sleep(delay)
+        return {"Status": "Completed.", "Echo": msg.get("val")}
+    return handler
+
+#sends requests in a loop until deadline, counting completed requests
+def echo_client(port, deadline, counts, i):
+    args = {"cmd": "echo", "val": "x" * 64}
+    while time.time() < deadline:
+        response = common.send_receive("localhost", port, args)
+        if "Error" not in response:
+            counts[i] += 1
+
+#requests/sec with n concurrent clients
+def measure(port, n, duration):
+    counts = [0] * n
+    deadline = time.time() + duration
+    threads = [threading.Thread(target = echo_client, args = (port, deadline, counts, i))
+               for i in range(n)]
+    for i in threads:
+        i.start()
+    for i in threads:
+        i.join()
+    common.close_pool()
+    return sum(counts) / float(duration)
+
+def bench_listen(args):
+    #every client thread keeps its own pooled connection
+    common.POOL_MAX_IDLE = 512
+    common.POOL_MAX_TOTAL = 512
+
+    clients = [1, 2, 4, 8, 16, 32, 64, 128, 256]
+    results = {}
+    for n, backend in enumerate(["eventloop", "threads"]):
+        port = BENCH_PORT + n
+        start_server(port, echo_handler(args.delay), None, backend, args.workers)
+        results[backend] = [measure(port, i, args.duration) for i in clients]
+
+    print("{:>8} {:>12} {:>12}".format("clients", "eventloop", "threads"))
+    for i, n in enumerate(clients):
+        print("{:>8} {:>12.0f} {:>12.0f}".format(n, results["eventloop"][i],
+                                                 results["threads"][i]))
+
+### codec ###
+
+#a server ID, as returned by common.hash_key
+SAMPLE_ID = common.hash_key(b"127.0.0.1:38000")
+
+#typical messages, each a (name, message) pair
+def sample_messages():
+    view = [{"IP": "127.0.0.1:{}".format(38000 + i), "ID": SAMPLE_ID + i} for i in range(8)]
+    return [
+        ("setr vote", {"cmd": "twoPC_vote", "key": "user:1234", "val": "x" * 32,
+                       "server": "localhost", "viewleader": "localhost"}),
+        ("vote response", {"Vote": True, "Epoch": 12, "ID": SAMPLE_ID}),
+        ("get response", {"Status": "Completed", "Key": "user:1234", "Value": "x" * 32}),
+        ("view", {"Result": view, "Epoch": 12, "Rebalance status": False}),
+        ("view (nested)", {"Result": json.dumps(view), "Epoch": 12, "Rebalance status": False}),
+        ("rebalance chunk", {"Result": [["key{}".format(i), "value{}".format(i)] for i in range(200)]}),
+    ]
+
+#microseconds per call of f, over at least duration seconds
+def time_call(f, duration):
+    n = 0
+    start = time.time()
+    while time.time() - start < duration:
+        for i in range(100):
+            f()
+        n += 100
+    return (time.time() - start) / n * 1e6
+
+def bench_codec(args):
+    duration = args.duration / 10
+    print("{:<16} {:>8} {:>8} {:>8} {:>8} {:>8} {:>8}".format(
+        "message", "json B", "enc us", "dec us", "bin B", "enc us", "dec us"))
+    for name, message in sample_messages():
+        row = []
+        for encoding in ["json", "binary"]:
+            body, flags = common.encode(message, encoding)
+            encode = lambda: common.encode(message, encoding)
+            decode = lambda: common.decode(body, flags)
+            if name == "view (nested)":
+                #the view was a JSON string inside the message
+                view = json.loads(message["Result"])
+                encode = lambda: common.encode(dict(message, Result = json.dumps(view)), encoding)
+                decode = lambda: json.loads(common.decode(body, flags)["Result"])
+            row += [len(body), time_call(encode, duration), time_call(decode, duration)]
+        print("{:<16} {:>8} {:>8.1f} {:>8.1f} {:>8} {:>8.1f} {:>8.1f}".format(name, *row))
+
+### receive ###
+
+#the receive path before buffers were reused, for comparison
+def legacy_receive_frame(sock):
+    nlen = sock.recv(4, socket.MSG_WAITALL)
+    slen = struct.unpack("!I", nlen)[0]
+    reqid = None
+    flags = 0
+    if slen & common.FRAME_EXT:
+        slen &= ~common.FRAME_EXT
+        header = sock.recv(common.FRAME_EXT_HEADER.size, socket.MSG_WAITALL)
+        reqid, flags = common.FRAME_EXT_HEADER.unpack(header)
+    body = sock.recv(slen, socket.MSG_WAITALL)
+    if flags & common.FLAG_BINARY:
+        return codec.decode(body), reqid, flags
+    return json.loads(body.decode()), reqid, flags
+
+#receives n copies of frame with receive_frame
+#Return value
+#   (bytes allocated per frame at peak, microseconds per frame)
+def receive_cost(receive_frame, frame, n):
+    import tracemalloc
+    results = []
+    for traced in [True, False]:
+        reader, writer = socket.socketpair()
+        thread = threading.Thread(target = writer.sendall, args = (frame * (n + 1),))
+        thread.daemon = True
+        thread.start()
+        #the first frame allocates the receive buffer
+        receive_frame(reader)
+        if traced:
+            tracemalloc.start()
+        allocated = 0
+        start = time.time()
+        for i in range(n):
+            if traced:
+                tracemalloc.reset_peak()
+                before = tracemalloc.get_traced_memory()[0]
+            msg = receive_frame(reader)
+            if traced:
+                allocated += tracemalloc.get_traced_memory()[1] - before
+            del msg
+        results.append(allocated / n if traced else (time.time() - start) / n * 1e6)
+        if traced:
+            tracemalloc.stop()
+        thread.join()
+        reader.close()
+        writer.close()
+    return results
+
+def bench_receive(args):
+    if sys.version_info < (3, 9):
+        sys.exit("receive needs Python 3.9 or later for tracemalloc")
+    n = 2000
+    print("{:<16} {:>7} {:>10} {:>10} {:>10} {:>10}".format(
+        "message", "codec", "old B", "new B", "old us", "new us"))
+    for name, message in sample_messages():
+        for encoding in ["json", "binary"]:
+            body, flags = common.encode(message, encoding)
+            frame = (common.FRAME_LENGTH.pack(common.FRAME_EXT | len(body)) +
+                     common.FRAME_EXT_HEADER.pack(0, flags) + body)
+            old = receive_cost(legacy_receive_frame, frame, n)
+            new = receive_cost(common.receive_frame, frame, n)
+            print("{:<16} {:>7} {:>10.0f} {:>10.0f} {:>10.1f} {:>10.1f}".format(
+                name, encoding, old[0], new[0], old[1], new[1]))
+
+### rebalance ###
+
+#True if key i hashes into the arc (predServer, server], hashing the key
+#on every call as rebalancing used to
+def legacy_in_arc(i, server, predServer, maxServer):
+    keyHash = common.hash_key(i)
+    if predServer == maxServer:
+        return keyHash > predServer or keyHash < server
+    return keyHash > predServer and keyHash < server
+
+def bench_rebalance(args):
+    random.seed(0)
+    ids = sorted(random.randrange(2 ** 160) for i in range(args.servers))
+    #the arcs a server sent to a new server before there was a ring diff
+    arcs = [(ids[2], ids[1]), (ids[3], ids[2])]
+
+    #inserts pay for hashing each key once
+    for name, store in [("dict", {}), ("kvstore.Store", kvstore.Store())]:
+        start = time.time()
+        for i in range(args.keys):
+            store["key{}".format(i)] = "value"
+        print("filled {} with {} keys in {:.2f}s".format(name, len(store), time.time() - start))
+
+    start = time.time()
+    keys = [i for i in store if any(legacy_in_arc(i, server, predServer, ids[-1])
+                                    for server, predServer in arcs)]
+    legacy = time.time() - start
+    start = time.time()
+    indexed = []
+    for server, predServer in arcs:
+        indexed.extend(store.arc(predServer, server))
+    index = time.time() - start
+    assert sorted(keys) == sorted(indexed)
+
+    print("{:<12} {:>10} {:>10}".format("", "keys", "seconds"))
+    print("{:<12} {:>10} {:>10.4f}".format("hash scan", len(keys), legacy))
+    print("{:<12} {:>10} {:>10.4f}".format("ring index", len(indexed), index))
+
+### wal ###
+
+#appends and syncs records until deadline, as server.set_val does
+def wal_writer(log, deadline, counts, i):
+    while time.time() < deadline:
+        log.sync(log.append(["set", "key{}".format(counts[i]), "x" * 64]))
+        counts[i] += 1
+
+#time to recover the store kept in directory
+def recovery_time(directory):
+    start = time.time()
+    values = {}
+    log = wal.Log(directory, "off")
+    log.recover(values)
+    log.close()
+    store = kvstore.Store()
+    store.load(values)
+    return time.time() - start, len(store)
+
+def bench_wal(args):
+    directory = tempfile.mkdtemp()
+    try:
+        print("{:<10} {:>12}".format("policy", "writes/sec"))
+        for policy in wal.POLICIES:
+            path = os.path.join(directory, policy)
+            os.makedirs(path)
+            log = wal.Log(path, policy)
+            log.recover(kvstore.Store())
+            counts = [0] * args.writers
+            deadline = time.time() + args.duration
+            threads = [threading.Thread(target = wal_writer, args = (log, deadline, counts, i))
+                       for i in range(args.writers)]
+            for i in threads:
+                i.start()
+            for i in threads:
+                i.join()
+            log.close()
+            print("{:<10} {:>12.0f}".format(policy, sum(counts) / args.duration))
+
+        path = os.path.join(directory, "recovery")
+        os.makedirs(path)
+        log = wal.Log(path, "off")
+        store = kvstore.Store()
+        log.recover(store)
+        for i in range(args.keys):
+            key = "key{}".format(i)
+            store[key] = "x" * 64
+            log.append(["set", key, "x" * 64])
+        log.close()
+        print("recovered {1} keys from the log in {0:.2f}s".format(*recovery_time(path)))
+        log = wal.Log(path, "off")
+        log.recover(kvstore.Store())
+        log.write_snapshot(list(store.items()), log.rotate())
+        log.close()
+        print("recovered {1} keys from a snapshot in {0:.2f}s".format(*recovery_time(path)))
+    finally:
+        shutil.rmtree(directory)
+
+### store ###
+
+#sets keys until deadline holding lock(key), recording the slowest set
+def store_writer(store, lock, deadline, counts, slowest, i):
+    while time.time() < deadline:
+        key = "new{}-{}".format(i, counts[i])
+        start = time.time()
+        with lock(key):
+            store[key] = "value"
+        slowest[i] = max(slowest[i], time.time() - start)
+        counts[i] += 1
+
+#scans arcs until deadline holding scanLock, as rebalance_keys does
+def store_scanner(store, scanLock, arcs, deadline, scans):
+    while time.time() < deadline:
+        with scanLock:
+            for server, predServer in arcs:
+                store.arc(predServer, server)
+        scans[0] += 1
+
+def bench_store(args):
+    random.seed(0)
+    ids = sorted(random.randrange(2 ** 160) for i in range(16))
+    arcs = [(ids[2], ids[1]), (ids[3], ids[2])]
+    values = dict(("key{}".format(i), "value") for i in range(args.keys))
+
+    #(name, lock held by a set, lock held by a scan)
+    single = threading.RLock()
+    variants = [("one lock", lambda key: single, single),
+                ("striped", lambda key: store.stripe(key), threading.Lock())]
+    print("{:<10} {:>10} {:>14} {:>8}".format("", "sets/sec", "slowest (ms)", "scans"))
+    for name, lock, scanLock in variants:
+        store = kvstore.Store()
+        store.load(dict(values))
+        counts = [0] * args.writers
+        slowest = [0.0] * args.writers
+        scans = [0]
+        deadline = time.time() + args.duration
+        threads = [threading.Thread(target = store_writer,
+                                    args = (store, lock, deadline, counts, slowest, i))
+                   for i in range(args.writers)]
+        threads.append(threading.Thread(target = store_scanner,
+                                        args = (store, scanLock, arcs, deadline, scans)))
+        for i in threads:
+            i.start()
+        for i in threads:
+            i.join()
+        print("{:<10} {:>10.0f} {:>14.1f} {:>8}".format(
+            name, sum(counts) / args.duration, max(slowest) * 1000, scans[0]))
+
+### antientropy ###
+
+def bench_antientropy(args):
+    random.seed(0)
+    values = dict(("key{}".format(i), "x" * 64) for i in range(args.keys))
+    print("store: {} bytes".format(len(json.dumps(list(values.items())))))
+    start = time.time()
+    replica = kvstore.Store()
+    replica.load(dict(values))
+    print("built the tree of {} keys in {:.2f}s".format(args.keys, time.time() - start))
+    local = kvstore.Store()
+    local.load(dict(values))
+
+    print("{:>10} {:>8} {:>12} {:>10}".format("differing", "rounds", "bytes", "seconds"))
+    differing = 0
+    for n in [0, 1, 10, 100, 1000]:
+        for k in random.sample(sorted(values), n - differing):
+            replica[k] = "y"
+        differing = n
+        sent = [0, 0]
+        #the ranges sent to the replica and the digests it returns, as in
+        #server.anti_entropy_replica
+        def remote(ranges):
+            theirs = [replica.digest(low, high) for low, high in ranges]
+            sent[0] += 1
+            sent[1] += len(json.dumps(ranges)) + len(json.dumps(theirs))
+            return theirs
+        start = time.time()
+        differ = merkle.diff(local, [(-1, 2 ** 160)], remote)
+        pairs = []
+        for low, high in differ:
+            pairs.extend(replica.digests(low, high))
+        sent[1] += len(json.dumps(differ)) + len(json.dumps(pairs))
+        elapsed = time.time() - start
+        print("{:>10} {:>8} {:>12} {:>10.3f}".format(n, sent[0], sent[1], elapsed))
+
+### ring ###
+
+#servers holding key, by sorting the view on every call and scanning it
+#as client.bucket_allocator used to
+def legacy_lookup(key, view):
+    if len(view) <= ring.REPLICAS:
+        return view
+    sortedView = sorted(view, key=lambda k: k["ID"])
+    keyHash = common.hash_key(key)
+    buckets = [i for i in sortedView if i["ID"] >= keyHash][:ring.REPLICAS]
+    return buckets + sortedView[:ring.REPLICAS - len(buckets)]
+
+#microseconds per lookup of f over the keys
+def lookup_cost(f, keys):
+    start = time.time()
+    for key in keys:
+        f(key)
+    return (time.time() - start) / len(keys) * 1e6
+
+#most ring positions a server holds copies of, over the mean
+def ring_skew(r):
+    held = dict((i, 0) for i in r.servers)
+    for j, pos in enumerate(r.positions):
+        length = (pos - r.positions[j - 1]) % ring.RING_SIZE
+        for i in r.owners(pos):
+            held[i] += length
+    return max(held.values()) * len(held) / float(sum(held.values()))
+
+def bench_ring(args):
+    random.seed(0)
+    keys = ["key{}".format(i) for i in range(args.keys)]
+    print("{:>8} {:>12} {:>12}".format("servers", "scan us", "ring us"))
+    for n in [4, 64, 1024]:
+        view = [{"IP": "127.0.0.1:{}".format(39000 + i), "ID": random.randrange(ring.RING_SIZE)}
+                for i in range(n)]
+        r = ring.Ring(view)
+        for key in keys[:100]:
+            assert legacy_lookup(key, view) == r.lookup(key)
+        print("{:>8} {:>12.1f} {:>12.1f}".format(
+            n, lookup_cost(lambda key: legacy_lookup(key, view), keys),
+            lookup_cost(r.lookup, keys)))
+
+    print("")
+    print("{:>8} {:>8} {:>8}".format("servers", "vnodes", "skew"))
+    for n in [4, 64, 1024]:
+        view = [{"IP": "127.0.0.1:{}".format(39000 + i), "ID": random.randrange(ring.RING_SIZE)}
+                for i in range(n)]
+        for vnodes in [1, 16, 128]:
+            print("{:>8} {:>8} {:>8.2f}".format(n, vnodes, ring_skew(ring.Ring(view, vnodes))))
+
+### fanout ###
+
+#milliseconds per call of f, over duration seconds
+def call_cost(f, duration):
+    calls = 0
+    start = time.time()
+    while time.time() - start < duration:
+        f()
+        calls += 1
+    return (time.time() - start) / calls * 1000
+
+def bench_fanout(args):
+    buckets = []
+    for n in range(3):
+        port = BENCH_PORT + 10 + n
+        start_server(port, echo_handler(args.delay), None, "threads")
+        buckets.append({"addr": "localhost", "port": port})
+    message = {"cmd": "echo", "val": "x" * 64}
+    for n, response in common.send_receive_all(buckets, message, 5):
+        if "Error" in response:
+            print(response["Error"])
+            return
+
+    #a vote and a commit phase
+    def sequential():
+        for phase in range(2):
+            for i in buckets:
+                common.send_receive(i["addr"], i["port"], message, 5)
+    def parallel():
+        for phase in range(2):
+            for n, response in common.send_receive_all(buckets, message, 5):
+                pass
+
+    print("{:>12} {:>12}".format("sequential", "parallel"))
+    print("{:>10.2f}ms {:>10.2f}ms".format(call_cost(sequential, args.duration),
+                                           call_cost(parallel, args.duration)))
+
+### reads ###
+
+#get handler answering after delay seconds, and after slow seconds more
+#on fraction of the requests
+def get_handler(delay, slow, fraction):
+    def handler(msg, addr):
+        if msg["cmd"] in ("init", "timeout"):
+            return {}
+        if random.random() < fraction:
+            time.sleep(delay + slow)
+        else:
+            time.sleep(delay)
+        return {"Status": "Completed", "Key": msg["key"], "Value": "x", "Epoch": 0}
+    return handler
+
+def bench_reads(args):
+    import client
+    buckets = []
+    for n in range(3):
+        port = BENCH_PORT + 20 + n
+        slow = args.slow if n == 0 else 0
+        start_server(port, get_handler(args.delay, slow, args.fraction), None, "threads")
+        buckets.append({"addr": "localhost", "port": port, "ID": n})
+    message = {"cmd": "get", "key": "key"}
+
+    print("{:<8} {:>10} {:>10}".format("read", "p50 ms", "p99 ms"))
+    for mode in client.READ_MODES:
+        read = getattr(client, "read_" + mode)
+        client.readLatencies.clear()
+        latencies = []
+        #the reads print every response
+        stdout = sys.stdout
+        sys.stdout = open(os.devnull, "w")
+        try:
+            for i in range(args.reads):
+                start = time.time()
+                response, stale = read(buckets, message, 0)
+                latencies.append(time.time() - start)
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+        latencies.sort()
+        print("{:<8} {:>10.2f} {:>10.2f}".format(mode, latencies[len(latencies) // 2] * 1000,
+                                                 latencies[len(latencies) * 99 // 100] * 1000))
+
+### writes ###
+
+#requests served by each write_handler, indexed by server ID
+counts = collections.Counter()
+
+#2PC and put handler answering after delay seconds, and after slow seconds
+#more on fraction of the requests
+def write_handler(delay, slow, fraction, serverID):
+    def handler(msg, addr):
+        if msg["cmd"] in ("init", "timeout"):
+            return {}
+        counts[serverID] += 1
+        #batches are streamed
+        list(msg.get("stream", []))
+        if random.random() < fraction:
+            time.sleep(delay + slow)
+        else:
+            time.sleep(delay)
+        if msg["cmd"] == "twoPC_vote":
+            return {"Vote": True, "Epoch": 0, "ID": serverID}
+        if msg["cmd"] == "put":
+            return {"Status": "Completed.", "Version": msg["version"],
+                    "Epoch": 0, "ID": serverID}
+        return {"Status": "2PC commited."}
+    return handler
+
+def bench_writes(args):
+    import client
+    buckets = []
+    for n in range(3):
+        port = BENCH_PORT + 30 + n
+        slow = args.slow if n == 2 else 0
+        start_server(port, write_handler(args.delay, slow, args.fraction, n), None, "threads")
+        buckets.append({"addr": "localhost", "port": port, "ID": n})
+
+    print("{:<8} {:>10} {:>10}".format("write", "p50 ms", "p99 ms"))
+    for mode in client.WRITE_MODES:
+        write = getattr(client, "write_" + mode)
+        latencies = []
+        #the writes print every response
+        stdout = sys.stdout
+        sys.stdout = open(os.devnull, "w")
+        try:
+            for i in range(args.writes):
+                message = {"key": "key", "val": "x", "version": client.clock.now()}
+                start = time.time()
+                written, stale = write(buckets, message, 0, False)
+                latencies.append(time.time() - start)
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+        latencies.sort()
+        print("{:<8} {:>10.2f} {:>10.2f}".format(mode, latencies[len(latencies) // 2] * 1000,
+                                                 latencies[len(latencies) * 99 // 100] * 1000))
+
+### commit ###
+
+#2PC commit as the server used to apply it, each on its own
+def legacy_commit(server, msg):
+    key = msg["key"]
+    with server.store.stripe(key):
+        applied, seq = server.store_merge(key, msg["val"], msg["version"])
+        server.pending_2PC.pop(key, None)
+    print ("Setting key {} to {} in local store".format(key, msg["val"]))
+    server.log_sync(seq)
+    print("2PC commited.")
+    return {"Status": "2PC commited."}
+
+#commits keys of its own until deadline, recording the time each took
+def commit_writer(commit, deadline, latencies, i):
+    n = 0
+    while time.time() < deadline:
+        message = {"key": "{}-{}".format(i, n), "val": "x", "version": [n, 0, str(i)]}
+        start = time.time()
+        commit(message)
+        latencies.append(time.time() - start)
+        n += 1
+
+def bench_commit(args):
+    import server
+    directory = tempfile.mkdtemp()
+    runs = [("each", lambda msg: legacy_commit(server, msg), 0),
+            ("group", lambda msg: server.twoPC_commit(msg, None), 0),
+            ("group 1ms", lambda msg: server.twoPC_commit(msg, None), 0.001)]
+    try:
+        print("{:<8} {:<10} {:>12} {:>10} {:>10}".format("policy", "commit", "commits/sec",
+                                                       "p50 ms", "p99 ms"))
+        for policy in ["group", "always"]:
+            for name, commit, window in runs:
+                path = tempfile.mkdtemp(dir = directory)
+                server.log = wal.Log(path, policy)
+                server.log.recover({}, {})
+                server.store = kvstore.Store()
+                server.config["commitWindow"] = window
+                latencies = []
+                deadline = time.time() + args.duration
+                threads = [threading.Thread(target = commit_writer,
+                                            args = (commit, deadline, latencies, i))
+                           for i in range(args.writers)]
+                #commits print every key
+                stdout = sys.stdout
+                sys.stdout = open(os.devnull, "w")
+                try:
+                    for i in threads:
+                        i.start()
+                    for i in threads:
+                        i.join()
+                finally:
+                    sys.stdout.close()
+                    sys.stdout = stdout
+                server.log.close()
+                latencies.sort()
+                print("{:<8} {:<10} {:>12.0f} {:>10.2f} {:>10.2f}".format(
+                    policy, name, len(latencies) / args.duration,
+                    latencies[len(latencies) // 2] * 1000,
+                    latencies[len(latencies) * 99 // 100] * 1000))
+    finally:
+        shutil.rmtree(directory)
+
+### locks ###
+
+#lock queues as the viewleader used to keep them, in lists
+class LegacyLocks(object):
+    def __init__(self):
+        self.locks = {}
+        self.track = {}
+
+    def acquire(self, lockname, requester):
+        if requester not in self.track:
+            self.track[requester] = {"hold": [], "wait": []}
+        if lockname not in self.locks:
+            self.locks[lockname] = []
+        if requester not in self.locks[lockname]:
+            self.locks[lockname].append(requester)
+        if self.locks[lockname][0] == requester:
+            if lockname not in self.track[requester]["hold"]:
+                self.track[requester]["hold"].append(lockname)
+            if lockname in self.track[requester]["wait"]:
+                self.track[requester]["wait"].remove(lockname)
+            return True
+        if lockname not in self.track[requester]["wait"]:
+            self.track[requester]["wait"].append(lockname)
+        return False
+
+    def release(self, lockname, requester):
+        self.locks[lockname].remove(requester)
+        if lockname in self.track[requester]["hold"]:
+            self.track[requester]["hold"].remove(lockname)
+        else:
+            self.track[requester]["wait"].remove(lockname)
+
+#queues requesters 0 to depth for lock "hot" of table t
+def fill(t, depth):
+    for i in range(depth + 1):
+        t.acquire("hot", i)
+    return t
+
+#microseconds per call of f, called n times
+def op_cost(f, n):
+    start = time.time()
+    for i in range(n):
+        f(i)
+    return (time.time() - start) / n * 1e6
+
+def bench_locks(args):
+    import locktable
+    tables = [("lists", LegacyLocks), ("LockTable", locktable.LockTable)]
+
+    print("{:<10} {:>14} {:>14}".format("table", "acquire us", "release us"))
+    for name, table in tables:
+        t = table()
+        #each requester holds 100 of the locks
+        acquire = op_cost(lambda i: t.acquire("lock{}".format(i), i // 100), args.locks)
+        release = op_cost(lambda i: t.release("lock{}".format(i), i // 100), args.locks)
+        print("{:<10} {:>14.2f} {:>14.2f}".format(name, acquire, release))
+
+    print("")
+    print("{:<10} {:>8} {:>10} {:>10} {:>10}".format("table", "waiters", "retry us",
+                                                     "cancel us", "handoff us"))
+    depth = 10
+    while depth <= args.depth:
+        n = 1000
+        #requester 0 holds the lock, and 1 to depth wait in order
+        waiters = [random.randint(1, depth) for i in range(n)]
+        for name, table in tables:
+            t = fill(table(), depth)
+            retry = op_cost(lambda i: t.acquire("hot", waiters[i]), n)
+            #the holder stays, and the waiter goes to the tail
+            cancel = op_cost(lambda i: (t.release("hot", waiters[i]),
+                                        t.acquire("hot", waiters[i])), n)
+            #the lock passes to requesters 1, 2, ... in turn
+            t = fill(table(), depth)
+            handoff = op_cost(lambda i: (t.release("hot", i % (depth + 1)),
+                                         t.acquire("hot", i % (depth + 1))), n)
+            print("{:<10} {:>8} {:>10.2f} {:>10.2f} {:>10.2f}".format(
+                name, depth, retry, cancel, handoff))
+        depth *= 10
+
+### deadlock ###
+
+#deadlock detection as the viewleader used to run it on every denied
+#lock_get, a depth-first search from the requester
+def legacy_deadlock(table, requester, lockname):
+    to_visit = {"requester": [requester], "lock": [lockname]}
+    visited = {}
+    preds = {requester: {"requester": requester, "lock": lockname}}
+    while to_visit["requester"]:
+        v = to_visit["requester"].pop()
+        v_lock = to_visit["lock"].pop()
+        if v in visited:
+            return True
+        for waited in table.waits(v):
+            #the locks are all exclusive
+            holder = next(iter(table.holders(waited)))
+            to_visit["requester"].append(holder)
+            to_visit["lock"].append(waited)
+            preds[holder] = {"requester": v, "lock": v_lock}
+        visited[v] = True
+    return False
+
+def bench_deadlock(args):
+    import locktable
+
+    def legacy_get(t, lockname, requester):
+        if not t.acquire(lockname, requester):
+            legacy_deadlock(t, requester, lockname)
+
+    def incremental_get(t, lockname, requester):
+        waiting = t.queued(lockname, requester)
+        if not t.acquire(lockname, requester) and not waiting:
+            t.cycle(lockname, requester)
+
+    print("{:<12} {:>8} {:>10} {:>10}".format("detection", "chain", "retry us", "wait us"))
+    chain = 10
+    while chain <= args.chain:
+        for name, get in [("every get", legacy_get), ("incremental", incremental_get)]:
+            #requester i holds lock i and waits for lock i + 1, and "probe"
+            #waits for lock 0
+            t = locktable.LockTable()
+            for i in range(chain + 1):
+                t.acquire(i, i)
+            for i in range(chain):
+                get(t, i + 1, i)
+            get(t, 0, "probe")
+            n = 1000
+            retry = op_cost(lambda i: get(t, 0, "probe"), n)
+            wait = op_cost(lambda i: (get(t, 0, "new"), t.release(0, "new")), n)
+            print("{:<12} {:>8} {:>10.2f} {:>10.2f}".format(name, chain, retry, wait))
+        chain *= 10
+
+    print("")
+    print("{:>8} {:>10}".format("depth", "search ms"))
+    depth = 10
+    while depth <= args.depth:
+        #waiter i holds lock ("own", i), and "new" holds lock "new", which
+        #"other" waits for, so the search from "new" can't be skipped
+        t = locktable.LockTable()
+        t.acquire("hot", "holder")
+        for i in range(depth):
+            t.acquire(("own", i), i)
+            t.acquire("hot", i, locktable.EXCLUSIVE if i % 2 else locktable.SHARED)
+        t.acquire("new", "new")
+        t.acquire("new", "other")
+        t.acquire("hot", "new")
+        search = op_cost(lambda i: t.cycle("hot", "new"), 10)
+        print("{:>8} {:>10.2f}".format(depth, search / 1000))
+        depth *= 10
+
+### handoff ###
+
+#requester taking lock once, releasing it as soon as it is granted
+#poll - seconds between lock_gets, or None for lock_gets held until granted
+def handoff_waiter(port, lockname, requester, poll, released, latencies, counts):
+    args = {"cmd": "lock_get", "lockname": lockname, "requester": requester}
+    if poll is None:
+        args["wait"] = 25
+    while True:
+        response = common.send_receive("localhost", port, args, 30)
+        counts[requester] += 1
+        if "Retry" not in response:
+            break
+        if not response.get("Waited"):
+            time.sleep(poll)
+    latencies.append(time.time() - released[-1])
+    released.append(time.time())
+    common.send_receive("localhost", port, {"cmd": "lock_release", "lockname": lockname,
+                                            "requester": requester})
+
+def bench_handoff(args):
+    import viewleader
+    port = BENCH_PORT + 50
+    start_server(port, viewleader.handler, viewleader.TICK, "threads")
+
+    print("{:<8} {:>10} {:>10} {:>10}".format("lock_get", "p50 ms", "max ms", "gets"))
+    for name, poll in [("poll", args.poll), ("held", None)]:
+        lockname = "bench-" + name
+        released = []
+        latencies = []
+        counts = collections.Counter()
+        #every lock_get and release prints
+        stdout = sys.stdout
+        sys.stdout = open(os.devnull, "w")
+        try:
+            common.send_receive("localhost", port, {"cmd": "lock_get", "lockname": lockname,
+                                                    "requester": "holder"})
+            threads = [threading.Thread(target = handoff_waiter,
+                                        args = (port, lockname, "w{}".format(i), poll, released,
+                                                latencies, counts))
+                       for i in range(args.waiters)]
+            for i in threads:
+                i.start()
+            time.sleep(0.5)
+            released.append(time.time())
+            common.send_receive("localhost", port, {"cmd": "lock_release", "lockname": lockname,
+                                                    "requester": "holder"})
+            for i in threads:
+                i.join()
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+        latencies.sort()
+        print("{:<8} {:>10.2f} {:>10.2f} {:>10.2f}".format(
+            name, latencies[len(latencies) // 2] * 1000, latencies[-1] * 1000,
+            sum(counts.values()) / float(args.waiters)))
+
+### sharing ###
+
+#requester taking lockname in a loop until deadline, in the mode chosen
+#by mode(), holding it for hold seconds each time
+def sharing_client(port, lockname, requester, mode, hold, deadline, counts, holding):
+    while time.time() < deadline:
+        args = {"cmd": "lock_get", "lockname": lockname, "requester": requester,
+                "mode": mode(), "wait": 25}
+        response = common.send_receive("localhost", port, args, 30)
+        while "Retry" in response:
+            response = common.send_receive("localhost", port, args, 30)
+        holding.append(1)
+        counts.append(len(holding))
+        time.sleep(hold)
+        holding.pop()
+        common.send_receive("localhost", port, {"cmd": "lock_release", "lockname": lockname,
+                                                "requester": requester})
+
+def bench_sharing(args):
+    import locktable
+    import viewleader
+    port = BENCH_PORT + 51
+    start_server(port, viewleader.handler, viewleader.TICK, "threads")
+
+    print("{:<10} {:>12} {:>12}".format("reads", "gets/sec", "holders"))
+    readMode = lambda: (locktable.SHARED if random.random() < args.reads
+                        else locktable.EXCLUSIVE)
+    runs = [("exclusive", lambda: locktable.EXCLUSIVE), ("shared", readMode)]
+    for name, mode in runs:
+        lockname = "bench-" + name
+        counts = []
+        holding = []
+        deadline = time.time() + args.duration
+        threads = [threading.Thread(target = sharing_client,
+                                    args = (port, lockname, "c{}".format(i), mode,
+                                            args.hold, deadline, counts, holding))
+                   for i in range(args.clients)]
+        #every lock_get and release prints
+        stdout = sys.stdout
+        sys.stdout = open(os.devnull, "w")
+        try:
+            for i in threads:
+                i.start()
+            for i in threads:
+                i.join()
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+        print("{:<10} {:>12.0f} {:>12.2f}".format(name, len(counts) / args.duration,
+                                                  sum(counts) / float(len(counts))))
+
+### multilock ###
+
+#requester running transactions on random sets of locks until deadline
+#many - True to take the locks with one lock_get_many, False to take them
+#       one after another
+def multilock_client(port, args, requester, many, deadline, counts):
+    def call(message):
+        message["requester"] = requester
+        return common.send_receive("localhost", port, message, 30)
+
+    while time.time() < deadline:
+        locknames = random.sample(range(args.locks), args.size)
+        locknames = ["lock{}".format(i) for i in locknames]
+        while True:
+            if many:
+                message = {"cmd": "lock_get_many", "locknames": locknames, "wait": 25}
+                requests = [message]
+            else:
+                requests = [{"cmd": "lock_get", "lockname": lockname, "wait": 25}
+                            for lockname in locknames]
+            deadlock = False
+            for message in requests:
+                response = {"Retry": True}
+                while "Retry" in response:
+                    response = call(message)
+                    counts["requests"] += 1
+                if response.get("Status") == "Deadlock":
+                    deadlock = True
+                    break
+            if not deadlock:
+                break
+            counts["deadlocks"] += 1
+            for lockname in locknames:
+                call({"cmd": "lock_release", "lockname": lockname})
+        time.sleep(args.hold)
+        for lockname in locknames:
+            call({"cmd": "lock_release", "lockname": lockname})
+        counts["transactions"] += 1
+
+def bench_multilock(args):
+    import viewleader
+    port = BENCH_PORT + 52
+    start_server(port, viewleader.handler, viewleader.TICK, "threads")
+
+    print("{:<14} {:>12} {:>14} {:>10}".format("locks taken", "txns/sec", "requests/txn",
+                                              "deadlocks"))
+    for name, many in [("one by one", False), ("lock_get_many", True)]:
+        counts = collections.Counter()
+        deadline = time.time() + args.duration
+        threads = [threading.Thread(target = multilock_client,
+                                    args = (port, args, "{}{}".format(name, i), many,
+                                            deadline, counts))
+                   for i in range(args.clients)]
+        #every lock_get and release prints
+        stdout = sys.stdout
+        sys.stdout = open(os.devnull, "w")
+        try:
+            for i in threads:
+                i.start()
+            for i in threads:
+                i.join()
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+        print("{:<14} {:>12.0f} {:>14.2f} {:>10}".format(
+            name, counts["transactions"] / args.duration,
+            counts["requests"] / float(counts["transactions"]), counts["deadlocks"]))
+
+### bulk ###
+
+def bench_bulk(args):
+    import client
+    buckets = []
+    for n in range(3):
+        port = BENCH_PORT + 40 + n
+        start_server(port, write_handler(args.delay, 0, 0, n), None, "threads")
+        buckets.append({"addr": "localhost", "port": port, "ID": n})
+    pairs = [["key{}".format(i), "x"] for i in range(args.keys)]
+    batches = [pairs[i:i + client.BATCH_SIZE]
+               for i in range(0, len(pairs), client.BATCH_SIZE)]
+
+    #one 2PC per key, for at most --duration seconds
+    def per_key():
+        deadline = time.time() + args.duration
+        done = 0
+        for key, val in pairs:
+            message = {"key": key, "val": val, "version": client.clock.now()}
+            client.write_2pc(buckets, message, 0, False)
+            done += 1
+            if time.time() > deadline:
+                break
+        return done
+
+    #one 2PC per batch, from that many threads at once
+    def batched(workers):
+        todo = list(batches)
+        def worker():
+            while True:
+                try:
+                    records = todo.pop()
+                except IndexError:
+                    return
+                message = {"txn": "bench", "version": client.clock.now(),
+                           "records": records}
+                client.write_2pc(buckets, message, 0, False)
+        threads = [threading.Thread(target = worker) for i in range(workers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return len(pairs)
+
+    print("{:<12} {:>12} {:>12}".format("setr", "keys/sec", "RPCs/key"))
+    runs = [("per key", per_key), ("batched", lambda: batched(1)),
+            ("batched x{}".format(client.BATCH_WORKERS),
+             lambda: batched(client.BATCH_WORKERS))]
+    for name, f in runs:
+        counts.clear()
+        #the writes print every response
+        stdout = sys.stdout
+        sys.stdout = open(os.devnull, "w")
+        try:
+            start = time.time()
+            done = f()
+            elapsed = time.time() - start
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+        print("{:<12} {:>12.0f} {:>12.4f}".format(name, done / elapsed,
+                                                  sum(counts.values()) / float(done)))
+
+### Main Program ###
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--duration', type=float, default=2.0)
+
+    subparsers = parser.add_subparsers(dest='cmd')
+
+    parser_listen = subparsers.add_parser('listen')
+    parser_listen.add_argument('--delay', type=float, default=0.0)
+    parser_listen.add_argument('--workers', type=int, default=common.WORKERS)
+
+    parser_codec = subparsers.add_parser('codec')
+
+    parser_receive = subparsers.add_parser('receive')
+
+    parser_rebalance = subparsers.add_parser('rebalance')
+    parser_rebalance.add_argument('--keys', type=int, default=1000000)
+    parser_rebalance.add_argument('--servers', type=int, default=16)
+
+    parser_wal = subparsers.add_parser('wal')
+    parser_wal.add_argument('--writers', type=int, default=16)
+    parser_wal.add_argument('--keys', type=int, default=100000)
+
+    parser_store = subparsers.add_parser('store')
+    parser_store.add_argument('--writers', type=int, default=16)
+    parser_store.add_argument('--keys', type=int, default=1000000)
+
+    parser_antientropy = subparsers.add_parser('antientropy')
+    parser_antientropy.add_argument('--keys', type=int, default=1000000)
+
+    parser_ring = subparsers.add_parser('ring')
+    parser_ring.add_argument('--keys', type=int, default=10000)
+
+    parser_fanout = subparsers.add_parser('fanout')
+    parser_fanout.add_argument('--delay', type=float, default=0.002)
+
+    parser_reads = subparsers.add_parser('reads')
+    parser_reads.add_argument('--delay', type=float, default=0.001)
+    parser_reads.add_argument('--slow', type=float, default=0.05)
+    parser_reads.add_argument('--fraction', type=float, default=0.03)
+    parser_reads.add_argument('--reads', type=int, default=1000)
+
+    parser_writes = subparsers.add_parser('writes')
+    parser_writes.add_argument('--delay', type=float, default=0.001)
+    parser_writes.add_argument('--slow', type=float, default=0.05)
+    parser_writes.add_argument('--fraction', type=float, default=0.1)
+    parser_writes.add_argument('--writes', type=int, default=1000)
+
+    parser_commit = subparsers.add_parser('commit')
+    parser_commit.add_argument('--writers', type=int, default=64)
+
+    parser_locks = subparsers.add_parser('locks')
+    parser_locks.add_argument('--locks', type=int, default=100000)
+    parser_locks.add_argument('--depth', type=int, default=10000)
+
+    parser_deadlock = subparsers.add_parser('deadlock')
+    parser_deadlock.add_argument('--chain', type=int, default=10000)
+    parser_deadlock.add_argument('--depth', type=int, default=10000)
+
+    parser_handoff = subparsers.add_parser('handoff')
+    parser_handoff.add_argument('--waiters', type=int, default=8)
+    parser_handoff.add_argument('--poll', type=float, default=5.0)
+
+    parser_sharing = subparsers.add_parser('sharing')
+    parser_sharing.add_argument('--clients', type=int, default=16)
+    parser_sharing.add_argument('--hold', type=float, default=0.01)
+    parser_sharing.add_argument('--reads', type=float, default=0.9)
+
+    parser_multilock = subparsers.add_parser('multilock')
+    parser_multilock.add_argument('--clients', type=int, default=8)
+    parser_multilock.add_argument('--locks', type=int, default=16)
+    parser_multilock.add_argument('--size', type=int, default=3)
+    parser_multilock.add_argument('--hold', type=float, default=0.005)
+
+    parser_bulk = subparsers.add_parser('bulk')
+    parser_bulk.add_argument('--keys', type=int, default=100000)
+    parser_bulk.add_argument('--delay', type=float, default=0.001)
+
+    args = parser.parse_args()
+
+    benchmarks = {
+        "listen": bench_listen,
+        "codec": bench_codec,
+        "receive": bench_receive,
+        "rebalance": bench_rebalance,
+        "wal": bench_wal,
+        "store": bench_store,
+        "antientropy": bench_antientropy,
+        "ring": bench_ring,
+        "fanout": bench_fanout,
+        "reads": bench_reads,
+        "writes": bench_writes,
+        "commit": bench_commit,
+        "locks": bench_locks,
+        "deadlock": bench_deadlock,
+        "handoff": bench_handoff,
+        "sharing": bench_sharing,
+        "multilock": bench_multilock,
+        "bulk": bench_bulk,
+    }
+    benchmarks[args.cmd](args)
+
+    #listening threads never return
+    sys.stdout.flush()
+    os._exit(0)
+
+if __name__ == "__main__":
+    main()
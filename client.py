@@ -30,18 +30,61 @@ Takes one of the arguments (RPC request):
         $ ./client.py query_all_keys
         
     setr: Requests to set a distributed key to a specified value
-        Executed by distributed commit - all-or-nothing semantics
+        The value is stored with a version from the client's clock, and a
+        replica never replaces a newer version with an older one.
         $ ./client.py setr KEY VALUE
+        Takes optional arguments:
+        --write: how the replicas are written (default: 2pc)
+            2pc - distributed commit, all-or-nothing semantics
+            quorum - to all replicas at once, succeeding once --quorum of
+                     them (default: 2) have stored it. Replicas left behind
+                     are repaired by quorum reads and anti-entropy.
+        $ ./client.py setr KEY VALUE --write quorum
     
     getr: Find the value associated with the specified distributed key.
         $ ./client.py getr KEY
+        Takes optional arguments:
+        --read: how the replicas are read (default: order)
+            order - one after another, until one has the key
+            hedged - as order, but also asks the next replica when one
+                     hasn't answered within --hedge-delay seconds (by
+                     default the 95th percentile of recent reads)
+            quorum - all at once, returning the freshest value among the
+                     first --quorum answers (default: 2), and sending it
+                     to those that answered with an older one
+        $ ./client.py getr KEY --read hedged --hedge-delay 0.01
+
+    setr_many: Sets many distributed keys, with one setr for each batch of
+        keys held by the same servers
+        Takes the same optional arguments as setr.
+        $ ./client.py setr_many KEY VALUE [KEY VALUE ...]
+
+    getr_many: Finds the values of many distributed keys, asking the servers
+        holding each batch of keys for all of them at once
+        $ ./client.py getr_many KEY [KEY ...]
+
+    setr and getr keep the view from the viewleader for later calls in the
+    same process, and only ask for it again once a server reports another
+    epoch or can't be reached, or after VIEW_TTL seconds.
         
 --- to Viewleader ---            
     query_servers: Returns the view leader's active servers and current epoch
         $ ./client.py query_servers
 
-    lock_get: Requests a lock from the viewleader.
-        $ ./client.py lock_get LOCKNAME REQUESTER
+    lock_get: Requests a lock from the viewleader, which answers as soon as
+        the lock is handed to the requester. --wait 0 asks again every
+        LOCK_POLL seconds instead, as viewleaders that can't hold a request
+        make it do anyway. --mode shared asks to share the lock with other
+        requesters asking to share it; asking for a lock shared by the
+        requester exclusively upgrades it, and the other way round
+        downgrades it.
+        $ ./client.py lock_get LOCKNAME REQUESTER [--wait SECONDS] [--mode shared|exclusive]
+
+    lock_get_many: Requests a set of locks from the viewleader in a single
+        call, which grants all of them at once or none of them. The
+        requester waits for the whole set, holding none of it meanwhile.
+        Takes the same options as lock_get.
+        $ ./client.py lock_get_many REQUESTER LOCKNAME [LOCKNAME ...]
         
     lock_release: Releases a lock that it holds.
         $ ./client.py lock_release LOCKNAME REQUESTER
@@ -55,15 +98,75 @@ e.g. valid RPC request to a server with address 10.0.2.5
 
 import common
 import common2
+import hlc
+import locktable
+import ring
 import argparse
+import collections
+import threading
 import time
 import sys
 import json
+import uuid
+
+#query_servers response kept across setr/getr calls, and when it was fetched
+VIEW_TTL = 30
+viewCache = {"view": None, "ring": None, "time": 0}
+
+#seconds each server has to answer a 2PC message
+TWO_PC_TIMEOUT = 5
+
+#most keys sent in one batch by setr_many and getr_many
+BATCH_SIZE = 1000
+#batches setr_many writes at once, each from its own thread, as the 2PC
+#fan-out of each batch runs on the common.fanout pool
+BATCH_WORKERS = 4
+
+#versions of the values written by this client
+clock = hlc.Clock(uuid.uuid4().hex[:8])
+
+#how setr writes and getr reads, set from the command line
+#   write - 2pc: commits to every replica or none of them
+#           quorum: succeeds once writeQuorum replicas have the value
+#   read - order: asks the replicas one after another, moving on when one
+#                 fails or doesn't have the key
+#          hedged: as order, but also moves on when a replica hasn't
+#                  answered within the hedge delay
+#          quorum: asks every replica at once and returns the freshest
+#                  value among the first readQuorum answers
+#   hedgeDelay - seconds before a hedged read asks the next replica, or
+#                None for the 95th percentile of recent reads
+config = {
+    "write": "2pc",
+    "writeQuorum": 2,
+    "read": "order",
+    "hedgeDelay": None,
+    "readQuorum": 2,
+}
+WRITE_MODES = ["2pc", "quorum"]
+READ_MODES = ["order", "hedged", "quorum"]
+
+#seconds each server has to answer a get
+READ_TIMEOUT = 5
+
+#seconds a lock_get asks the viewleader to hold it until the lock is
+#granted, before asking again, and seconds between lock_gets when the
+#viewleader doesn't hold them
+LOCK_WAIT = 25
+LOCK_POLL = 5
+#seconds the viewleader has to answer on top of the time it holds a lock_get
+LOCK_TIMEOUT = 5
+#hedge delay until HEDGE_MIN_SAMPLES reads have been timed
+HEDGE_DELAY = 0.05
+HEDGE_MIN_SAMPLES = 20
+#seconds taken by the last reads answered
+readLatencies = collections.deque(maxlen = 100)
 
 #determines which address and ports to connect to by the RPC call
 def connectHandler(msg):
     connect = {
         "server": {"addr": msg["server"],
+            "role": "server",
             "portLow": common2.serverLow, 
             "portHigh": common2.serverHigh,
             "cmds": ["set", "get", "print", "query_all_keys"],
@@ -71,14 +174,16 @@ def connectHandler(msg):
               },
         
         "viewleader": {"addr": msg["viewleader"],
+            "role": "viewleader",
             "portLow": common2.viewleaderLow, 
             "portHigh": common2.viewleaderHigh,
-            "cmds": ["lock_get", "lock_release", "query_servers"],
+            "cmds": ["lock_get", "lock_get_many", "lock_release", "query_servers"],
             "distributed": False
               },
         "distributed": {
-            "cmds": ["setr", "getr"],
+            "cmds": ["setr", "getr", "setr_many", "getr_many"],
             "addr": msg["viewleader"],
+            "role": "viewleader",
             "portLow": common2.viewleaderLow, 
             "portHigh": common2.viewleaderHigh,
             "distributed": True
@@ -97,156 +202,505 @@ def connect(connectTo, args):
     portLow = connectTo["portLow"]
     portHigh = connectTo["portHigh"]
     connectTarget = connectTo["addr"]
+    role = connectTo["role"]
     
-    for port in range(portLow, portHigh):
-        print ("Trying to connect to {}:{}...".format(connectTarget, port))
-        response = common.send_receive(connectTarget, port, args)
-        if "Error" in response:
-            continue
-        
-        #in the event of waiting for lock, repeat RPC every 5 seconds
-        if "Retry" in response:
-            while "Retry" in response:
-                time.sleep(5)
-                print("Waiting on lock {}".format(args.lockname))
-                for port in range(portLow, portHigh):
-                    response = common.send_receive(connectTarget, port, args)
-                    if "Error" in response:
-                        continue
-                    break
-                else:
-                    print "Client has failed to connect. Exiting program..."
-                    sys.exit()
-        return response
-    else:
+    #a lock_get held by the viewleader takes as long as it waits
+    timeout = None
+    if args.get("wait"):
+        timeout = args["wait"] + LOCK_TIMEOUT
+
+    print ("Trying to connect to {}...".format(connectTarget))
+    response = common.send_receive_any(connectTarget, portLow, portHigh, args, role,
+                                       timeout)
+    if "Error" in response:
         return {"Error": "Failed to connect."}
     
+    #in the event of waiting for lock, repeat RPC, straight away if the
+    #viewleader held it until it gave up waiting, or every LOCK_POLL seconds
+    while "Retry" in response:
+        if not response.get("Waited"):
+            time.sleep(LOCK_POLL)
+        if "locknames" in args:
+            print("Waiting on locks {}".format(", ".join(args["locknames"])))
+        else:
+            print("Waiting on lock {}".format(args["lockname"]))
+        response = common.send_receive_any(connectTarget, portLow, portHigh, args, role,
+                                           timeout)
+        if "Error" in response:
+            print "Client has failed to connect. Exiting program..."
+            sys.exit()
+    return response
+    
+#returns the query_servers response, and True if it was just fetched
+#the cached view is used unless refresh is set, it is too old, or servers
+#were rebalancing when it was fetched
+#viewCache["ring"] is the ring of the cached view
+def cached_view(connectTo, refresh=False):
+    view = viewCache["view"]
+    if (refresh or view is None or view["Rebalance status"]
+            or time.time() - viewCache["time"] > VIEW_TTL):
+        view = connect(connectTo, {"cmd": "query_servers"})
+        if "Error" in view:
+            return view, True
+        viewCache["view"] = view
+        viewCache["ring"] = ring.Ring(server_list(view), view.get("Vnodes", 1))
+        viewCache["time"] = time.time()
+        return view, True
+    return view, False
+
+#returns the list of active servers from a query_servers response
+#older viewleaders send it as a JSON string
+def server_list(view):
+    if isinstance(view["Result"], basestring):
+        return json.loads(view["Result"])
+    return view["Result"]
+
 #bucket allocator
-def bucket_allocator(key, view):
-    buckets = []
-    #if < 3 servers, all servers should have the key
-    if len(view) <= 3:
-        buckets = view
+#view is a ring.Ring, or a list of servers with vnodes positions each
+def bucket_allocator(key, view, vnodes=1):
+    if not isinstance(view, ring.Ring):
+        view = ring.Ring(view, vnodes)
+    return [common.connectBucket(i) for i in view.lookup(key)]
+
+#splits keys into batches of at most BATCH_SIZE keys held by the same
+#servers in ring r
+#returns a list of (buckets, keys) pairs
+def batch_keys(keys, r):
+    groups = collections.OrderedDict()
+    for key in keys:
+        groups.setdefault(tuple(r.owners(common.hash_key(key))), []).append(key)
+    batches = []
+    for owners, group in groups.items():
+        buckets = [common.connectBucket(r.servers[i]) for i in owners]
+        for i in range(0, len(group), BATCH_SIZE):
+            batches.append((buckets, group[i:i + BATCH_SIZE]))
+    return batches
+
+#the message for cmd, from the message of a setr
+#the message of a setr_many batch holds the [key, value] records of the
+#batch, which are streamed to the servers: the keys alone for a vote or an
+#abort, and the records for a commit or a put
+def write_message(message, cmd):
+    if "records" not in message:
+        return dict(message, cmd = cmd)
+    result = dict((k, v) for k, v in message.items() if k != "records")
+    result["cmd"] = cmd
+    if cmd in ("twoPC_commit", "put"):
+        result["stream"] = message["records"]
     else:
-        #sorts view by servers' identity hash
-        sortedView = sorted(view, key=lambda k: k["ID"])
-        keyHash = common.hash_key(key)
-
-        #allocates key to at most 3 buckets
-        for i in sortedView:
-            if len(buckets) == 3:
-                break
-            if i["ID"] >= keyHash:
-                buckets.append({"IP": i["IP"], "ID": i["ID"]})
-
-        #wraps around the circular distributed hashtable
-        if len(buckets) < 3:
-            for i in range(3 - len(buckets)):
-                buckets.append({"IP": sortedView[i]["IP"], "ID": sortedView[i]["ID"]})
-            
-    bucketAddr = []
-    for i in buckets:
-        bucket = common.connectBucket(i)
-        bucketAddr.append(bucket)
-    return bucketAddr
-    
-# distributed set
-def setr(args, connectTo):
-    key = args["key"]
-    val = args["val"]
-    voteResults = []
-        
-    #RPC query_servers
-    args["cmd"] = "query_servers"
-    view = connect(connectTo, args)
-    currentEpoch = view["Epoch"]
-    
-    #abort if servers are rebalancing
-    if view["Rebalance status"]:
-        print("Status: Servers are rebalancing. Setr aborted.")
-        return None
-    
-    view = json.loads(view["Result"])
-    
-    #finds the appropriate buckets to store key
-    buckets = bucket_allocator(key, view)
-    if buckets == []:
-        print("Status: No servers available. Setr aborted")
-        return None
-    
+        result["stream"] = [r[0] for r in message["records"]]
+    return result
+
+#aborts a 2PC on the servers whose votes were still on the way when it was
+#aborted, once each vote arrives, so that the abort can't overtake it
+def abort_late(votes, buckets, args):
+    for n, response in votes:
+        common.send_receive(buckets[n]["addr"], buckets[n]["port"], args, TWO_PC_TIMEOUT)
+
+#writes to the replicas by distributed commit
+#the vote, abort and commit messages go to every bucket at once, and the
+#vote stops at the first server that doesn't vote YES
+#retry is True if the setr will be tried again with a fresh view when a
+#server disagrees with this one
+#returns True if the value was committed, and True if a server disagreed
+#with the view
+def write_2pc(buckets, message, epoch, retry):
+    stale = False
+
     #RPC twoPC_vote to all the buckets
-    #store results in voteResults
-    args["cmd"] = "twoPC_vote"
-    for i in buckets:
-        response = common.send_receive(i["addr"], i["port"], args)
+    votes = common.send_receive_all(buckets, write_message(message, "twoPC_vote"), TWO_PC_TIMEOUT)
+    voted = [] #buckets whose votes have arrived
+    commit = True
+    for n, response in votes:
+        i = buckets[n]
+        voted.append(i)
         if "Error" in response:
-            voteResults.append(False)
+            stale = True
             print("Status: Server {} is not responding.".format(i["ID"]))
-            
+
         elif response["ID"] != i["ID"]:
-            voteResults.append(False)
+            stale = True
             print("Error: Server IDs do not match.")
-            
-        elif response["Epoch"] != currentEpoch:
-            voteResults.append(False)
+
+        elif response["Epoch"] != epoch:
+            stale = True
             print("Error: Epochs do not match.")
-            
+
+        elif response["Vote"]:
+            continue
+
+        commit = False
+        break
+
+    if not commit:
+        #RPC twoPC_abort to the buckets that voted, and to the others once
+        #their votes arrive
+        abortArgs = write_message(message, "twoPC_abort")
+        for n, response in common.send_receive_all(voted, abortArgs, TWO_PC_TIMEOUT):
+            pass
+        if stale and retry:
+            #the retry votes on the same key, so no vote may be left pending
+            abort_late(votes, buckets, abortArgs)
         else:
-            voteResults.append(response["Vote"])
-    #time.sleep(10)
-    
-    if False in voteResults:
-        #RPC twoPC_abort
-        args["cmd"] = "twoPC_abort"
-        for i in buckets:
-            response = common.send_receive(i["addr"], i["port"], args)
-        print("Error: Setr aborted.")
-        
-    else:
-        #RPC twoPC_commit
-        args["cmd"] = "twoPC_commit"
-        for i in buckets:
-            response = common.send_receive(i["addr"], i["port"], args)
-            #prints status of set in each bucket
-            print (json.dumps(response), json.dumps(i))
-        print("Status: Setr commited.")
-        
-    return None
+            threading.Thread(target = abort_late, args = (votes, buckets, abortArgs)).start()
+        return False, stale
 
-#distributed get
-def getr(args, connectTo):
+    #RPC twoPC_commit
+    for n, response in common.send_receive_all(buckets, write_message(message, "twoPC_commit"), TWO_PC_TIMEOUT):
+        #prints status of set in each bucket
+        print (json.dumps(response), json.dumps(buckets[n]))
+    return True, stale
+
+#writes to every replica at once, and returns once config["writeQuorum"] of
+#them have stored the value, or a newer version of the key. The others
+#finish on their own.
+#returns the same as write_2pc
+def write_quorum(buckets, message, epoch, retry):
+    quorum = min(config["writeQuorum"], len(buckets))
+    stale = False
+    acks = 0
+    for n, response in common.send_receive_all(buckets, write_message(message, "put"), TWO_PC_TIMEOUT):
+        i = buckets[n]
+        print (json.dumps(response), json.dumps(i))
+        if "Error" in response:
+            stale = True
+            print("Status: Server {} is not responding.".format(i["ID"]))
+        elif response["ID"] != i["ID"] or response["Epoch"] != epoch:
+            #the server may not hold the key at all, so its answer doesn't count
+            stale = True
+            print("Error: Server disagrees with the view.")
+        else:
+            clock.update(response.get("Version"))
+            acks += 1
+            if acks == quorum:
+                return True, stale
+    print("Error: {} of {} replicas stored the value.".format(acks, quorum))
+    return False, stale
+
+# distributed set
+# the replicas are written as config["write"] says, all with the same
+# version, taken once so that a retry doesn't make a newer one
+# a setr that fails because the cached view was out of date is tried again
+# with a fresh one
+def setr(args, connectTo):
     key = args["key"]
-    
-    #RPC query_servers
-    args["cmd"] = "query_servers"
-    view = connect(connectTo, args)
-    
-    #abort if servers are rebalancing
-    if view["Rebalance status"]:
-        print("Error: Servers are rebalancing. Getr aborted.")
+    refresh = False
+    write = {"2pc": write_2pc, "quorum": write_quorum}[config["write"]]
+    message = dict(args, version = clock.now())
+    while True:
+        #RPC query_servers, unless the view is cached
+        view, fresh = cached_view(connectTo, refresh)
+        if "Error" in view:
+            print("Error: Can't reach the viewleader. Setr aborted.")
+            return None
+        currentEpoch = view["Epoch"]
+
+        #abort if servers are rebalancing
+        if view["Rebalance status"]:
+            print("Status: Servers are rebalancing. Setr aborted.")
+            return None
+
+        #finds the appropriate buckets to store key
+        buckets = bucket_allocator(key, viewCache["ring"])
+        if buckets == []:
+            print("Status: No servers available. Setr aborted")
+            return None
+
+        written, stale = write(buckets, message, currentEpoch, not fresh)
+        if written:
+            print("Status: Setr commited.")
+            return None
+        if stale and not fresh:
+            print("Status: View is out of date. Retrying setr.")
+            refresh = True
+            continue
+        print("Error: Setr aborted.")
         return None
-    
-    view = json.loads(view["Result"])
-    buckets = bucket_allocator(key, view)
 
-    #RPC Get
-    args["cmd"] = "get"
+# distributed set of many keys
+# the keys are written in batches of keys held by the same servers, each
+# batch as config["write"] says, and all with the same version. Up to
+# BATCH_WORKERS batches are written at once. Batches that fail because the
+# cached view was out of date are tried again with a fresh one.
+# pairs - list of (key, value) pairs
+# returns the keys that weren't set
+def setr_many(pairs, connectTo):
+    write = {"2pc": write_2pc, "quorum": write_quorum}[config["write"]]
+    version = clock.now()
+    values = collections.OrderedDict(pairs)
+    failed = []
+    refresh = False
+    while values:
+        #RPC query_servers, unless the view is cached
+        view, fresh = cached_view(connectTo, refresh)
+        if "Error" in view:
+            print("Error: Can't reach the viewleader. Setr_many aborted.")
+            return failed + list(values)
+        currentEpoch = view["Epoch"]
+
+        #abort if servers are rebalancing
+        if view["Rebalance status"]:
+            print("Status: Servers are rebalancing. Setr_many aborted.")
+            return failed + list(values)
+
+        if not viewCache["ring"].ids:
+            print("Status: No servers available. Setr_many aborted")
+            return failed + list(values)
+
+        batches = batch_keys(list(values), viewCache["ring"])
+        results = []
+        def worker():
+            while True:
+                try:
+                    buckets, keys = batches.pop()
+                except IndexError:
+                    return
+                message = {"txn": uuid.uuid4().hex, "version": version,
+                           "records": [[k, values[k]] for k in keys]}
+                results.append((keys, write(buckets, message, currentEpoch, not fresh)))
+        workers = [threading.Thread(target = worker)
+                   for i in range(min(BATCH_WORKERS, len(batches)))]
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+
+        for keys, (written, stale) in results:
+            if written or not stale or fresh:
+                for k in keys:
+                    del values[k]
+                if not written:
+                    failed.extend(keys)
+        if values:
+            print("Status: View is out of date. Retrying {} keys.".format(len(values)))
+            refresh = True
+
+    print("Status: Setr_many commited {} of {} keys.".format(len(pairs) - len(failed), len(pairs)))
+    return failed
+
+# distributed get of many keys
+# the servers holding each batch of keys are asked for all of them at once,
+# one after another, until each key is found or every server has been
+# asked. Keys that can't be read with a cached view that is out of date
+# are tried again with a fresh one.
+# returns a dict of the values found
+def getr_many(keys, connectTo):
+    found = {}
+    missing = list(keys)
+    refresh = False
+    while True:
+        #RPC query_servers, unless the view is cached
+        view, fresh = cached_view(connectTo, refresh)
+        if "Error" in view:
+            print("Error: Can't reach the viewleader. Getr_many aborted.")
+            return found
+        currentEpoch = view["Epoch"]
+
+        #abort if servers are rebalancing
+        if view["Rebalance status"]:
+            print("Error: Servers are rebalancing. Getr_many aborted.")
+            return found
+
+        stale = False
+        if viewCache["ring"].ids:
+            batches = batch_keys(missing, viewCache["ring"])
+        else:
+            batches = []
+        for buckets, batch in batches:
+            for i in buckets:
+                #RPC mget
+                response = common.send_receive(i["addr"], i["port"],
+                                               {"cmd": "mget", "stream": batch}, READ_TIMEOUT)
+                records = list(response.pop("stream", []))
+                if read_failed(response, currentEpoch):
+                    print(json.dumps(response))
+                    stale = True
+                    continue
+                for record in records:
+                    found[record[0]] = record[1]
+                    if len(record) > 2:
+                        clock.update(record[2])
+                batch = [k for k in batch if k not in found]
+                if not batch:
+                    break
+        missing = [k for k in missing if k not in found]
+
+        if missing and stale and not fresh:
+            print("Status: View is out of date. Retrying {} keys.".format(len(missing)))
+            refresh = True
+            continue
+        break
+
+    for key in keys:
+        if key in found:
+            print("{}: {}".format(key, json.dumps(found[key])))
+        else:
+            print("{}: Key doesn't exist.".format(key))
+    return found
+
+#seconds before a hedged read asks the next replica
+def hedge_delay():
+    if config["hedgeDelay"] is not None:
+        return config["hedgeDelay"]
+    if len(readLatencies) < HEDGE_MIN_SAMPLES:
+        return HEDGE_DELAY
+    latencies = sorted(readLatencies)
+    return latencies[int(len(latencies) * 0.95)]
+
+#True if a get response is an error or comes from another epoch
+def read_failed(response, epoch):
+    return "Error" in response or response.get("Epoch", epoch) != epoch
+
+#reads from the replicas one after another
+#returns the response holding the value, or None, and True if a server
+#disagreed with the view
+def read_order(buckets, message, epoch):
+    stale = False
     for i in buckets:
-        response = common.send_receive(i["addr"], i["port"], args)
+        start = time.time()
+        response = common.send_receive(i["addr"], i["port"], message, READ_TIMEOUT)
         print(json.dumps(response))
-        
+
         #terminates when a value is returned
         if "Value" in response:
+            readLatencies.append(time.time() - start)
+            return response, stale
+        if read_failed(response, epoch):
+            stale = True
+    return None, stale
+
+#reads from the primary, and from the next replica as well whenever the
+#ones asked so far have failed, or haven't answered within the hedge delay
+#returns the same as read_order
+def read_hedged(buckets, message, epoch):
+    if not buckets:
+        return None, False
+    responses = []
+    arrived = threading.Condition()
+    state = {"sent": 0, "done": False}
+
+    #asks replica n after delay seconds, unless it has been asked already or
+    #a value has come back since
+    def ask(n, delay):
+        if delay:
+            time.sleep(delay)
+        with arrived:
+            if state["done"] or state["sent"] != n:
+                return
+            state["sent"] = n + 1
+        if n + 1 < len(buckets):
+            common.fanout(ask, n + 1, hedge_delay())
+        start = time.time()
+        response = common.send_receive(buckets[n]["addr"], buckets[n]["port"],
+                                       message, READ_TIMEOUT)
+        with arrived:
+            responses.append((response, time.time() - start))
+            arrived.notify()
+
+    common.fanout(ask, 0, 0)
+    stale = False
+    received = 0
+    while True:
+        with arrived:
+            while len(responses) == received:
+                arrived.wait()
+            response, latency = responses[received]
+            received += 1
+            sent = state["sent"]
+            if "Value" in response:
+                state["done"] = True
+        print(json.dumps(response))
+
+        if "Value" in response:
+            readLatencies.append(latency)
+            return response, stale
+        if read_failed(response, epoch):
+            stale = True
+        if sent < len(buckets):
+            common.fanout(ask, sent, 0)
+        elif received == sent:
+            return None, stale
+
+#reads from every replica at once, and returns the freshest value among the
+#first config["readQuorum"] answers
+#values are compared by their "Version", which servers that don't keep
+#versions leave out, in which case the first answer wins
+#the replicas among those that answered with an older version, or without
+#the key, are sent the freshest value in the background
+#returns the same as read_order
+def read_quorum(buckets, message, epoch):
+    quorum = min(config["readQuorum"], len(buckets))
+    stale = False
+    answers = []
+    for n, response in common.send_receive_all(buckets, message, READ_TIMEOUT):
+        print(json.dumps(response))
+        if read_failed(response, epoch):
+            stale = True
+            continue
+        answers.append((n, response))
+        if len(answers) == quorum:
+            break
+    if len(answers) < quorum:
+        print("Error: {} of {} replicas answered.".format(len(answers), quorum))
+        return None, stale
+    values = [i for n, i in answers if "Value" in i]
+    if not values:
+        return None, stale
+    response = max(values, key=lambda i: i.get("Version"))
+    print("Status: Freshest answer {}".format(json.dumps(response)))
+    version = response.get("Version")
+    if version is not None:
+        repair = {"cmd": "put", "key": message["key"], "val": response["Value"],
+                  "version": version}
+        for n, i in answers:
+            if hlc.newer(version, i.get("Version")):
+                print("Status: Repairing server {}.".format(buckets[n]["ID"]))
+                common.fanout(common.send_receive, buckets[n]["addr"],
+                              buckets[n]["port"], repair, READ_TIMEOUT)
+    return response, stale
+
+#distributed get
+#the replicas are read as config["read"] says
+#a getr that fails with a cached view that is out of date is tried again
+#with a fresh one
+def getr(args, connectTo):
+    key = args["key"]
+    refresh = False
+    read = {"order": read_order, "hedged": read_hedged, "quorum": read_quorum}[config["read"]]
+    while True:
+        #RPC query_servers, unless the view is cached
+        view, fresh = cached_view(connectTo, refresh)
+        if "Error" in view:
+            print("Error: Can't reach the viewleader. Getr aborted.")
             return None
-    
-    print("Error: Failed to access key in any server.")
-    return None
+        currentEpoch = view["Epoch"]
+
+        #abort if servers are rebalancing
+        if view["Rebalance status"]:
+            print("Error: Servers are rebalancing. Getr aborted.")
+            return None
+
+        buckets = bucket_allocator(key, viewCache["ring"])
+
+        #RPC Get
+        response, stale = read(buckets, dict(args, cmd = "get"), currentEpoch)
+        if response is not None:
+            clock.update(response.get("Version"))
+            return None
+
+        if stale and not fresh:
+            print("Status: View is out of date. Retrying getr.")
+            refresh = True
+            continue
+        print("Error: Failed to access key in any server.")
+        return None
 
 # Client entry point
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('--server', default='localhost')
     parser.add_argument('--viewleader', default='localhost')
+    parser.add_argument('--codec', default=common.CODECS[0], choices=common.CODECS)
 
     subparsers = parser.add_subparsers(dest='cmd')
     
@@ -267,6 +721,14 @@ def main():
     parser_lockGet = subparsers.add_parser('lock_get')
     parser_lockGet.add_argument('lockname', type=str)
     parser_lockGet.add_argument('requester', type=str)
+    parser_lockGet.add_argument('--wait', type=float, default=LOCK_WAIT)
+    parser_lockGet.add_argument('--mode', default=locktable.EXCLUSIVE, choices=locktable.MODES)
+
+    parser_lockGetMany = subparsers.add_parser('lock_get_many')
+    parser_lockGetMany.add_argument('requester', type=str)
+    parser_lockGetMany.add_argument('locknames', nargs='+', metavar='LOCKNAME')
+    parser_lockGetMany.add_argument('--wait', type=float, default=LOCK_WAIT)
+    parser_lockGetMany.add_argument('--mode', default=locktable.EXCLUSIVE, choices=locktable.MODES)
 
     parser_lockRelease = subparsers.add_parser('lock_release')
     parser_lockRelease.add_argument('lockname', type=str)
@@ -275,26 +737,63 @@ def main():
     parser_setr = subparsers.add_parser('setr')
     parser_setr.add_argument('key', type=str)
     parser_setr.add_argument('val', type=str)
+    parser_setr.add_argument('--write', default=config["write"], choices=WRITE_MODES)
+    parser_setr.add_argument('--quorum', type=int, default=config["writeQuorum"])
     
+    parser_setrMany = subparsers.add_parser('setr_many')
+    parser_setrMany.add_argument('pairs', nargs='+', metavar='KEY VALUE')
+    parser_setrMany.add_argument('--write', default=config["write"], choices=WRITE_MODES)
+    parser_setrMany.add_argument('--quorum', type=int, default=config["writeQuorum"])
+
+    parser_getrMany = subparsers.add_parser('getr_many')
+    parser_getrMany.add_argument('keys', nargs='+')
+
     parser_getr = subparsers.add_parser('getr')
     parser_getr.add_argument('key', type=str)
+    parser_getr.add_argument('--read', default=config["read"], choices=READ_MODES)
+    parser_getr.add_argument('--hedge-delay', type=float, default=config["hedgeDelay"])
+    parser_getr.add_argument('--quorum', type=int, default=config["readQuorum"])
 
     args = vars(parser.parse_args())
+    common.prefer_codec(args.pop("codec"))
+    if args["cmd"] == "setr_many" and len(args["pairs"]) % 2:
+        parser.error("setr_many takes KEY VALUE pairs")
+    if args["cmd"] in ("setr", "setr_many"):
+        config["write"] = args.pop("write")
+        config["writeQuorum"] = args.pop("quorum")
+    if args["cmd"] == "getr":
+        config["read"] = args.pop("read")
+        config["hedgeDelay"] = args.pop("hedge_delay")
+        config["readQuorum"] = args.pop("quorum")
     
     connectTo = connectHandler(args)
 
     if connectTo["distributed"]:
         if args["cmd"] == "setr":
             setr(args, connectTo)
+        elif args["cmd"] == "setr_many":
+            pairs = args["pairs"]
+            setr_many(zip(pairs[::2], pairs[1::2]), connectTo)
+        elif args["cmd"] == "getr_many":
+            getr_many(args["keys"], connectTo)
         else:
             getr(args, connectTo)
   
     else:
         #RPC call to a server / viewleader
+        if args["cmd"] == "query_all_keys":
+            #keys are streamed back in chunks
+            args["chunked"] = True
         response = connect(connectTo, args)
+        keys = response.pop("stream", None)
         #print response            
-        for p in response.iteritems():
-            print ("{}: {}".format(*p))
+        for k, v in response.iteritems():
+            if isinstance(v, (list, dict)):
+                v = json.dumps(v)
+            print ("{}: {}".format(k, v))
+        if keys is not None:
+            for i in keys:
+                print (i)
 
 if __name__ == "__main__":
     main() 
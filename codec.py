@@ -0,0 +1,169 @@
+import binascii
+import struct
+
+#Compact binary encoding for RPC messages
+#An alternative to JSON for the dict/list/str/int messages exchanged by
+#the client, server and viewleader. Every value starts with a 1-byte tag:
+#
+#   N - None                     T / F - True / False
+#   i - int, 8-byte signed       I / J - non-negative / negative int of any
+#   d - float, 8-byte double             size, 1-byte length + magnitude
+#   s - str, 1-byte length + UTF-8 bytes
+#   S - str, 4-byte length + UTF-8 bytes
+#   l / L - list, 1-byte / 4-byte count + items
+#   m / M - dict, 1-byte / 4-byte count + key/value pairs
+#
+#Server IDs are 160-bit SHA-1 hashes, which take 22 bytes here instead of
+#49 decimal digits in JSON. Strings decode to the same type as json.loads.
+
+try:
+    text_type = unicode
+    integer_types = (int, long)
+except NameError:
+    text_type = str
+    integer_types = (int,)
+
+COUNT = struct.Struct("!I")
+SHORT = struct.Struct("!B")
+INT64 = struct.Struct("!q")
+FLOAT = struct.Struct("!d")
+
+INT64_MIN = -2 ** 63
+INT64_MAX = 2 ** 63 - 1
+
+#tags as the integers found in a bytearray, (short, long) where paired
+STRING = (ord("s"), ord("S"))
+DICT = (ord("m"), ord("M"))
+LIST = (ord("l"), ord("L"))
+BIGINT = (ord("I"), ord("J"))
+INT, TRUE, FALSE, NONE, DOUBLE = [ord(i) for i in "iTFNd"]
+
+# Encodes a message
+# Raises ValueError for values that can't be encoded
+def encode(obj):
+    out = []
+    encode_into(obj, out)
+    return b"".join(out)
+
+# Appends the tag and length of a string or container
+def encode_header(short, long, n, out):
+    if n < 256:
+        out.append(short + SHORT.pack(n))
+    else:
+        out.append(long + COUNT.pack(n))
+
+# Appends the encoding of obj to the list out
+def encode_into(obj, out):
+    t = type(obj)
+    if t is text_type:
+        data = obj.encode("utf-8")
+        encode_header(b"s", b"S", len(data), out)
+        out.append(data)
+    elif t is bytes:
+        #Python 2 str, assumed to be UTF-8 text as json does
+        encode_header(b"s", b"S", len(obj), out)
+        out.append(obj)
+    elif t is dict:
+        encode_header(b"m", b"M", len(obj), out)
+        for k, v in obj.items():
+            encode_into(k, out)
+            encode_into(v, out)
+    elif t is list or t is tuple:
+        encode_header(b"l", b"L", len(obj), out)
+        for i in obj:
+            encode_into(i, out)
+    elif t is bool:
+        out.append(b"T" if obj else b"F")
+    elif t in integer_types:
+        if INT64_MIN <= obj <= INT64_MAX:
+            out.append(b"i" + INT64.pack(obj))
+        else:
+            digits = "{:x}".format(abs(obj))
+            data = binascii.unhexlify(("0" if len(digits) % 2 else "") + digits)
+            if len(data) > 255:
+                raise ValueError("can't encode int of {} bytes".format(len(data)))
+            out.append((b"I" if obj > 0 else b"J") + SHORT.pack(len(data)))
+            out.append(data)
+    elif obj is None:
+        out.append(b"N")
+    elif t is float:
+        out.append(b"d" + FLOAT.pack(obj))
+    else:
+        raise ValueError("can't encode {}".format(t.__name__))
+
+# Decodes a message
+# Parameters
+#   data - bytes, or a bytearray that is parsed in place
+#   end - length of the message, if data holds more than the message
+# Raises ValueError if data isn't a complete encoding of one value
+def decode(data, end=None):
+    if not isinstance(data, bytearray):
+        data = bytearray(data)
+    if end is None:
+        end = len(data)
+    try:
+        obj, pos = decode_from(data, 0)
+    except (IndexError, KeyError, struct.error, UnicodeDecodeError) as e:
+        raise ValueError("malformed message: {}".format(e))
+    if pos != end:
+        #values are parsed up to the end of data, past end if need be, so
+        #a message that is cut short shows up here
+        raise ValueError("malformed message: expected {} bytes, got {}".format(pos, end))
+    return obj
+
+# Decodes the value starting at pos in the bytearray data
+# Return value
+#   (value, position after the value)
+def decode_from(data, pos):
+    tag = data[pos]
+    if tag in STRING:
+        if tag == STRING[0]:
+            n = data[pos + 1]
+            pos += 2
+        else:
+            n = COUNT.unpack_from(data, pos + 1)[0]
+            pos += 5
+        if pos + n > len(data):
+            raise IndexError("string runs past the end")
+        return data[pos:pos + n].decode("utf-8"), pos + n
+    if tag in DICT:
+        if tag == DICT[0]:
+            n = data[pos + 1]
+            pos += 2
+        else:
+            n = COUNT.unpack_from(data, pos + 1)[0]
+            pos += 5
+        obj = {}
+        for i in range(n):
+            k, pos = decode_from(data, pos)
+            obj[k], pos = decode_from(data, pos)
+        return obj, pos
+    if tag in LIST:
+        if tag == LIST[0]:
+            n = data[pos + 1]
+            pos += 2
+        else:
+            n = COUNT.unpack_from(data, pos + 1)[0]
+            pos += 5
+        obj = [None] * n
+        for i in range(n):
+            obj[i], pos = decode_from(data, pos)
+        return obj, pos
+    if tag == INT:
+        return INT64.unpack_from(data, pos + 1)[0], pos + 9
+    if tag in BIGINT:
+        n = data[pos + 1]
+        pos += 2
+        if pos + n > len(data):
+            raise IndexError("integer runs past the end")
+        obj = int(binascii.hexlify(data[pos:pos + n]), 16)
+        return (obj if tag == BIGINT[0] else -obj), pos + n
+    if tag == TRUE:
+        return True, pos + 1
+    if tag == FALSE:
+        return False, pos + 1
+    if tag == NONE:
+        return None, pos + 1
+    if tag == DOUBLE:
+        return FLOAT.unpack_from(data, pos + 1)[0], pos + 9
+    raise IndexError("unknown tag {}".format(tag))
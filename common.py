@@ -1,144 +1,1079 @@
+import atexit
+import codec
+import codecs
+import common2
+import errno
 import json
+import os
+import select
 import socket
 import struct
+import threading
 import time
 import hashlib
 
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
 MAX_MESSAGE_SIZE = 8192
 
-# Encode and send a message on an open socket
-def send(sock, message):
-    message = json.dumps(message).encode()
+#error returned by receive when the peer has closed the connection
+CLOSED = "can't receive"
+
+# Frame header
+# A bare frame is a 4-byte length followed by the JSON body.
+# An extended frame sets the top bit of the length and is followed by a
+# 4-byte request ID and a 1-byte flags field. Responses to an extended
+# frame echo its request ID, which lets many requests share a connection.
+# Peers that only send bare frames get bare frames back.
+FRAME_EXT = 0x80000000
+FRAME_EXT_HEADER = struct.Struct("!IB")
+
+#frame flags
+FLAG_RESPONSE = 0x01
+FLAG_STREAM = 0x02 #message is followed by chunk frames
+FLAG_CHUNK = 0x04 #frame is a list of stream items
+FLAG_END = 0x08 #last chunk of a stream
+FLAG_BINARY = 0x10 #body is encoded with codec instead of JSON
+FLAG_HELLO = 0x20 #codec negotiation
+
+# Codecs
+# Each new connection starts with a hello frame offering the codecs the
+# client supports, in order of preference, and the server answers with the
+# first one it also supports. Peers that don't understand the hello close
+# the connection, and the client reconnects and falls back to bare JSON
+# frames. Every frame says which codec its body uses, and responses use
+# the codec of their request.
+#
+# JSON comes first by default, in which case no hello is sent at all:
+# json is implemented in C while codec is pure Python, so binary frames
+# are smaller but cost more CPU (see ./benchmark.py codec).
+CODECS = ["json", "binary"]
+
+#peers that closed the connection on a hello, indexed by (host, port)
+legacyPeers = set()
+
+# Sets the preferred codec for connections opened by this process
+def prefer_codec(encoding):
+    CODECS.remove(encoding)
+    CODECS.insert(0, encoding)
+
+# Encodes a message body
+# Return value
+#   (body, flags to set on the frame)
+def encode(message, encoding):
+    if encoding == "binary":
+        return codec.encode(message), FLAG_BINARY
+    return json.dumps(message).encode(), 0
 
-    nlen = len(message)
-    if nlen >= MAX_MESSAGE_SIZE:
+# Decodes a message body according to the frame's flags
+# Parameters
+#   body - bytes, or a bytearray holding the body in its first size bytes
+def decode(body, flags, size=None):
+    if flags & FLAG_BINARY:
+        return codec.decode(body, size)
+    if size is None:
+        size = len(body)
+    #the text is decoded straight out of the buffer
+    return json.loads(codecs.utf_8_decode(memoryview(body)[:size])[0])
+
+# Streams
+# A message whose "stream" key holds an iterable is sent as a header frame
+# (the rest of the message) followed by chunk frames, each carrying a list
+# of items, and ends with a chunk frame flagged FLAG_END. Chunk frames can
+# be up to MAX_CHUNK_SIZE bytes, and a stream can carry any number of them.
+# On the receiving side, "stream" holds a generator that reads the items
+# off the socket as it is iterated.
+MAX_CHUNK_SIZE = 65536
+
+# Sends an already encoded frame
+# Parameters
+#   reqid, flags - if reqid is not None, an extended frame is sent
+def send_frame(sock, body, reqid=None, flags=0, limit=MAX_MESSAGE_SIZE):
+    nlen = len(body)
+    if nlen >= limit:
         return {"Error": "maxmimum message size exceeded"}
-    slen = struct.pack("!i", nlen)
+    if reqid is None:
+        slen = struct.pack("!i", nlen)
+    else:
+        slen = struct.pack("!I", FRAME_EXT | nlen) + FRAME_EXT_HEADER.pack(reqid, flags)
 
-    if sock.sendall(slen) is not None:
-        return {"Error": "incomplete message"}
-    if sock.sendall(message) is not None:
+    #header and body go out in a single write, so that a kept-alive
+    #connection doesn't stall on delayed acknowledgements
+    if sock.sendall(slen + body) is not None:
         return {"Error": "incompletely sent message"}
 
     return {}
 
+# Encode and send a message on an open socket
+# Messages with a "stream" key are sent as a stream
+# Parameters
+#   reqid, flags - if reqid is not None, an extended frame is sent
+#   encoding - codec negotiated for the connection,
+#              anything but JSON needs an extended frame
+def send(sock, message, reqid=None, flags=0, encoding="json"):
+    if encoding != "json" and reqid is None:
+        reqid = 0
+    if "stream" in message:
+        return send_stream(sock, message, reqid, flags, encoding)
+    body, codecFlags = encode(message, encoding)
+    return send_frame(sock, body, reqid, flags | codecFlags)
+
+# Joins encoded stream items into the body of a chunk frame
+def encode_chunk(items, encoding):
+    if encoding == "binary":
+        return b"L" + codec.COUNT.pack(len(items)) + b"".join(items)
+    return b"[" + b",".join(items) + b"]"
+
+# Sends a message followed by the items of message["stream"]
+# Items are encoded one at a time and sent in chunks, so the stream is
+# never held in memory as a whole
+def send_stream(sock, message, reqid=None, flags=0, encoding="json"):
+    if reqid is None:
+        reqid = 0
+    header = dict((k, v) for k, v in message.items() if k != "stream")
+    body, codecFlags = encode(header, encoding)
+    flags |= codecFlags
+    result = send_frame(sock, body, reqid, flags | FLAG_STREAM)
+    if "Error" in result:
+        return result
+
+    chunk = []
+    size = 5
+    for item in message["stream"]:
+        data = encode(item, encoding)[0]
+        if size + len(data) + 1 >= MAX_CHUNK_SIZE and chunk:
+            result = send_frame(sock, encode_chunk(chunk, encoding), reqid,
+                                flags | FLAG_CHUNK, MAX_CHUNK_SIZE)
+            if "Error" in result:
+                return result
+            chunk = []
+            size = 5
+        if size + len(data) + 1 >= MAX_CHUNK_SIZE:
+            #the header has already gone out, so the stream can't be ended
+            #cleanly and the connection has to be dropped
+            raise ValueError("stream item of {} bytes is too large".format(len(data)))
+        chunk.append(data)
+        size += len(data) + 1
+
+    return send_frame(sock, encode_chunk(chunk, encoding), reqid,
+                      flags | FLAG_CHUNK | FLAG_END, MAX_CHUNK_SIZE)
+
+# Receive buffers
+# Frames are read with recv_into into a buffer that belongs to the
+# receiving thread and is reused for every frame, including the header.
+# A frame is decoded before the next one is read, so the buffer is free
+# again by the time receive_frame returns, and a connection can move
+# between threads without taking its buffer along.
+FRAME_LENGTH = struct.Struct("!I")
+buffers = threading.local()
+
+# Returns the calling thread's receive buffer, as (bytearray, memoryview)
+def receive_buffer():
+    if not hasattr(buffers, "data"):
+        buffers.data = bytearray(MAX_CHUNK_SIZE)
+        buffers.view = memoryview(buffers.data)
+    return buffers.data, buffers.view
+
+# Reads exactly n bytes into the start of view
+# recv_into can return less than was asked for, so reads are repeated
+# until the bytes are in or the peer closes the connection
+# Return value
+#   False if the connection was closed first
+def receive_into(sock, view, n):
+    if n == 0:
+        #recv_into reads as much as the buffer holds when asked for 0 bytes
+        return True
+    got = sock.recv_into(view, n)
+    while 0 < got < n:
+        count = sock.recv_into(view[got:], n - got)
+        if count == 0:
+            return False
+        got += count
+    return got == n
+
 # Expect a message on an open socket
+# Return value
+#   (message, request ID or None for a bare frame, flags)
+def receive_frame(sock):
+    data, view = receive_buffer()
+    if not receive_into(sock, view, FRAME_LENGTH.size):
+        return {"Error": CLOSED}, None, 0
+
+    slen = FRAME_LENGTH.unpack_from(data)[0]
+    reqid = None
+    flags = 0
+    if slen & FRAME_EXT:
+        slen &= ~FRAME_EXT
+        if not receive_into(sock, view, FRAME_EXT_HEADER.size):
+            return {"Error": CLOSED}, None, 0
+        reqid, flags = FRAME_EXT_HEADER.unpack_from(data)
+
+    limit = MAX_CHUNK_SIZE if flags & FLAG_CHUNK else MAX_MESSAGE_SIZE
+    if slen >= limit:
+        return {"Error": "maximum response size exceeded"}, reqid, flags
+    if not receive_into(sock, view, slen):
+        return {"Error": CLOSED}, reqid, flags
+
+    return decode(data, flags, slen), reqid, flags
+
+# Expect a message on an open socket
+# If the message is followed by a stream, message["stream"] is a generator
+# over its items, which must be consumed before the socket is used again
 def receive(sock):
-    nlen = sock.recv(4, socket.MSG_WAITALL)
-    if not nlen:
-        return {"Error": "can't receive"}
+    msg, reqid, flags = receive_frame(sock)
+    if flags & FLAG_STREAM and "Error" not in msg:
+        msg["stream"] = receive_stream(sock)
+    return msg
+
+# Yields the items of a stream as its chunks arrive
+# Raises socket.error if the stream is cut short
+def receive_stream(sock):
+    while True:
+        chunk, reqid, flags = receive_frame(sock)
+        if not flags & FLAG_CHUNK:
+            error = chunk.get("Error", "unexpected frame") if isinstance(chunk, dict) else "unexpected frame"
+            raise socket.error("stream interrupted: {}".format(error))
+        for item in chunk:
+            yield item
+        if flags & FLAG_END:
+            return
+
+# Connection pool
+# Idle connections are kept per (host, port) and reused by send_receive.
+#   POOL_MAX_IDLE - idle connections kept for a single (host, port)
+#   POOL_MAX_TOTAL - idle connections kept across all peers
+#   POOL_IDLE_TIMEOUT - seconds before an idle pooled connection is evicted
+#   CONN_IDLE_TIMEOUT - seconds listen keeps an idle accepted connection open
+POOL_MAX_IDLE = 8
+POOL_MAX_TOTAL = 64
+POOL_IDLE_TIMEOUT = 30
+CONN_IDLE_TIMEOUT = 60
+
+#default number of worker threads for the "threads" listen backend
+WORKERS = 16
+
+#indexed by (host, port), each entry is a list of
+#(socket, time last used, codec negotiated for the connection)
+pool = {}
+poolLock = threading.Lock()
+
+# Opens a new connection with keep-alive enabled
+# timeout applies to connecting, and stays set on the socket
+def connect(host, port, timeout=None):
+    sock = socket.create_connection((host, port), timeout)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return sock
 
-    slen = (struct.unpack("!i", nlen)[0])
-    if slen >= MAX_MESSAGE_SIZE:
-        return {"Error": "maximum response size exceeded"}
-    response = sock.recv(slen, socket.MSG_WAITALL)
+# Agrees on a codec with the peer on a new connection
+# Return value
+#   name of the codec, or None if the peer closed the connection
+def negotiate(sock):
+    if CODECS[0] == "json":
+        return "json"
+    send(sock, {"codecs": CODECS}, 0, FLAG_HELLO)
+    response, reqid, flags = receive_frame(sock)
+    if not flags & FLAG_HELLO:
+        return None
+    if response.get("codec") in CODECS:
+        return response["codec"]
+    return "json"
+
+# Opens a new connection and negotiates its codec
+# Falls back to JSON on a fresh connection if the peer doesn't negotiate
+# Return value
+#   (socket, codec)
+def open_connection(host, port, timeout=None):
+    sock = connect(host, port, timeout)
+    if (host, port) in legacyPeers:
+        return sock, "json"
+    try:
+        encoding = negotiate(sock)
+    except (ValueError, socket.error):
+        encoding = None
+    if encoding is None:
+        legacyPeers.add((host, port))
+        sock.close()
+        sock = connect(host, port, timeout)
+        encoding = "json"
+    return sock, encoding
+
+# An idle connection should have nothing to read
+# If it is readable, the peer has closed it (or sent something unexpected)
+def healthy(sock):
+    try:
+        readable, _, _ = select.select([sock], [], [], 0)
+    except (select.error, socket.error, ValueError):
+        return False
+    return not readable
+
+# Closes pooled connections that have been idle for too long
+# Must be called with poolLock held
+def evict_idle():
+    now = time.time()
+    for peer in list(pool):
+        fresh = []
+        for sock, lastUsed, encoding in pool[peer]:
+            if now - lastUsed > POOL_IDLE_TIMEOUT:
+                sock.close()
+            else:
+                fresh.append((sock, lastUsed, encoding))
+        if fresh:
+            pool[peer] = fresh
+        else:
+            del pool[peer]
+
+# Takes a healthy idle connection from the pool, or opens a new one
+# Return value
+#   (socket, True if the connection was reused, codec of the connection)
+def checkout(host, port, timeout=None):
+    with poolLock:
+        evict_idle()
+        idle = pool.get((host, port), [])
+        while idle:
+            sock, lastUsed, encoding = idle.pop()
+            if healthy(sock):
+                return sock, True, encoding
+            sock.close()
+    sock, encoding = open_connection(host, port, timeout)
+    return sock, False, encoding
 
-    return json.loads(response.decode())
+# Returns a connection to the pool once a request has completed on it
+# The connection is closed if the pool is full
+def checkin(host, port, sock, encoding):
+    sock.settimeout(None)
+    with poolLock:
+        idle = pool.setdefault((host, port), [])
+        total = sum(len(i) for i in pool.values())
+        if len(idle) >= POOL_MAX_IDLE or total >= POOL_MAX_TOTAL:
+            sock.close()
+            return
+        idle.append((sock, time.time(), encoding))
+
+# Closes every pooled connection
+def close_pool():
+    with poolLock:
+        for peer in pool:
+            for sock, lastUsed, encoding in pool[peer]:
+                sock.close()
+        pool.clear()
 
 # Sends a message and expects a message
+# Connections are taken from the pool and returned to it afterwards
 # Parameters
 #   host, port - host and port to connect to
 #   message - arbitrary Python object to be sent as message
+#             if message["stream"] is an iterable, its items are streamed
+#   timeout - seconds to wait for each step of the request, or None to
+#             wait for as long as it takes
 # Return value
 #   Response received from server
+#   If the server streams its response, response["stream"] is a generator
+#   over the items, and the connection goes back to the pool once it is
+#   exhausted
 #   In case of error, returns a dict containing an "Error" key
-def send_receive(host, port, message):
-    sock = None
+def send_receive(host, port, message, timeout=None):
+    #a pooled connection may have been closed by the peer while idle,
+    #in which case the request is retried once on a new connection, but
+    #only if it couldn't be written, as the peer may have handled a request
+    #it received before the connection failed
+    #(a stream can't be replayed, so streamed requests aren't retried)
+    retry = "stream" not in message
+    for attempt in range(2):
+        sock = None
+        reused = False
+        sent = False
+        try:
+            sock, reused, encoding = checkout(host, port, timeout)
+            sock.settimeout(timeout)
+
+            send_result = send(sock, message, None, 0, encoding)
+            if "Error" in send_result:
+                return send_result
+            sent = True
+
+            receive_result, reqid, flags = receive_frame(sock)
+            if "Error" in receive_result:
+                return receive_result
+
+            if flags & FLAG_STREAM:
+                receive_result["stream"] = pooled_stream(host, port, sock, encoding)
+            else:
+                checkin(host, port, sock, encoding)
+            sock = None
+            return receive_result
+
+        except ValueError as e:
+            return {"Error": "Json encoding error {}".format(e)}
+        except socket.error as e:
+            #a request that timed out isn't tried again
+            if reused and retry and not sent and not isinstance(e, socket.timeout):
+                continue
+            return {"Error": "Can't connect to {}:{} because {}".format(host, port, e)}
+        finally:
+            if sock is not None:
+                sock.close()
+    return {"Error": "Can't connect to {}:{}".format(host, port)}
+
+# Yields a streamed response, then returns the connection to the pool
+# The connection is closed instead if the stream is abandoned or cut short
+def pooled_stream(host, port, sock, encoding):
+    done = False
     try:
-        sock = socket.create_connection((host, port), None)
-        if not sock:
-            return {"Error": "Can't connect to {}:{}".format(host, port)}
+        for item in receive_stream(sock):
+            yield item
+        done = True
+    finally:
+        if done:
+            checkin(host, port, sock, encoding)
+        else:
+            sock.close()
 
-        send_result = send(sock, message)
-        if "Error" in send_result:
-            return send_result
+# Discovery
+# Servers and viewleaders bind the first free port of their range, so
+# peers have to find out which one. The last port that answered is
+# remembered for each host and range, and other ports are only tried when
+# that one fails. Running processes publish their ports in
+# common2.registryDir, and for a host on this machine those are tried
+# first. Failing that, all ports of the range are probed at once.
+PROBE_TIMEOUT = 1
 
-        receive_result = receive(sock)
-        return receive_result
+#indexed by (host, portLow, portHigh), last port that answered
+endpoints = {}
 
-    except ValueError as e:
-        return {"Error": "Json encoding error {}".format(e)}
+# Publishes the port a process listens on, for as long as it runs
+# Parameters
+#   role - "server" or "viewleader"
+def publish(role, port):
+    try:
+        os.makedirs(common2.registryDir)
+    except OSError:
+        pass
+    try:
+        with open(os.path.join(common2.registryDir, "{}.{}".format(role, port)), "w") as f:
+            f.write(str(os.getpid()))
+    except (IOError, OSError):
+        #the registry is only a hint, probing finds the port anyway
+        return
+    atexit.register(unpublish, role, port)
+
+def unpublish(role, port):
+    try:
+        os.remove(os.path.join(common2.registryDir, "{}.{}".format(role, port)))
+    except OSError:
+        pass
+
+# Returns the ports published for role, lowest first
+# Entries left by processes that were killed are removed
+def registered(role):
+    try:
+        names = os.listdir(common2.registryDir)
+    except OSError:
+        return []
+    ports = []
+    for name in names:
+        prefix, _, port = name.partition(".")
+        if prefix != role or not port.isdigit():
+            continue
+        path = os.path.join(common2.registryDir, name)
+        try:
+            with open(path) as f:
+                pid = int(f.read())
+            os.kill(pid, 0)
+        except (IOError, ValueError):
+            continue
+        except OSError as e:
+            if e.errno == errno.ESRCH:
+                unpublish(role, int(port))
+                continue
+        ports.append(int(port))
+    return sorted(ports)
+
+# Adds port to accepted if host accepts connections on it
+def probe_port(host, port, accepted):
+    try:
+        sock = socket.create_connection((host, port), PROBE_TIMEOUT)
+    except socket.error:
+        return
+    sock.close()
+    accepted.append(port)
+
+# Tries to connect to all of ports at once
+# Return value
+#   ports that accepted a connection, lowest first
+def probe(host, ports):
+    accepted = []
+    threads = [threading.Thread(target = probe_port, args = (host, port, accepted))
+               for port in ports]
+    for i in threads:
+        i.daemon = True
+        i.start()
+    for i in threads:
+        i.join()
+    return sorted(accepted)
+
+# True if host is this machine, the only one whose ports are published in
+# the registry
+def is_local(host):
+    try:
+        addr = socket.gethostbyname(host)
+    except socket.error:
+        return False
+    if addr.startswith("127."):
+        return True
+    try:
+        return addr == socket.gethostbyname(socket.gethostname())
+    except socket.error:
+        return False
+
+# Yields the ports in [portLow, portHigh) that host may be listening on,
+# the ones published for role first if host is this machine, then the
+# others that accept connections
+# The range is only probed once the published ports have been used up
+def discover(host, portLow, portHigh, role=None):
+    published = []
+    if role is not None and is_local(host):
+        published = [i for i in registered(role) if portLow <= i < portHigh]
+    for port in published:
+        yield port
+    others = [i for i in range(portLow, portHigh) if i not in published]
+    for port in probe(host, others):
+        yield port
+
+# Same as send_receive, to whichever port in [portLow, portHigh) host
+# answers on
+# The remembered port is tried first. If it fails, the range is probed and
+# each port that accepts connections is tried in turn. A streamed message
+# is only ever sent once.
+def send_receive_any(host, portLow, portHigh, message, role=None, timeout=None):
+    key = (host, portLow, portHigh)
+    remembered = endpoints.get(key)
+    if remembered is not None:
+        response = send_receive(host, remembered, message, timeout)
+        if "Error" not in response or "stream" in message:
+            return response
+        endpoints.pop(key, None)
+
+    response = {"Error": "Can't connect to {} on ports {}-{}".format(host, portLow, portHigh - 1)}
+    for port in discover(host, portLow, portHigh, role):
+        if port == remembered:
+            continue
+        response = send_receive(host, port, message, timeout)
+        if "Error" not in response:
+            endpoints[key] = port
+            break
+        if "stream" in message:
+            break
+    return response
+
+#threads that run the calls handed to fanout, such as the requests of
+#send_receive_all, started on first use so that a fan-out doesn't pay for
+#starting a thread per request
+FANOUT_WORKERS = 16
+fanoutCalls = queue.Queue()
+fanoutThreads = []
+
+def fanout_worker():
+    while True:
+        call = fanoutCalls.get()
+        if call is None:
+            return
+        f, args = call
+        f(*args)
+
+# Stops the fan-out threads once the calls handed to them are done, so that
+# they aren't torn down with the interpreter in the middle of a request
+# Registered with atexit when the threads are started, so a process waits
+# for its requests still in flight before exiting, for at most their timeouts
+def stop_fanout():
+    for thread in fanoutThreads:
+        fanoutCalls.put(None)
+    for thread in fanoutThreads:
+        thread.join()
+
+# Calls f(*args) on a fan-out thread, without waiting for it
+def fanout(f, *args):
+    with poolLock:
+        if not fanoutThreads:
+            atexit.register(stop_fanout)
+        while len(fanoutThreads) < FANOUT_WORKERS:
+            thread = threading.Thread(target = fanout_worker)
+            thread.daemon = True
+            thread.start()
+            fanoutThreads.append(thread)
+    fanoutCalls.put((f, args))
+
+# Sends message to each of the buckets at once, each from a fan-out thread
+# A streamed message must hold its items in a list, as every bucket reads
+# them
+# Parameters
+#   buckets - list of {"addr": host, "port": port} dicts, as from connectBucket
+#   timeout - as in send_receive, for each bucket
+# Return value
+#   generator of (index into buckets, response) pairs, in the order the
+#   responses arrive, so that the caller can stop at the first one it
+#   doesn't like. Requests still in flight then finish on their own.
+def send_receive_all(buckets, message, timeout=None):
+    responses = []
+    arrived = threading.Condition()
+    def call(i, bucket):
+        response = send_receive(bucket["addr"], bucket["port"], message, timeout)
+        with arrived:
+            responses.append((i, response))
+            arrived.notify()
+    for i, bucket in enumerate(buckets):
+        fanout(call, i, bucket)
+    for n in range(len(buckets)):
+        with arrived:
+            while len(responses) <= n:
+                arrived.wait()
+            response = responses[n]
+        yield response
+
+# Channels
+# A channel is a connection that carries many in-flight requests at once.
+# Each request is sent in an extended frame with its own ID, and a reader
+# thread matches responses to requests in whatever order they arrive.
+#
+#   reqid = channel_send(channel, message)
+#   response = channel_wait(channel, reqid, timeout)
+
+#open channels indexed by (host, port)
+channels = {}
+
+# Opens a channel to host:port
+# Return value
+#   a dict describing the channel
+#   In case of error, returns a dict containing an "Error" key
+def open_channel(host, port):
+    try:
+        sock, encoding = open_connection(host, port)
     except socket.error as e:
         return {"Error": "Can't connect to {}:{} because {}".format(host, port, e)}
-    finally:
-        if sock is not None:
-            sock.close()         
-            
+    channel = {
+        "sock": sock,
+        "codec": encoding,
+        "peer": (host, port),
+        "sendLock": threading.Lock(),
+        "pending": {}, #indexed by request ID, [event, response]
+        "nextID": 0,
+        "closed": False,
+    }
+    thread = threading.Thread(target = channel_reader, args = (channel,))
+    thread.daemon = True
+    thread.start()
+    return channel
+
+# Returns the open channel to host:port, opening one if necessary
+def get_channel(host, port):
+    with poolLock:
+        channel = channels.get((host, port))
+        if channel is not None and not channel["closed"]:
+            return channel
+        channel = open_channel(host, port)
+        if "Error" not in channel:
+            channels[(host, port)] = channel
+        return channel
+
+# Reads responses on a channel and wakes up the requests waiting for them
+def channel_reader(channel):
+    sock = channel["sock"]
+    while True:
+        try:
+            response, reqid, flags = receive_frame(sock)
+        except (ValueError, socket.error) as e:
+            response, reqid = {"Error": "{}".format(e)}, None
+        if reqid is None:
+            break
+        #streams aren't carried on channels
+        if flags & (FLAG_STREAM | FLAG_CHUNK):
+            break
+        #channel_wait removes the request once it has seen the response
+        with channel["sendLock"]:
+            waiter = channel["pending"].get(reqid)
+        if waiter is not None:
+            waiter[1] = response
+            waiter[0].set()
+
+    #fails every request still waiting on the channel
+    with channel["sendLock"]:
+        close_channel(channel)
+        waiters = list(channel["pending"].values())
+    for waiter in waiters:
+        if not waiter[0].is_set():
+            waiter[1] = {"Error": "Channel to {}:{} closed".format(*channel["peer"])}
+            waiter[0].set()
+
+# Sends a request on a channel without waiting for the response
+# Return value
+#   request ID to pass to channel_wait, or None if the request couldn't be sent
+def channel_send(channel, message):
+    if "Error" in channel:
+        return None
+    with channel["sendLock"]:
+        if channel["closed"]:
+            return None
+        channel["nextID"] = (channel["nextID"] + 1) & 0xffffffff
+        reqid = channel["nextID"]
+        channel["pending"][reqid] = [threading.Event(), None]
+        try:
+            result = send(channel["sock"], message, reqid, 0, channel["codec"])
+        except (ValueError, socket.error) as e:
+            result = {"Error": "{}".format(e)}
+        if "Error" in result:
+            del channel["pending"][reqid]
+            return None
+    return reqid
+
+# Waits for the response to a request sent on a channel
+# Parameters
+#   timeout - seconds to wait, or None to wait until the channel closes
+# Return value
+#   Response received from server
+#   In case of error or timeout, returns a dict containing an "Error" key
+def channel_wait(channel, reqid, timeout=None):
+    if reqid is None:
+        return {"Error": "Request wasn't sent"}
+    with channel["sendLock"]:
+        waiter = channel["pending"].get(reqid)
+    if waiter is None:
+        return {"Error": "Unknown request {}".format(reqid)}
+    done = waiter[0].wait(timeout)
+    with channel["sendLock"]:
+        channel["pending"].pop(reqid, None)
+    if not done:
+        return {"Error": "Timed out waiting for {}:{}".format(*channel["peer"])}
+    return waiter[1]
+
+# Sends a request on a channel and waits for its response
+def channel_call(channel, message, timeout=None):
+    return channel_wait(channel, channel_send(channel, message), timeout)
+
+# Closes a channel, requests still in flight fail
+def close_channel(channel):
+    if channel["closed"]:
+        return
+    channel["closed"] = True
+    try:
+        channel["sock"].shutdown(socket.SHUT_RDWR)
+    except socket.error:
+        pass
+    channel["sock"].close()
+
+# Sends the response to a request on an accepted connection
+# A response that can't be sent, such as one over MAX_MESSAGE_SIZE, is
+# replaced by an error, so that the peer isn't left waiting for it
+# Return value
+#   False if the connection should be closed
+def respond(sock, response, reqid, encoding, sendLock):
+    flags = 0 if reqid is None else FLAG_RESPONSE
+    with sendLock:
+        try:
+            res = send(sock, response, reqid, flags, encoding)
+        except ValueError as e:
+            res = {"Error": "encoding error {}".format(e)}
+        if "Error" not in res:
+            return True
+        print ("listen: when sending, {}".format(res["Error"]))
+        #an error leaves the connection at the start of a frame, or in a
+        #stream, which the error frame ends
+        res = send(sock, {"Error": "Can't send response: {}".format(res["Error"])},
+                   reqid, flags, encoding)
+    return "Error" not in res
+
+# Deferred response
+# A handler that can't answer a request yet returns a Deferred instead of a
+# response, and answers the request later, from any thread, with reply.
+# The connection goes back to the listening loop in the meantime, so a
+# request left waiting ties up neither a worker thread nor the loop. The
+# peer has to be answered within CONN_IDLE_TIMEOUT, as an idle connection
+# may be closed after that. reply writes to the connection at once, so it
+# shouldn't be called with a lock other requests need held.
+class Deferred(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.target = None #(sock, reqid, encoding, sendLock) of the request
+        self.response = None
+
+    #called by serve_request once the handler has returned the Deferred,
+    #which may already have been answered by then
+    def attach(self, sock, reqid, encoding, sendLock):
+        with self.lock:
+            self.target = (sock, reqid, encoding, sendLock)
+            response = self.response
+        if response is not None:
+            self.send(response)
+
+    #answers the request, unless it has been answered already
+    #returns False if it had
+    def reply(self, response):
+        with self.lock:
+            if self.response is not None:
+                return False
+            self.response = response
+            if self.target is None:
+                return True
+        self.send(response)
+        return True
+
+    def send(self, response):
+        sock, reqid, encoding, sendLock = self.target
+        try:
+            if respond(sock, response, reqid, encoding, sendLock):
+                return
+        except socket.error as e:
+            #the peer may have closed the connection while it waited
+            print ("listen: when sending, {}".format(e))
+        #the listening loop owns the connection, and sees it close
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+
+# Receives one request on an accepted connection, handles it and
+# sends the response
+# Parameters
+#   sendLock - serializes responses written to the connection
+#   release - if not None, called as soon as an extended frame has been read,
+#             so that further requests on the connection can be read and
+#             handled while this one is in progress
+#             (streamed requests are read to the end first)
+# Return value
+#   (True if the connection should be kept open,
+#    the handler's response if it asked to abort, otherwise None)
+def serve_request(sock, addr, handler, sendLock, release=None):
+    try:
+        msg, reqid, flags = receive_frame(sock)
+        if "Error" in msg:
+            if msg["Error"] != CLOSED:
+                print ("listen: when receiving, {}".format(msg["Error"]))
+            return False, None
+
+        #codec negotiation on a new connection
+        if flags & FLAG_HELLO:
+            offered = [i for i in msg.get("codecs", []) if i in CODECS]
+            with sendLock:
+                send(sock, {"codec": (offered + ["json"])[0]}, reqid, FLAG_HELLO | FLAG_RESPONSE)
+            return True, None
+
+        #the response uses the codec of the request
+        encoding = "binary" if flags & FLAG_BINARY else "json"
+
+        streamed = flags & FLAG_STREAM
+        if streamed:
+            msg["stream"] = receive_stream(sock)
+
+        #requests with an ID can be answered out of order
+        elif reqid is not None and release is not None:
+            release()
+
+        try:
+            response = handler(msg, addr)
+            if not isinstance(response, Deferred) and "abort" in response:
+                print ("listen: abort")
+                return False, response
+
+        except Exception as e:
+            #the peer is told, rather than left to guess whether the
+            #request was handled
+            print ("listen: handler error: {}".format(e))
+            response = {"Error": "Handler error: {}".format(e)}
+
+        #skips whatever the handler left unread of the request stream
+        if streamed:
+            for item in msg["stream"]:
+                pass
+
+        if isinstance(response, Deferred):
+            response.attach(sock, reqid, encoding, sendLock)
+            return True, None
+        return respond(sock, response, reqid, encoding, sendLock), None
+
+    except ValueError as e:
+        print ("listen: json encoding error {}".format(e))
+    except socket.error as e:
+        print ("listen: socket error {}".format(e))
+    return False, None
+
+# Hands a served connection back to the listening loop
+def finish(done, wakeup, result):
+    done.put(result)
+    try:
+        wakeup.send(b"x")
+    except socket.error:
+        pass
+
+# Worker thread for the "threads" backend
+# Serves connections taken from tasks and hands them back through done,
+# writing to wakeup so that the listening loop notices
+def worker(tasks, done, wakeup, handler):
+    while True:
+        task = tasks.get()
+        if task is None:
+            return
+        sock, addr, sendLock = task
+
+        released = []
+        def release():
+            released.append(True)
+            finish(done, wakeup, (sock, addr, True, None))
+
+        keep, aborted = serve_request(sock, addr, handler, sendLock, release)
+        if not released or aborted is not None:
+            finish(done, wakeup, (sock, addr, keep, aborted))
+        elif not keep:
+            #the loop already owns the connection again,
+            #shutting it down makes the loop see it close
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
 # A simple RPC server
+# Accepted connections are kept open and served until the peer closes them,
+# so that clients can reuse pooled connections
 # Parameters
 #   port - port number to listen on for all interfaces
 #   handler - function to handle respones, documented below
-#   timeout - if not None, after how many seconds to invoke timeout handler
-#   vl - a dict containing relevant parameters for heartbeat call
+#   timeout - if not None, how often (in seconds) to invoke timeout handler
+#   backend - how requests are served
+#       "eventloop": a single-threaded select loop that runs the handler inline
+#       "threads": the select loop hands ready connections to a bounded pool
+#                  of worker threads, so a slow peer or a blocking handler
+#                  only ties up one worker. The handler must be thread-safe.
+#   workers - number of worker threads for the "threads" backend
 # Return value
 #   in case of error, returns a dict with "error" key
 
 #    init: the port has been bound, please perform server initializiation
 #    timeout: timeout occurred
 #    anything else: RPC command received
-# the return value of the handler function is sent as an RPC response
-def listen(port, handler, timeout=None):
+# the return value of the handler function is sent as an RPC response,
+# unless it is a Deferred, which the handler answers later
+def listen(port, handler, timeout=None, backend="eventloop", workers=WORKERS):
     bindsock = None
+    conns = {} #idle connections indexed by socket, (address, time of last request)
+    busy = set() #connections being served by a worker
+    sendLocks = {} #indexed by socket
+    threads = []
+    tasks = queue.Queue()
+    done = queue.Queue()
+    wakeup, wakeupWriter = socket.socketpair()
     try:
         bindsock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        #a port left in TIME_WAIT by a process that just exited can be
+        #bound again straight away
+        bindsock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         bindsock.bind(('', port))
         bindsock.listen(100)
-        if timeout:
-            bindsock.settimeout(timeout)
 
         if "abort" in handler({"cmd":"init", "port": port}, None):
             return {"error": "listen: abort in init"}
 
-        sock = None
-        addr = None
-        
+        if backend == "threads":
+            for i in range(workers):
+                thread = threading.Thread(target = worker,
+                                          args = (tasks, done, wakeupWriter, handler))
+                thread.daemon = True
+                thread.start()
+                threads.append(thread)
+
         print("Listening on port {}...".format(port))
 
+        lastTick = time.time()
         while True:
-            try:               
-                    
-                sock, (addr, accepted_port) = bindsock.accept()
-                # print("\nAccepting connection from {}".format(addr))
-                msg = receive(sock)
-                if "Error" in msg:
-                    print ("listen: when receiving, {}".format(msg["Error"]))
-                    continue
-
-                try:
-                    response = handler(msg, addr)
-                    if "abort" in response:
-                        print ("listen: abort")
-                        return response
-                        break
-                        
-                except Exception as e:
-                    print ("listen: handler error: {}".format(e))
-                    continue
-                        
-                res = send(sock, response)
-                if "Error" in res:
-                    print ("listen: when sending, {}".format(res["Error"]))
-                    continue
-                    
-            except socket.timeout:
+            #the timeout handler runs every timeout seconds, however busy
+            #the connections are
+            if timeout:
+                wait = max(0, lastTick + timeout - time.time())
+            else:
+                wait = CONN_IDLE_TIMEOUT
+            try:
+                readable, _, _ = select.select([bindsock, wakeup] + list(conns), [], [],
+                                               wait)
+            except (select.error, socket.error) as e:
+                print ("listen: socket error {}".format(e))
+                #drops connections that can no longer be polled
+                for sock in list(conns):
+                    if not healthy(sock):
+                        del conns[sock]
+                        sendLocks.pop(sock, None)
+                        sock.close()
+                continue
+
+            #closes accepted connections that have been idle for too long
+            now = time.time()
+            for sock in list(conns):
+                if now - conns[sock][1] > CONN_IDLE_TIMEOUT:
+                    del conns[sock]
+                    sendLocks.pop(sock, None)
+                    sock.close()
+
+            if timeout and now - lastTick >= timeout:
+                lastTick = now
                 if "abort" in handler({"cmd":"timeout"}, None):
                     return {"Error": "listen: abort in timeout"}
-    
-            except ValueError as e:
-                print ("listen: json encoding error {}".format(e))
-            except socket.error as e:
-                print ("listen: socket error {}".format(e))
-            finally:
-                if sock is not None:
+
+            finished = []
+            for sock in readable:
+                if sock is bindsock:
+                    try:
+                        conn, (addr, accepted_port) = bindsock.accept()
+                    except socket.error as e:
+                        print ("listen: socket error {}".format(e))
+                        continue
+                    # print("\nAccepting connection from {}".format(addr))
+                    conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                    conns[conn] = (addr, now)
+                    sendLocks[conn] = threading.Lock()
+
+                elif sock is wakeup:
+                    wakeup.recv(4096)
+
+                else:
+                    addr = conns.pop(sock)[0]
+                    if threads:
+                        busy.add(sock)
+                        tasks.put((sock, addr, sendLocks[sock]))
+                    else:
+                        keep, aborted = serve_request(sock, addr, handler,
+                                                      sendLocks[sock])
+                        finished.append((sock, addr, keep, aborted))
+
+            while not done.empty():
+                finished.append(done.get())
+
+            for sock, addr, keep, aborted in finished:
+                busy.discard(sock)
+                if aborted is not None:
                     sock.close()
+                    return aborted
+                if keep:
+                    conns[sock] = (addr, time.time())
+                else:
+                    sendLocks.pop(sock, None)
+                    sock.close()
+
     except socket.error as e:
         return {"Error": "can't bind {}".format(e)}
     finally:
+        for i in threads:
+            tasks.put(None)
+        for sock in list(conns) + list(busy):
+            sock.close()
+        wakeup.close()
+        wakeupWriter.close()
         if bindsock is not None:
             bindsock.close()
             
 #hash function
+#text is hashed as UTF-8, the way the client hashes its arguments
 def hash_key(d):
+    if isinstance(d, codec.text_type):
+        d = d.encode("utf-8")
     sha1 = hashlib.sha1(d)
     return int(sha1.hexdigest(), 16)
 
@@ -1,3 +1,6 @@
+import os
+import tempfile
+
 #Port specifications for server and viewleader
 #Inclusive lower bound and exclusive upper bound
 
@@ -5,4 +8,7 @@ serverLow = 38000
 serverHigh = 38011
 
 viewleaderLow = 39000
-viewleaderHigh = 39011
\ No newline at end of file
+viewleaderHigh = 39011
+
+#Directory where running servers and viewleaders publish their ports
+registryDir = os.path.join(tempfile.gettempdir(), "dht-ports")
@@ -0,0 +1,44 @@
+import threading
+import time
+
+#Hybrid logical clocks
+#A version is [wall clock in ms, counter, node], and versions compare as
+#lists. The clock follows the wall clock, but never goes back, and moves
+#past every version it is shown, so that a write made after seeing a
+#version always gets a newer one even if the clocks of the machines
+#disagree. The counter orders versions made within the same millisecond,
+#and the node, which is different on every clock, breaks the remaining
+#ties.
+#
+#Values without a version (None) are older than any version.
+
+# True if version a is newer than version b
+def newer(a, b):
+    if a is None:
+        return False
+    return b is None or list(a) > list(b)
+
+class Clock(object):
+    def __init__(self, node):
+        self.node = node
+        self.last = [0, 0, node]
+        self.lock = threading.Lock()
+
+    #a version newer than any made or seen so far
+    def now(self):
+        with self.lock:
+            ms = int(time.time() * 1000)
+            if ms > self.last[0]:
+                self.last = [ms, 0, self.node]
+            else:
+                self.last = [self.last[0], self.last[1] + 1, self.node]
+            return list(self.last)
+
+    #moves the clock past version
+    def update(self, version):
+        if version is None:
+            return
+        with self.lock:
+            if version[0] > self.last[0] or (version[0] == self.last[0] and
+                                             version[1] >= self.last[1]):
+                self.last = [version[0], version[1], self.node]
@@ -0,0 +1,304 @@
+import bisect
+import common
+import contextlib
+import merkle
+import threading
+
+#Key-value store with an index of the keys by ring position
+#Behaves like the dict it replaces in the server, and also keeps every key
+#sorted by common.hash_key. The keys in an arc of the ring can then be
+#found with a binary search instead of hashing the whole store.
+#
+#The index is a list of sorted blocks, so that an insert only shifts the
+#entries of one block. Blocks are split when they grow past 2 * BLOCK
+#entries and dropped when they become empty.
+#
+#A merkle.Tree over the same ring positions is kept up to date with the
+#values, so that replicas can compare their contents range by range.
+#
+#Values can carry a version (see hlc.py), kept next to them in versions.
+#Setting a value without one drops the version it had.
+#
+#Store is safe to share between threads. Each key is guarded by one of
+#STRIPES locks picked by the key's hash, so changes to different keys only
+#contend on the short critical section that updates the index. Callers that
+#need several steps on a key to be atomic (e.g. a change and its log
+#record) hold stripe(key) around them, locked(keys) holds the stripes of
+#several keys, and frozen() holds every stripe to stop all changes.
+#Iterating over the store, arc and items work on copies, so they never see
+#the store change under them.
+
+BLOCK = 512
+STRIPES = 64
+
+class Store(object):
+    def __init__(self):
+        self.values = {}
+        self.versions = {} #version of each key that has one
+        self.positions = [] #blocks of ring positions
+        self.keys = [] #blocks of keys, in the same order as positions
+        self.maxes = [] #last ring position of each block
+        self.tree = merkle.Tree()
+        #reentrant, so callers holding a stripe can still use the methods
+        self.stripes = [threading.RLock() for i in range(STRIPES)]
+        self.indexLock = threading.Lock() #guards positions, keys, maxes and tree
+
+    #lock guarding key
+    def stripe(self, key):
+        return self.stripes[hash(key) % STRIPES]
+
+    #holds the stripes of keys, taken in the same order as by frozen so
+    #that the two can't deadlock
+    @contextlib.contextmanager
+    def locked(self, keys):
+        locks = sorted(set(hash(key) % STRIPES for key in keys))
+        for i in locks:
+            self.stripes[i].acquire()
+        try:
+            yield
+        finally:
+            for i in reversed(locks):
+                self.stripes[i].release()
+
+    #holds every stripe, so that no key changes until it is left
+    @contextlib.contextmanager
+    def frozen(self):
+        for lock in self.stripes:
+            lock.acquire()
+        try:
+            yield
+        finally:
+            for lock in reversed(self.stripes):
+                lock.release()
+
+    def __len__(self):
+        return len(self.values)
+
+    def __contains__(self, key):
+        return key in self.values
+
+    def __iter__(self):
+        return iter(list(self.values))
+
+    def __getitem__(self, key):
+        return self.values[key]
+
+    def get(self, key, default=None):
+        return self.values.get(key, default)
+
+    #version of key, or None if it has none
+    def version(self, key):
+        return self.versions.get(key)
+
+    def __setitem__(self, key, val):
+        self.put(key, val)
+
+    #sets key to val at version, or without a version if version is None
+    def put(self, key, val, version=None):
+        h = common.hash_key(key)
+        d = merkle.digest(key, val, version)
+        with self.stripe(key):
+            new = key not in self.values
+            if not new:
+                d ^= merkle.digest(key, self.values[key], self.versions.get(key))
+            with self.indexLock:
+                if new:
+                    self.index(h, key)
+                self.tree.toggle(h, d)
+            self.values[key] = val
+            if version is None:
+                self.versions.pop(key, None)
+            else:
+                self.versions[key] = version
+
+    def __delitem__(self, key):
+        self.pop(key)
+
+    def pop(self, key, *default):
+        with self.stripe(key):
+            if key not in self.values:
+                if default:
+                    return default[0]
+                raise KeyError(key)
+            val = self.values.pop(key)
+            h = common.hash_key(key)
+            d = merkle.digest(key, val, self.versions.pop(key, None))
+            with self.indexLock:
+                self.unindex(h, key)
+                self.tree.toggle(h, d)
+            return val
+
+    def items(self):
+        return list(self.values.items())
+
+    #[key, value] record of key, with its version appended if it has one,
+    #as the log and rebalancing carry keys, or None if key isn't there
+    def record(self, key):
+        with self.stripe(key):
+            if key not in self.values:
+                return None
+            if key in self.versions:
+                return [key, self.values[key], self.versions[key]]
+            return [key, self.values[key]]
+
+    #records of every key
+    def records(self):
+        versions = dict(self.versions)
+        return [[k, v, versions[k]] if k in versions else [k, v]
+                for k, v in list(self.values.items())]
+
+    #sets each (key, value) pair of pairs
+    def update(self, pairs):
+        for k, v in pairs:
+            self[k] = v
+
+    #replaces the contents of the store with the dict values, and the
+    #versions of the keys that have one
+    #faster than setting the keys one at a time, as the index is sorted once
+    def load(self, values, versions=None):
+        if versions is None:
+            versions = {}
+        entries = sorted((common.hash_key(k), k) for k in values)
+        positions = []
+        keys = []
+        maxes = []
+        for i in range(0, len(entries), BLOCK):
+            block = entries[i:i + BLOCK]
+            positions.append([h for h, k in block])
+            keys.append([k for h, k in block])
+            maxes.append(block[-1][0])
+        tree = merkle.Tree()
+        tree.load((h, merkle.digest(k, values[k], versions.get(k))) for h, k in entries)
+        with self.frozen():
+            with self.indexLock:
+                self.values = values
+                self.versions = versions
+                self.positions = positions
+                self.keys = keys
+                self.maxes = maxes
+                self.tree = tree
+
+    #adds key at ring position h to the index, called with indexLock held
+    def index(self, h, key):
+        if not self.maxes:
+            self.positions.append([h])
+            self.keys.append([key])
+            self.maxes.append(h)
+            return
+        i = bisect.bisect_left(self.maxes, h)
+        if i == len(self.maxes):
+            i -= 1
+        block = self.positions[i]
+        j = bisect.bisect_right(block, h)
+        block.insert(j, h)
+        self.keys[i].insert(j, key)
+        self.maxes[i] = block[-1]
+        if len(block) > 2 * BLOCK:
+            self.positions[i:i + 1] = [block[:BLOCK], block[BLOCK:]]
+            keys = self.keys[i]
+            self.keys[i:i + 1] = [keys[:BLOCK], keys[BLOCK:]]
+            self.maxes[i:i + 1] = [block[BLOCK - 1], block[-1]]
+
+    #removes key at ring position h from the index, called with indexLock held
+    def unindex(self, h, key):
+        i = bisect.bisect_left(self.maxes, h)
+        while i < len(self.maxes):
+            block = self.positions[i]
+            j = bisect.bisect_left(block, h)
+            while j < len(block) and block[j] == h:
+                if self.keys[i][j] == key:
+                    del block[j]
+                    del self.keys[i][j]
+                    if block:
+                        self.maxes[i] = block[-1]
+                    else:
+                        del self.positions[i]
+                        del self.keys[i]
+                        del self.maxes[i]
+                    return
+                j += 1
+            i += 1
+
+    #keys with ring positions in (low, high], in ring order, stopping after
+    #limit keys if limit is given
+    #called with indexLock held
+    def span(self, low, high, limit=None):
+        result = []
+        i = bisect.bisect_right(self.maxes, low)
+        if i == len(self.maxes):
+            return result
+        j = bisect.bisect_right(self.positions[i], low)
+        while i < len(self.maxes):
+            block = self.positions[i]
+            if block[-1] <= high:
+                result.extend(self.keys[i][j:])
+            else:
+                end = bisect.bisect_right(block, high, j)
+                result.extend(self.keys[i][j:end])
+                break
+            if limit is not None and len(result) >= limit:
+                break
+            i += 1
+            j = 0
+        if limit is not None:
+            del result[limit:]
+        return result
+
+    #up to limit keys with ring positions in (low, high], in ring order
+    #a range is walked in batches by calling scan again with low set to the
+    #position of the last key returned
+    def scan(self, low, high, limit):
+        with self.indexLock:
+            return self.span(low, high, limit)
+
+    #keys that hash into the arc of the ring that ends at server, i.e.
+    #predServer < hash(key) <= server, going around the end of the ring if
+    #predServer >= server
+    #Returns a list, so the store can change while the keys are used
+    def arc(self, predServer, server):
+        with self.indexLock:
+            if predServer < server:
+                return self.span(predServer, server)
+            if not self.maxes:
+                return []
+            #ring positions are never negative
+            return self.span(predServer, self.maxes[-1]) + self.span(-1, server)
+
+    #[key, digest] pairs for the keys with ring positions in (low, high]
+    def digests(self, low, high):
+        with self.indexLock:
+            keys = self.span(low, high)
+        result = []
+        for k in keys:
+            try:
+                result.append([k, merkle.digest(k, self.values[k], self.versions.get(k))])
+            except KeyError:
+                #removed since
+                pass
+        return result
+
+    #XOR of the digests of the pairs with ring positions in (low, high]
+    #whole leaves come from the tree, and the leaves the range only partly
+    #covers from their keys
+    def digest(self, low, high):
+        high = min(high, merkle.LEAVES * merkle.LEAF_WIDTH - 1)
+        if low >= high:
+            return 0
+        first = merkle.leaf(low + 1)
+        last = merkle.leaf(high)
+        result = 0
+        if (low + 1) % merkle.LEAF_WIDTH:
+            end = min(high, (first + 1) * merkle.LEAF_WIDTH - 1)
+            for k, d in self.digests(low, end):
+                result ^= d
+            first += 1
+            low = end
+        if first > last:
+            return result
+        if (high + 1) % merkle.LEAF_WIDTH:
+            for k, d in self.digests(last * merkle.LEAF_WIDTH - 1, high):
+                result ^= d
+            last -= 1
+        if first <= last:
+            result ^= self.tree.leaves(first, last)
+        return result
@@ -0,0 +1,547 @@
+import collections
+
+#Lock table of the viewleader
+#A lock is held either exclusively by a single requester, or shared by any
+#number of them. Requesters that can't hold it yet wait in a FIFO queue,
+#and are granted the lock strictly in order: a requester asking to share a
+#lock that is shared already still waits behind an earlier exclusive
+#request, so that readers can't starve writers. Adding a requester at the
+#tail, finding the head, checking whether a requester is queued and
+#removing it from anywhere in the queue all take O(1) (amortized), however
+#many requesters are waiting. The locks each requester holds and waits for
+#are kept in sets, for the same reason.
+#
+#A shared holder asking for the lock exclusively (upgrade) goes to the head
+#of the queue, keeping its shared hold, and holds it exclusively once the
+#other holders release it. An exclusive holder asking to share it
+#(downgrade) does at once, and the shared requesters at the head of the
+#queue then hold it too.
+#
+#A requester may also ask for a set of locks at once, all of which it is
+#granted together or none of which it holds. It is queued for all of them
+#in one step, so requesters waiting for sets are in the same order, that
+#they asked in, in every queue they share, and can never wait for each
+#other in a cycle. It keeps its place at the head of a queue until it can
+#hold every lock of its set, the requesters behind it waiting meanwhile.
+#
+#Whenever a lock is released or its queue changes, the requesters at the
+#head of the queue that can hold it along with its holders hold it at once,
+#and are moved from waiting to holding.
+#
+#The table is also the wait-for graph of the requesters, kept up to date by
+#the changes above: a requester waits for the holders of the locks in its
+#waiting set, and the requesters queued ahead of it for them, that it
+#can't share them with, as they are all granted the lock first. An edge is
+#only added when a requester starts waiting for a lock, or a lock changes
+#hands or is upgraded and its waiters wait for the new holders, so a
+#deadlock can only appear then, and through that requester or lock. cycle
+#looks for one by searching from the requesters that requester waits for,
+#or from the holders of that lock, so it only visits the requesters they
+#wait for, directly or not. Most of the time it doesn't search at all: a
+#new waiter no one waits for, or holders that wait for nothing, can't be
+#part of a cycle.
+#
+#The requesters a waiter waits for are the holders it can't share the lock
+#with and some of the requesters queued ahead of it, so a queue of n
+#waiters makes up to n * n edges. A search goes through each queue once
+#rather than once per waiter it visits (see Scan), and takes time in
+#proportion to the waiters it visits and the length of their queues.
+
+SHARED = "shared"
+EXCLUSIVE = "exclusive"
+MODES = [SHARED, EXCLUSIVE]
+
+# FIFO queue of distinct requesters, each asking for a lock in some mode
+# Requesters are kept in a deque in the order they were queued, and members
+# maps each queued requester to the number it was queued with and its mode.
+# Numbers increase from the head to the tail, so comparing them tells which
+# of two requesters is ahead. A requester leaving from the middle of the
+# queue is only taken out of members, and its entry in the deque is skipped
+# once it reaches the head. The deque is compacted when most of its entries
+# are stale.
+class Queue(object):
+    #there is one queue for every lock
+    __slots__ = ["entries", "members", "count", "front"]
+
+    def __init__(self):
+        self.entries = collections.deque() #(number, requester) pairs
+        self.members = {} #requester -> (number, mode)
+        self.count = 0 #number of the last requester queued at the tail
+        self.front = 0 #number of the last requester queued at the head
+
+    def __len__(self):
+        return len(self.members)
+
+    def __contains__(self, requester):
+        return requester in self.members
+
+    #queued requesters, from the head
+    def __iter__(self):
+        members = self.members
+        for n, requester in list(self.entries):
+            if members.get(requester, (None,))[0] == n:
+                yield requester
+
+    def append(self, requester, mode):
+        self.count += 1
+        self.members[requester] = (self.count, mode)
+        self.entries.append((self.count, requester))
+
+    #queues requester ahead of everyone else
+    def appendleft(self, requester, mode):
+        self.front -= 1
+        self.members[requester] = (self.front, mode)
+        self.entries.appendleft((self.front, requester))
+
+    #mode requester is queued with
+    def mode(self, requester):
+        return self.members[requester][1]
+
+    #True if queued requester a is ahead of queued requester b
+    def ahead(self, a, b):
+        return self.members[a][0] < self.members[b][0]
+
+    #last requester in the queue, or None
+    def tail(self):
+        entries = self.entries
+        members = self.members
+        while entries:
+            n, requester = entries[-1]
+            if members.get(requester, (None,))[0] == n:
+                return requester
+            entries.pop()
+        return None
+
+    #first requester in the queue, or None
+    def head(self):
+        entries = self.entries
+        members = self.members
+        while entries:
+            n, requester = entries[0]
+            if members.get(requester, (None,))[0] == n:
+                return requester
+            entries.popleft()
+        return None
+
+    def remove(self, requester):
+        del self.members[requester]
+        if len(self.entries) > 2 * len(self.members) + 16:
+            members = self.members
+            self.entries = collections.deque(
+                (n, r) for n, r in self.entries if members.get(r, (None,))[0] == n)
+
+class Lock(object):
+    __slots__ = ["holders", "exclusive", "queue"]
+
+    def __init__(self):
+        self.holders = {} #mode each holder holds the lock in
+        self.exclusive = None #the holder if the lock is held exclusively
+        self.queue = Queue() #requesters waiting for the lock
+
+# How far a search of the wait-for graph has gone through the queue of a
+# lock
+class Scan(object):
+    __slots__ = ["entries", "all", "barriers", "holders"]
+
+    def __init__(self, queue):
+        self.entries = list(queue.entries)
+        self.all = 0 #every requester in entries before this has been found
+        #the requesters in entries before this that shared waiters wait for
+        #have been found
+        self.barriers = 0
+        self.holders = False #all the holders have been found
+
+class LockTable(object):
+    def __init__(self):
+        self.locks = {} #Lock, indexed by lock name
+        self.held = {} #locks held by each requester
+        self.waiting = {} #locks each requester is queued for
+        self.groups = {} #locks each requester is queued for as a set, sorted
+        self.aborted = {} #locks whose wait was aborted, indexed by requester
+
+    #True if lockname has ever been requested
+    def __contains__(self, lockname):
+        return lockname in self.locks
+
+    #mode each holder of lockname holds it in
+    def holders(self, lockname):
+        lock = self.locks.get(lockname)
+        if lock is None:
+            return {}
+        return lock.holders
+
+    #mode requester holds lockname in, or None
+    def mode(self, lockname, requester):
+        return self.holders(lockname).get(requester)
+
+    #mode requester is queued for lockname with, or None
+    def wants(self, lockname, requester):
+        lock = self.locks.get(lockname)
+        if lock is None or requester not in lock.queue:
+            return None
+        return lock.queue.mode(requester)
+
+    #True if requester holds lockname or is waiting for it
+    def queued(self, lockname, requester):
+        lock = self.locks.get(lockname)
+        return lock is not None and (requester in lock.holders or
+                                     requester in lock.queue)
+
+    #locks held by requester
+    def holds(self, requester):
+        return self.held.get(requester, set())
+
+    #locks requester is waiting for
+    def waits(self, requester):
+        return self.waiting.get(requester, set())
+
+    #tuple of the locks requester is queued for as a set, or None
+    def group(self, requester):
+        return self.groups.get(requester)
+
+    #queues requester for lockname in mode, unless it is queued already, in
+    #which case it keeps the mode it was queued with
+    #a shared holder asking for an exclusive lock upgrades it
+    #returns True if requester holds the lock in mode, or exclusively
+    def acquire(self, lockname, requester, mode=EXCLUSIVE):
+        lock = self.locks.get(lockname)
+        if lock is None:
+            lock = self.locks[lockname] = Lock()
+        held = lock.holders.get(requester)
+        if held == EXCLUSIVE or held == mode:
+            return True
+        #goes to queue.members rather than through the methods of Queue, as
+        #this is called on every lock_get
+        queue = lock.queue
+        if held is None and not queue.members and lock.exclusive is None and (
+                mode == SHARED or not lock.holders):
+            #no one to wait for
+            lock.holders[requester] = mode
+            if mode == EXCLUSIVE:
+                lock.exclusive = requester
+            self.index(self.held, requester, lockname)
+            return True
+        if requester not in queue.members:
+            if held is None:
+                queue.append(requester, mode)
+            else:
+                queue.appendleft(requester, mode)
+            self.index(self.waiting, requester, lockname)
+            self.promote(lockname, lock)
+        held = lock.holders.get(requester)
+        return held == EXCLUSIVE or held == mode
+
+    #queues requester for all of locknames at once in mode, to be granted
+    #them all together, unless it is queued for a set already
+    #the locks requester holds in mode, or exclusively, are left out of the
+    #set, and it must not hold or wait for the others
+    #returns True if requester holds all of locknames
+    def acquire_many(self, locknames, requester, mode=EXCLUSIVE):
+        wanted = []
+        for lockname in sorted(set(locknames)):
+            lock = self.locks.get(lockname)
+            if lock is None:
+                lock = self.locks[lockname] = Lock()
+            held = lock.holders.get(requester)
+            if held != EXCLUSIVE and held != mode:
+                wanted.append(lockname)
+        if not wanted:
+            return True
+        if requester in self.groups:
+            return False
+        self.groups[requester] = tuple(wanted)
+        for lockname in wanted:
+            self.locks[lockname].queue.append(requester, mode)
+            self.index(self.waiting, requester, lockname)
+        self.promote(wanted[0], self.locks[wanted[0]])
+        return requester not in self.groups
+
+    #True if requester, which is queued for lock, can hold it along with
+    #its holders
+    def grantable(self, lock, requester):
+        if lock.exclusive is not None:
+            return False
+        if lock.queue.members[requester][1] == SHARED:
+            return True
+        return not lock.holders or (len(lock.holders) == 1 and requester in lock.holders)
+
+    #moves requester, which is queued for lockname, to its holders
+    def grant(self, lockname, lock, requester):
+        mode = lock.queue.members[requester][1]
+        lock.queue.remove(requester)
+        self.forget(self.waiting, requester, lockname)
+        if requester not in lock.holders:
+            self.index(self.held, requester, lockname)
+        lock.holders[requester] = mode
+        if mode == EXCLUSIVE:
+            lock.exclusive = requester
+
+    #hands lockname to the requesters at the head of its queue that can
+    #hold it along with its holders, and a requester queued for a set of
+    #locks all of them, if it is at the head of all their queues and can
+    #hold every one
+    #returns the (lockname, requester) pairs of the locks handed over
+    def promote(self, lockname, lock):
+        granted = []
+        queue = lock.queue
+        while True:
+            requester = queue.head()
+            if requester is None or not self.grantable(lock, requester):
+                return granted
+            group = self.groups.get(requester)
+            if group is None or lockname not in group:
+                self.grant(lockname, lock, requester)
+                granted.append((lockname, requester))
+                continue
+            for other in group:
+                otherLock = self.locks[other]
+                if otherLock.queue.head() != requester or not self.grantable(otherLock, requester):
+                    return granted
+            del self.groups[requester]
+            for other in group:
+                self.grant(other, self.locks[other], requester)
+                granted.append((other, requester))
+            #the requesters queued behind it for the other locks may hold
+            #them too
+            for other in group:
+                if other != lockname:
+                    granted.extend(self.promote(other, self.locks[other]))
+
+    #takes requester out of the queue of lockname, or of all the locks of
+    #its set if lockname is one of them
+    #returns the locks it was taken out of the queues of
+    def dequeue(self, lockname, requester):
+        group = self.groups.get(requester)
+        if group is not None and lockname in group:
+            del self.groups[requester]
+            locknames = group
+        elif requester in self.locks[lockname].queue:
+            locknames = (lockname,)
+        else:
+            return ()
+        for other in locknames:
+            self.locks[other].queue.remove(requester)
+            self.forget(self.waiting, requester, other)
+        return locknames
+
+    #takes requester out of the queue of lockname (see dequeue), and
+    #releases the lock if requester holds it
+    #returns the (lockname, requester) pairs of the locks handed over, or
+    #whose upgrade went through, as a result
+    def release(self, lockname, requester):
+        lock = self.locks[lockname]
+        locknames = set(self.dequeue(lockname, requester))
+        if requester in lock.holders:
+            del lock.holders[requester]
+            if lock.exclusive == requester:
+                lock.exclusive = None
+            self.forget(self.held, requester, lockname)
+            locknames.add(lockname)
+        granted = []
+        for other in sorted(locknames):
+            granted.extend(self.promote(other, self.locks[other]))
+        return granted
+
+    #makes requester, which holds lockname exclusively, share it
+    #returns the (lockname, requester) pairs of the locks handed over as a
+    #result
+    def downgrade(self, lockname, requester):
+        lock = self.locks[lockname]
+        lock.holders[requester] = SHARED
+        lock.exclusive = None
+        return self.promote(lockname, lock)
+
+    #releases every lock requester holds or waits for
+    #returns the (lockname, requester) pairs of the locks handed over as a
+    #result
+    def release_all(self, requester):
+        granted = []
+        for lockname in sorted(self.waits(requester)) + sorted(self.holds(requester)):
+            granted.extend(self.release(lockname, requester))
+        self.aborted.pop(requester, None)
+        return granted
+
+    #requesters that requester, which is waiting for lockname, waits for:
+    #the holders and the requesters queued ahead of it that it can't share
+    #the lock with
+    def blockers(self, lockname, requester):
+        result = []
+        seen = set([requester])
+        for u in self.unseen(lockname, requester, {}):
+            if u not in seen:
+                seen.add(u)
+                result.append(u)
+        return result
+
+    #True if waiter, which is waiting for lockname, waits for blocker
+    def blocks(self, lockname, waiter, blocker):
+        lock = self.locks[lockname]
+        queue = lock.queue
+        if blocker == waiter:
+            return False
+        if queue.mode(waiter) == EXCLUSIVE:
+            return blocker in lock.holders or (blocker in queue and queue.ahead(blocker, waiter))
+        if blocker == lock.exclusive:
+            return True
+        #a requester queued for a set of locks keeps its place even when it
+        #could share this one
+        return (blocker in queue and queue.ahead(blocker, waiter) and
+                (queue.mode(blocker) == EXCLUSIVE or lockname in self.groups.get(blocker, ())))
+
+    #requesters that requester, which is waiting for lockname, waits for,
+    #leaving out those found by the earlier calls with the same scans
+    #scans holds a Scan of each lock whose queue has been looked at, so
+    #that a search goes through every queue once however many of its
+    #waiters it visits. The blockers of a waiter are the holders it can't
+    #share the lock with and a prefix of the queue, so only the part of that
+    #prefix not scanned yet needs looking at. The result may include
+    #requester itself, if it holds the lock.
+    def unseen(self, lockname, requester, scans):
+        lock = self.locks[lockname]
+        members = lock.queue.members
+        scan = scans.get(lockname)
+        if scan is None:
+            scan = scans[lockname] = Scan(lock.queue)
+        result = []
+        exclusive = members[requester][1] == EXCLUSIVE
+        if exclusive:
+            if not scan.holders:
+                scan.holders = True
+                result.extend(lock.holders)
+            i = scan.all
+        else:
+            if lock.exclusive is not None:
+                result.append(lock.exclusive)
+            i = max(scan.all, scan.barriers)
+        entries = scan.entries
+        end = members[requester][0]
+        groups = self.groups
+        while i < len(entries):
+            n, queued = entries[i]
+            if n >= end:
+                break
+            i += 1
+            mode = members.get(queued, (None, None))
+            if mode[0] != n:
+                continue
+            if exclusive or mode[1] == EXCLUSIVE or lockname in groups.get(queued, ()):
+                result.append(queued)
+        if exclusive:
+            scan.all = i
+        else:
+            scan.barriers = i
+        return result
+
+    #True if any requester may be waiting for requester: it holds a lock
+    #others are queued for, or is queued ahead of others
+    def awaited(self, requester):
+        for held in self.holds(requester):
+            queue = self.locks[held].queue
+            if len(queue) > (requester in queue):
+                return True
+        for waited in self.waits(requester):
+            if self.locks[waited].queue.tail() != requester:
+                return True
+        return False
+
+    # Finds a cycle of the wait-for graph after lockname gained a waiter or
+    # changed hands
+    # Parameters
+    #   waiter - the waiter lockname gained, which any new cycle goes
+    #            through, or None if lockname changed hands
+    # Return value
+    #   list of (waiter, lockname, blocker) edges of the cycle, each blocker
+    #   being the waiter of the next edge, and the first waiting for
+    #   lockname if lockname changed hands, or for any lock waiter waits for
+    #   otherwise, or None
+    def cycle(self, lockname, waiter=None):
+        lock = self.locks.get(lockname)
+        if lock is None or not lock.queue:
+            return None
+        if waiter is not None:
+            if not self.awaited(waiter):
+                return None
+            #an upgrade also makes the requesters queued behind waiter
+            #wait for it, so the cycle may leave it through any lock
+            #all of its blockers are searched from at once, so that the
+            #requesters they share are only visited once
+            closes = lambda u: u == waiter
+            starts = {}
+            for waited in self.waits(waiter):
+                for start in self.blockers(waited, waiter):
+                    starts.setdefault(start, waited)
+            path = self.search(list(starts), closes)
+            if path is None:
+                return None
+            start = path[0][0]
+            return [(waiter, starts[start], start)] + path
+
+        for start in list(lock.holders):
+            if start not in self.waiting:
+                continue
+            closes = lambda u: u in lock.queue and self.blocks(lockname, u, start)
+            path = self.search([start], closes)
+            if path is not None:
+                return [(path[-1][2], lockname, start)] + path
+        return None
+
+    #depth-first search of the wait-for graph from starts for a requester
+    #closes is True of
+    #returns the (waiter, lockname, blocker) edges of the path to it from
+    #one of starts, or None
+    def search(self, starts, closes):
+        preds = dict((start, None) for start in starts)
+        stack = list(starts)
+        scans = {}
+        while stack:
+            v = stack.pop()
+            for waited in self.waits(v):
+                for u in self.unseen(waited, v, scans):
+                    if u in preds:
+                        continue
+                    preds[u] = (v, waited)
+                    if closes(u):
+                        path = []
+                        while preds[u] is not None:
+                            v, waited = preds[u]
+                            path.append((v, waited, u))
+                            u = v
+                        return list(reversed(path))
+                    stack.append(u)
+        return None
+
+    #takes requester, which is waiting for lockname, out of its queue (see
+    #dequeue), and remembers it so that aborted can tell it
+    #an upgrade that is aborted leaves requester sharing the lock
+    #returns the (lockname, requester) pairs of the locks handed over as a
+    #result
+    def abort(self, lockname, requester):
+        granted = []
+        for other in self.dequeue(lockname, requester):
+            self.aborted.setdefault(requester, set()).add(other)
+            granted.extend(self.promote(other, self.locks[other]))
+        return granted
+
+    #True if the wait of requester for lockname was aborted since it last
+    #asked, which it only is told once
+    def take_aborted(self, lockname, requester):
+        locknames = self.aborted.get(requester)
+        if locknames is None or lockname not in locknames:
+            return False
+        self.forget(self.aborted, requester, lockname)
+        return True
+
+    #adds lockname to the set of requester in index
+    def index(self, index, requester, lockname):
+        if requester in index:
+            index[requester].add(lockname)
+        else:
+            index[requester] = set([lockname])
+
+    #removes lockname from the set of requester in index, dropping the set
+    #once it is empty
+    def forget(self, index, requester, lockname):
+        locknames = index[requester]
+        locknames.discard(lockname)
+        if not locknames:
+            del index[requester]
@@ -0,0 +1,136 @@
+import codec
+import hashlib
+import json
+import struct
+
+#Merkle tree over the ring positions of the keys in a store
+#The ring is split into LEAVES leaves of equal width. Each leaf holds the
+#XOR of the digests of the (key, value) pairs whose ring positions fall in
+#it, and each internal node the XOR of its two children, so a change to a
+#key updates a single path of the tree and the digest of any run of whole
+#leaves takes a few nodes.
+#
+#Two replicas find where they differ by comparing the digests of ranges of
+#the ring, and splitting the ranges that differ into FANOUT parts until
+#they are down to a single leaf. Only the keys of those leaves are then
+#compared, so the work done is proportional to how far the replicas have
+#diverged rather than to the size of the store.
+
+RING_BITS = 160
+DEPTH = 14
+LEAVES = 2 ** DEPTH
+LEAF_WIDTH = 2 ** (RING_BITS - DEPTH)
+FANOUT = 16
+
+DIGEST = struct.Struct("!q")
+
+# Digest of a (key, value) pair, the first 64 bits of its SHA-1
+# The version of a value, if it has one, is part of what replicas have to
+# agree on
+def digest(key, val, version=None):
+    if isinstance(val, (dict, list)):
+        #dicts have to be in the same order on every replica, which the
+        #faster encoder used otherwise doesn't give
+        data = json.dumps(val, sort_keys=True)
+    else:
+        data = json.dumps(val)
+    if isinstance(key, codec.text_type):
+        key = key.encode("utf-8")
+    sha1 = hashlib.sha1(key)
+    sha1.update(b"\0")
+    sha1.update(data.encode("utf-8"))
+    if version is not None:
+        #versions hold no dicts, so they can take the faster encoder
+        sha1.update(b"\0")
+        sha1.update(json.dumps(version).encode("utf-8"))
+    return DIGEST.unpack_from(sha1.digest())[0]
+
+# Leaf holding ring position h
+def leaf(h):
+    return h >> (RING_BITS - DEPTH)
+
+class Tree(object):
+    def __init__(self):
+        #node 1 is the root, and the children of node i are 2i and 2i + 1
+        #leaf i is node LEAVES + i
+        self.nodes = [0] * (2 * LEAVES)
+
+    #adds d to the path from the leaf holding ring position h to the root
+    #adding the digest of a pair a second time takes it out again
+    def toggle(self, h, d):
+        i = LEAVES + leaf(h)
+        while i:
+            self.nodes[i] ^= d
+            i >>= 1
+
+    #rebuilds the tree from (ring position, digest) pairs
+    def load(self, pairs):
+        nodes = [0] * (2 * LEAVES)
+        for h, d in pairs:
+            nodes[LEAVES + leaf(h)] ^= d
+        for i in range(LEAVES - 1, 0, -1):
+            nodes[i] = nodes[2 * i] ^ nodes[2 * i + 1]
+        self.nodes = nodes
+
+    #XOR of the leaves first to last
+    def leaves(self, first, last):
+        result = 0
+        low = LEAVES + first
+        high = LEAVES + last + 1
+        while low < high:
+            if low & 1:
+                result ^= self.nodes[low]
+                low += 1
+            if high & 1:
+                high -= 1
+                result ^= self.nodes[high]
+            low >>= 1
+            high >>= 1
+        return result
+
+# Splits the range of ring positions (low, high] along leaf boundaries into
+# at most FANOUT ranges
+# Return value
+#   list of (low, high) ranges, or [] if the range is within a single leaf
+def split(low, high):
+    first = leaf(low + 1)
+    last = leaf(high)
+    if first == last:
+        return []
+    step = (last - first + FANOUT) // FANOUT
+    ranges = []
+    start = low
+    for i in range(first + step, last + 1, step):
+        end = i * LEAF_WIDTH - 1
+        ranges.append((start, end))
+        start = end
+    ranges.append((start, high))
+    return ranges
+
+# Finds the ranges of the ring where a replica differs from the local store
+# Parameters
+#   store - kvstore.Store
+#   ranges - list of (low, high) ranges of ring positions to compare
+#   remote - function taking a list of ranges and returning the replica's
+#            digests of them, in the same order, or None if the replica
+#            can't be reached
+# Return value
+#   list of (low, high) ranges, each within a single leaf, that differ, or
+#   None if the replica couldn't be reached
+def diff(store, ranges, remote):
+    differ = []
+    while ranges:
+        theirs = remote(ranges)
+        if theirs is None:
+            return None
+        todo = []
+        for (low, high), d in zip(ranges, theirs):
+            if store.digest(low, high) == d:
+                continue
+            parts = split(low, high)
+            if parts:
+                todo.extend(parts)
+            else:
+                differ.append((low, high))
+        ranges = todo
+    return differ
@@ -0,0 +1,98 @@
+import bisect
+import common
+
+#Consistent-hash ring of the servers in a view
+#Each server is placed on the ring at vnodes positions: its ID, which is
+#where it was placed before there were virtual nodes, and the hashes of
+#"ID#1", "ID#2" and so on. A key is held by the first REPLICAS distinct
+#servers at or after its ring position, going around the end of the ring.
+#With REPLICAS servers or fewer, every server holds every key.
+#
+#Positions are kept sorted, so a lookup is a binary search. A Ring is built
+#once for a view and reused for every lookup in that view.
+#
+#Ranges of ring positions are (low, high] pairs, as in kvstore.Store.span.
+
+REPLICAS = 3
+RING_SIZE = 2 ** 160
+
+# Ring position of virtual node i of the server with ID serverID
+def position(serverID, i):
+    if i == 0:
+        return serverID
+    return common.hash_key("{}#{}".format(serverID, i))
+
+# (low, high] ranges covering the arc of the ring after pred up to and
+# including pos, which goes around the end of the ring if pred >= pos
+def arc(pred, pos):
+    if pred < pos:
+        return [(pred, pos)]
+    return [(pred, RING_SIZE - 1), (-1, pos)]
+
+class Ring(object):
+    # Parameters
+    #   view - list of servers, as {"IP": address, "ID": ID} dicts
+    #   vnodes - number of positions of each server on the ring
+    def __init__(self, view, vnodes=1, replicas=REPLICAS):
+        self.vnodes = vnodes
+        self.replicas = replicas
+        self.servers = dict((s["ID"], s) for s in view)
+        points = sorted((position(s["ID"], i), s["ID"])
+                        for s in view for i in range(vnodes))
+        self.positions = [p for p, i in points]
+        self.ids = [i for p, i in points]
+
+    def __len__(self):
+        return len(self.servers)
+
+    #IDs of the servers holding the keys at ring position h, primary first
+    def owners(self, h):
+        result = []
+        n = len(self.ids)
+        j = bisect.bisect_left(self.positions, h)
+        #goes around the ring at most once, when there are fewer servers
+        #than replicas
+        end = j + n
+        while j < end and len(result) < self.replicas:
+            i = self.ids[j % n]
+            if i not in result:
+                result.append(i)
+            j += 1
+        return result
+
+    #servers holding key, primary first
+    def lookup(self, key):
+        if not self.ids:
+            return []
+        return [self.servers[i] for i in self.owners(common.hash_key(key))]
+
+    # Arcs of the ring the server serverID is primary for
+    # Return value
+    #   list of (low, high, owners), owners being the IDs of the servers
+    #   holding the keys in (low, high], primary first
+    def primary(self, serverID):
+        result = []
+        for j, i in enumerate(self.ids):
+            if i != serverID:
+                continue
+            pos = self.positions[j]
+            owners = self.owners(pos)
+            for low, high in arc(self.positions[j - 1], pos):
+                result.append((low, high, owners))
+        return result
+
+# Ranges of the ring whose keys are held by other servers in ring new than
+# in ring old
+# Return value
+#   list of (low, high, before, after), before and after being the IDs of
+#   the servers holding the keys in (low, high] in each ring
+def diff(old, new):
+    points = sorted(set(old.positions) | set(new.positions))
+    result = []
+    for j, pos in enumerate(points):
+        before = old.owners(pos) if old.ids else []
+        after = new.owners(pos) if new.ids else []
+        if set(before) != set(after):
+            for low, high in arc(points[j - 1], pos):
+                result.append((low, high, before, after))
+    return result
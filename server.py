@@ -23,10 +23,14 @@ Types of RPC requests:
     6) 2PC Abort: Aborts a pending 2PC for a distributed set RPC
     
     7) Rebalance keys: when another server joins / leaves the view
+
+    8) Anti-entropy: compares the keys it is primary for with the replicas
+       holding copies of them, and repairs the keys that differ.
         
 --- 
 Sends a heartbeat RPC with its ID and listening port to view leader at 10s 
-intervals.
+intervals, from a thread of its own so that requests never wait on it.
+Runs anti-entropy with its replicas every minute in the same way.
 
 
 @author Han Yang, Tay
@@ -36,30 +40,155 @@ import argparse
 import common
 import common2
 import json
+import os
+import random
 import uuid
 import hashlib
+import hlc
+import kvstore
+import merkle
+import ring
 import threading
 import time
+import wal
 
 ### Global variables ###
 
 
-store = {}
+store = kvstore.Store()
 pending_2PC = {}
+log = None #write-ahead log, if the server has a data directory
+
+#store and pending_2PC are shared by the listen worker threads
+#both are guarded key by key with store.stripe(key)
+#only one snapshot of the store is written at a time
+snapshotLock = threading.Lock()
+
+#seconds between heartbeats, varied by up to HEARTBEAT_JITTER either way so
+#that servers started together don't all hit the viewleader at once
+HEARTBEAT_INTERVAL = 10
+HEARTBEAT_JITTER = 0.1
+#seconds to wait for the viewleader before giving up on a heartbeat
+HEARTBEAT_TIMEOUT = 5
+
 config = {
     "status": True, #active / failed
     "viewleader": None, #viewleader address
-    "lastHeartbeat": time.time() - 10, #time of last heartbeat
+    "lastHeartbeat": None, #time of last heartbeat
     "Epoch": None, #knowledge of epoch from viewleader
     "ID": common.hash_key(str(uuid.uuid4())),
+    "incarnation": str(uuid.uuid4()), #tells the viewleader the server restarted
     "serverPort": None, #port it is listening on
-    "rebalance": False
+    "rbBatch": 1000, #keys sent per rebalancing batch
+    "rbRate": 0, #keys/sec sent when rebalancing, 0 for no limit
+    "rbBandwidth": 0, #bytes/sec sent when rebalancing, 0 for no limit
+    "commitWindow": 0, #seconds a 2PC commit waits for others to group with
+    "loopsStarted": False, #heartbeat and anti-entropy threads are running
 }
 
 
 
+### Store ###
+
+#sets key to val in the store, at version if it isn't None, and appends the
+#change to the log
+#returns the log position to pass to log_sync
+def store_set(key, val, version=None):
+    with store.stripe(key):
+        store.put(key, val, version)
+        if log is not None:
+            if version is None:
+                return log.append(["set", key, val])
+            return log.append(["set", key, val, version])
+    return None
+
+#True if the store holds a newer version of key than version, or the same
+#one. A value without a version replaces one without a version, as it
+#always has.
+#with strict, only a value strictly newer than the one in the store
+#replaces it, so two values without a version are left alone
+#called with the stripe of key held
+def store_superseded(key, version, strict=False):
+    if key not in store:
+        return False
+    current = store.version(key)
+    if strict:
+        return not hlc.newer(version, current)
+    return (hlc.newer(current, version) or
+            (version is not None and version == current))
+
+#sets key to val at version, unless store_superseded says otherwise
+#returns (True if the value was set, log position to pass to log_sync)
+def store_merge(key, val, version, strict=False):
+    with store.stripe(key):
+        if store_superseded(key, version, strict):
+            return False, None
+        return True, store_set(key, val, version)
+
+#removes key from the store and appends the change to the log
+#returns the log position to pass to log_sync
+def store_remove(key):
+    with store.stripe(key):
+        if key not in store:
+            return None
+        store.pop(key)
+        if log is not None:
+            return log.append(["del", key])
+    return None
+
+#waits until the logged change at position seq is on disk
+#called without holding a stripe, so that writers can share an fsync
+def log_sync(seq):
+    if log is not None:
+        log.sync(seq)
+
+#writes a snapshot of the store and drops the log it replaces
+def snapshot():
+    if not snapshotLock.acquire(False):
+        return
+    try:
+        with store.frozen():
+            segment = log.rotate()
+            items = store.records()
+        log.write_snapshot(items, segment)
+        print("Wrote snapshot of {} keys".format(len(items)))
+    finally:
+        snapshotLock.release()
+
+#restores the server ID, store and rebalancing checkpoints from the data
+#directory
+def recover(directory, policy):
+    global log
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    idPath = os.path.join(directory, "id")
+    if os.path.exists(idPath):
+        with open(idPath) as f:
+            config["ID"] = int(f.read())
+    else:
+        wal.write_file(idPath, str(config["ID"]))
+
+    start = time.time()
+    log = wal.Log(directory, policy)
+    values = {}
+    versions = {}
+    count = log.recover(values, versions)
+    store.load(values, versions)
+    print("Recovered {} keys from {} log records in {:.2f}s".format(
+        len(store), count, time.time() - start))
+    rebalance_load(os.path.join(directory, "rebalance"))
+
 ### RPC ###
 def init(msg, addr):
+    common.publish("server", msg["port"])
+    #listen may be started again on another port, which shares the threads
+    if config["loopsStarted"]:
+        return {}
+    config["loopsStarted"] = True
+    for loop in [heartbeat_loop, anti_entropy_loop]:
+        thread = threading.Thread(target = loop)
+        thread.daemon = True
+        thread.start()
     return {}
 
 # set command sets a key in the value store
@@ -67,7 +196,7 @@ def set_val(msg, addr):
     print ("Function: Set")
     key = msg["key"]
     val = msg["val"]
-    store[key] = val
+    log_sync(store_set(key, val))
     print ("Setting key {} to {} in local store".format(key, val))
     return {"Status": "Completed."}
 
@@ -75,19 +204,83 @@ def set_val(msg, addr):
 def get_val(msg, addr):
     print ("Function: Get")
     key = msg["key"]
-    if key in store:
-        val = store[key]
+    with store.stripe(key):
+        found = key in store
+        val = store.get(key)
+        version = store.version(key)
+    #the epoch lets clients with a cached view check that it is current
+    if found:
         print ("Key: {}, Value: {}".format(key, val))
-        return {"Status": "Completed", "Key": key, "Value": val}
+        response = {"Status": "Completed", "Key": key, "Value": val, "Epoch": config["Epoch"]}
+        if version is not None:
+            response["Version"] = version
+        return response
     else:
         print ("The key {} does not exist.".format(key))
-        return {"Status": "Key doesn't exist."}
+        return {"Status": "Key doesn't exist.", "Epoch": config["Epoch"]}
+
+# sets a key at the version the client gave it, unless the store already
+# holds a newer version of it
+# used by writes that only wait for a quorum of replicas, and by reads
+# repairing replicas that are behind
+# a batch of keys arrives as a stream of [key, value] records, all at the
+# same version
+def put(msg, addr):
+    if "stream" in msg:
+        seq = None
+        count = 0
+        for key, val in msg["stream"]:
+            applied, last = store_merge(key, val, msg["version"])
+            seq = last or seq
+            count += applied
+        log_sync(seq)
+        print("Put {} keys".format(count))
+        return {"Status": "Completed.", "Count": count,
+                "Epoch": config["Epoch"], "ID": config["ID"]}
+    key = msg["key"]
+    applied, seq = store_merge(key, msg["val"], msg["version"])
+    log_sync(seq)
+    with store.stripe(key):
+        version = store.version(key)
+    print("Put key {}: {}".format(key, "set" if applied else "newer version kept"))
+    return {"Status": "Completed." if applied else "Superseded.", "Version": version,
+            "Epoch": config["Epoch"], "ID": config["ID"]}
+
+# sets many keys in the value store
+# keys arrive as a stream of [key, value] pairs, and are logged with a
+# single wait for the disk
+def mset(msg, addr):
+    seq = None
+    count = 0
+    for key, val in msg["stream"]:
+        seq = store_set(key, val)
+        count += 1
+    log_sync(seq)
+    print("Set {} keys".format(count))
+    return {"Status": "Completed.", "Count": count}
+
+# fetches many keys in the value store
+# keys arrive as a stream, and the [key, value] or [key, value, version]
+# records of those in the store are streamed back
+def mget(msg, addr):
+    records = []
+    for key in msg["stream"]:
+        record = store.record(key)
+        if record is not None:
+            records.append(record)
+    print("Found {} keys".format(len(records)))
+    return {"Status": "Completed", "Epoch": config["Epoch"], "stream": records}
 
 # returns all keys in the value store
+# keys are streamed if the client asks for chunked results
 def query_all_keys(msg, addr):
     print ("Function: query_all_keys")
-    keyList = json.dumps(list(store))
-    print("Result: {}".format(keyList))
+    if msg.get("chunked"):
+        keys = list(store)
+        print("Result: {} keys".format(len(keys)))
+        return {"Status": "Completed", "stream": keys}
+    keyList = list(store)
+    print("Result: {}".format(json.dumps(keyList)))
     return {"Result": keyList}
 
 # prints a message
@@ -103,262 +296,531 @@ def heartbeat():
         "vladdr": config["viewleader"],
         "serverID": config["ID"],
         "port": config["serverPort"],
+        "incarnation": config["incarnation"],
         "cmd": "heartbeat",
         }
     
     #if server has failed, don't connect to viewleader
     if config["status"] == False:
         return None
-    
-    for port in range(common2.viewleaderLow, common2.viewleaderHigh):
-        response = common.send_receive(config["viewleader"], port, args)
-        if "Error" in response:
-            continue
-        if "Failure" in response:
-            config["status"] = False
-            print(json.dumps(response))
-        #updates epoch and last heartbeat received
-        config["Epoch"] = response["Epoch"]
-        config["lastHeartbeat"] = time.time()
-        break
-    else:
+
+    heartbeat_send(args)
+    return None
+
+#sends heartbeats until the server is told it has failed
+#runs in its own thread, started once the server is listening
+def heartbeat_loop():
+    while config["status"]:
+        heartbeat()
+        jitter = random.uniform(-HEARTBEAT_JITTER, HEARTBEAT_JITTER)
+        time.sleep(HEARTBEAT_INTERVAL * (1 + jitter))
+
+#sends the heartbeat to the viewleader
+def heartbeat_send(args):
+    response = common.send_receive_any(config["viewleader"], common2.viewleaderLow,
+                                       common2.viewleaderHigh, args, "viewleader",
+                                       HEARTBEAT_TIMEOUT)
+    if "Error" in response:
         print ("\nError: Can't connect to Viewleader.")
+        return None
+    if "Failure" in response:
+        config["status"] = False
+        print(json.dumps(response))
+    #updates epoch and last heartbeat received
+    config["Epoch"] = response["Epoch"]
+    config["lastHeartbeat"] = time.time()
     return None
 
-#nil RPC
+#runs every 10 seconds
+#starts a snapshot once enough changes have been logged
 def tick(msg, addr):
+    if log is not None and log.snapshot_due():
+        thread = threading.Thread(target = snapshot)
+        thread.start()
     return {}
 
 ### 2PC ###
 
+#A 2PC covers a single key, or a batch of keys streamed in each message:
+#keys in the vote and abort, [key, value] records in the commit. A batch
+#has a "txn" ID, which marks its keys as pending, and a batch vote is YES
+#only if none of its keys is pending.
+
+#marks keys as pending for txn, unless one of them is pending already
+#returns True if they were all marked
+def twoPC_mark(keys, txn):
+    marked = []
+    for key in keys:
+        with store.stripe(key):
+            if key in pending_2PC:
+                break
+            pending_2PC[key] = txn
+            marked.append(key)
+    else:
+        return True
+    twoPC_unmark(marked, txn)
+    return False
+
+#unmarks the keys marked as pending for txn
+def twoPC_unmark(keys, txn):
+    for key in keys:
+        with store.stripe(key):
+            if pending_2PC.get(key) == txn:
+                del pending_2PC[key]
+
 #votes YES - True, or NO - False to a client coordinator
 #sends ID and knowledge of epoch
 def twoPC_vote(msg, addr):
+    if "stream" in msg:
+        vote = twoPC_mark(list(msg["stream"]), msg["txn"])
+        print("2PC Vote on a batch: {}".format("YES" if vote else "NO"))
+        return {"Vote": vote, "Epoch": config["Epoch"], "ID": config["ID"]}
     key = msg["key"]
     
     #if server is currently rebalancing or
     #waiting for a pending 2PC for the same key, vote NO
-    if key in pending_2PC:
+    with store.stripe(key):
+        vote = key not in pending_2PC
+        if vote:
+            pending_2PC[key] = addr
+    if not vote:
         print("2PC Vote: NO")
         return {"Vote": False, "Epoch": config["Epoch"], "ID": config["ID"]}
     else:
-        pending_2PC[key] = addr
         print("2PC Vote: YES")
         return {"Vote": True, "Epoch": config["Epoch"], "ID": config["ID"]}
 
 #does nothing, terminates current 2PC    
 def twoPC_abort(msg, addr):
+    if "stream" in msg:
+        twoPC_unmark(msg["stream"], msg["txn"])
+        print("2PC aborted.")
+        return {"Status": "2PC aborted."}
     key = msg["key"]
-    pending_2PC.pop(key, None)
+    with store.stripe(key):
+        pending_2PC.pop(key, None)
     print("2PC aborted.")
     return {"Status": "2PC aborted."}
 
 #sets the keys, terminates current 2PC
+#a versioned value doesn't replace a newer one written by a quorum write
 def twoPC_commit(msg, addr):
+    if "stream" in msg:
+        txn = msg["txn"]
+        commits = [(key, val, msg.get("version"), txn) for key, val in msg["stream"]]
+        group_commit(commits)
+        print("2PC commited a batch of {} keys.".format(len(commits)))
+        return {"Status": "2PC commited.", "Count": len(commits)}
     key = msg["key"]
-    msg["cmd"] = "set"
-    handler(msg, addr)
-    pending_2PC.pop(key, None)
+    group_commit([(key, msg["val"], msg.get("version"), None)])
+    print ("Setting key {} to {} in local store".format(key, msg["val"]))
     print("2PC commited.")
     return {"Status": "2PC commited."}
 
 ###
 
-### Rebalance ###
-
-#simply copies whole store to the new server
-#when no. of servers = 2 or 3
-def rebalance_new_simple(msg, addr):
-    print("Rebalancing...")
-    source = msg["source"]
-    target = msg["target"]
-    
-    args = {"cmd": "rb_addKeys", "keyAdd": store}
-    common.send_receive(target["addr"], target["port"], args)
-    print("Rebalancing tasks completed.")
-    return {"Status": "Sent keys to be added."}
-
-#sends keys to be added to new server / removed from other servers
-#in the event that a server joins the view
-def rebalance_new(msg, addr):
-    servers = msg["servers"]
-    print("Rebalancing...")
-    #stores keys to be rebalanced in a dict
-    #i.e. send to target server
-    keyAdd = {} #keys to be copied to n
-    keyRemove = {} #keys to be removed from n+1
-    keyRemove2 = {} #keys to be removed from n+2
-
-    #if new server should contain secondary/tertiary copies of the keys
-    config["rebalance"] = True
-    for i in store:
-        #for tertiary copies
-        keyAdd, keyRemove = rebalance_aux(i, servers["n-2"]["ID"], servers["n-3"]["ID"], 
-                      servers["maxN"]["ID"], keyAdd, keyRemove)
-                    
-        #for secondary copies 
-        keyAdd, keyRemove2 = rebalance_aux(i, servers["n-1"]["ID"], servers["n-2"]["ID"], 
-                      servers["maxN"]["ID"], keyAdd, keyRemove2)
-    config["rebalance"] = False
-           
-    #sends keys that are to be added to new server
-    args = {"cmd": "rb_addKeys", "keyAdd": keyAdd}
-    common.send_receive(servers["n"]["addr"], servers["n"]["port"], args)
-    
-    #sends keys that are to be removed from n + 1
-    args = {"cmd": "rb_removeKeys", "keyRemove": keyRemove}
-    common.send_receive(servers["n+1"]["addr"], servers["n+1"]["port"], args)
+### Group commit ###
+
+#Concurrent 2PC commits are applied in groups. A commit queues its keys,
+#and the first one to find no group being applied leads the next group:
+#it waits config["commitWindow"] seconds for others to queue, then applies
+#every queued commit in the order they arrived, appends their log records
+#in a single write and waits once for them to be on disk. Commits queued
+#meanwhile wait for it, and one of them leads the group after. With no
+#window, a group is whatever queued while the last one was applied.
+#
+#Keys are applied in queue order by one leader at a time, so commits to
+#the same key keep the order they arrived in.
+
+commitQueue = [] #[commits, state] pairs, state being None until applied
+commitLock = threading.Lock()
+commitDone = threading.Condition(commitLock)
+commitLeading = [False]
+
+#applies commits and waits for them to be logged
+#commits - list of (key, value, version, txn) tuples, txn being the batch
+#          that marked the key as pending, or None for a single-key 2PC
+def group_commit(commits):
+    queued = [commits, None]
+    with commitLock:
+        commitQueue.append(queued)
+        while queued[1] is None:
+            if commitLeading[0]:
+                commitDone.wait()
+                continue
+            commitLeading[0] = True
+            group = []
+            state = "failed"
+            commitLock.release()
+            try:
+                if config["commitWindow"]:
+                    time.sleep(config["commitWindow"])
+                with commitLock:
+                    group = commitQueue[:]
+                    del commitQueue[:]
+                log_sync(commit_apply([c for i in group for c in i[0]]))
+                state = "applied"
+            finally:
+                commitLock.acquire()
+                commitLeading[0] = False
+                for i in group:
+                    i[1] = state
+                commitDone.notify_all()
+    if queued[1] != "applied":
+        raise RuntimeError("group commit failed")
+
+#sets the keys of commits in order, holding their stripes so that the log
+#records are in the same order as the changes, and unmarks them as pending
+#returns the log position of the last record, to pass to log_sync
+def commit_apply(commits):
+    records = []
+    with store.locked([c[0] for c in commits]):
+        for key, val, version, txn in commits:
+            if txn is None:
+                pending_2PC.pop(key, None)
+            elif pending_2PC.get(key) == txn:
+                del pending_2PC[key]
+            if version is not None and store_superseded(key, version):
+                continue
+            store.put(key, val, version)
+            if version is None:
+                records.append(["set", key, val])
+            else:
+                records.append(["set", key, val, version])
+        if log is not None and records:
+            return log.append_many(records)
+    return None
 
-    #sends keys that are to be removed from n + 2
-    args = {"cmd": "rb_removeKeys", "keyRemove": keyRemove2}
-    common.send_receive(servers["n+2"]["addr"], servers["n+2"]["port"], args)
-    
-    print("Rebalancing tasks completed.")
-    return {"Status": "Sent keys to be added/removed."}
+###
 
-#sends keys to be added to new server / removed from other servers
-#in the event that a server joins the view
-def rebalance_new2(msg, addr):
-    servers = msg["servers"]
-    print("Rebalancing...")
-    #stores keys to be rebalanced in a dict
-    #i.e. send to target server
-    keyAdd = {} #keys to be copied to n
-    keyRemove = {} #keys to be removed from n+3
-
-    #if new server should contain primary copies of the keys'
-    config["rebalance"] = True
-    for i in store:
-        keyAdd, keyRemove = rebalance_aux(i, servers["n"]["ID"], servers["n-1"]["ID"], 
-                      servers["maxN"]["ID"], keyAdd, keyRemove)
-    config["rebalance"] = False
-
-    #sends keys that are to be added to new server
-    args = {"cmd": "rb_addKeys", "keyAdd": keyAdd}
-    common.send_receive(servers["n"]["addr"], servers["n"]["port"], args)
-
-    #sends keys that are to be removed from n
-    args = {"cmd": "rb_removeKeys", "keyRemove": keyRemove}
-    common.send_receive(servers["n+3"]["addr"], servers["n+3"]["port"], args)
-
-    print("Rebalancing tasks completed.")
-    return {"Status": "Sent keys to be added/removed."}
-
-#sends keys to be added to other servers
-#in the event that a server leaves the view
-def rebalance_drop(msg, addr):
-    servers = msg["servers"]
-    print("Rebalancing...")
-    
-    #stores keys to be rebalanced in a dict
-    #i.e. send to target server
-    keyAdd = {} #keys to be copied to n+1
-    keyAdd2 = {} #keys to be copied to n+2
-
-    #if dropped server contains secondary/tertiary copies of the keys
-    config["rebalance"] = True
-    for i in store:
-        #for tertiary copies
-        keyAdd = rebalance_aux(i, servers["n-2"]["ID"], servers["n-3"]["ID"], 
-                      servers["maxN"]["ID"], keyAdd)
-                    
-        #for secondary copies        
-        keyAdd2 = rebalance_aux(i, servers["n-1"]["ID"], servers["n-2"]["ID"], 
-                      servers["maxN"]["ID"], keyAdd)
-    config["rebalance"] = False
-    
-    #sends keys that are stored as tertiary copies in server n
-    #to server n+1
-    args = {"cmd": "rb_addKeys", "keyAdd": keyAdd}
-    common.send_receive(servers["n+1"]["addr"], servers["n+1"]["port"], args)
-    
-    #sends keys that are stored as secondary copies in server n
-    #to server n+2
-    args = {"cmd": "rb_addKeys", "keyAdd": keyAdd2}
-    common.send_receive(servers["n+2"]["addr"], servers["n+2"]["port"], args)
-    
-    print("Rebalancing tasks completed.")
-    return {"Status": "Sent keys to be added."}
+### Rebalance ###
 
-#sends keys to be added to other servers
-#in the event that a server leaves the view
-def rebalance_drop2(msg, addr):
-    servers = msg["servers"]
+#Rebalancing runs as tasks handed out by the viewleader. A task is a list of
+#transfers, each sending the keys of some ranges of the ring to a target
+#server to be added or removed. Keys go in batches of config["rbBatch"],
+#and after each batch the target acknowledges, the task records a
+#checkpoint, so that a task the viewleader hands out again resumes where it
+#stopped. With a data directory, the checkpoints are kept there too, and
+#survive a restart. Transfers are throttled to config["rbRate"] keys/sec
+#and config["rbBandwidth"] bytes/sec, which leaves the server's disk and
+#network to the requests it serves, but makes rebalancing take longer,
+#and clients' setr and getr abort for as long as it does.
+
+#times a batch is sent before the task gives up until handed out again,
+#and seconds to wait for the target to acknowledge it
+RB_RETRIES = 3
+RB_RETRY_DELAY = 1
+RB_SEND_TIMEOUT = 30
+
+#rebalancing tasks this server was handed, by task ID
+#each is {"status": running / done / failed,
+#         "checkpoint": [transfer, span, position of the last key sent]}
+rbTasks = {}
+rbLock = threading.Lock()
+rbPath = [None] #file rbTasks is saved in, if the server has a data directory
+
+#saves rbTasks to the data directory
+def rebalance_save():
+    if rbPath[0] is None:
+        return
+    with rbLock:
+        wal.write_file(rbPath[0], json.dumps(rbTasks))
+
+#restores the rebalancing tasks saved in path
+#tasks that were running when the server stopped resume from their
+#checkpoint when the viewleader hands them out again
+def rebalance_load(path):
+    rbPath[0] = path
+    if not os.path.exists(path):
+        return
+    with open(path) as f:
+        tasks = json.load(f)
+    for task, state in tasks.items():
+        if state["status"] != "done":
+            state["status"] = "failed"
+        rbTasks[task] = state
+
+#[key, value] or [key, value, version] records for a batch of keys,
+#skipping keys removed since
+def rebalance_values(keys):
+    records = []
+    for i in keys:
+        record = store.record(i)
+        if record is not None:
+            records.append(record)
+    return records
+
+#sleeps as long as needed to keep to the rate and bandwidth limits, given
+#the keys and bytes sent since start
+def rebalance_throttle(start, keys, size):
+    wait = 0
+    if config["rbRate"]:
+        wait = float(keys) / config["rbRate"]
+    if config["rbBandwidth"]:
+        wait = max(wait, float(size) / config["rbBandwidth"])
+    wait -= time.time() - start
+    if wait > 0:
+        time.sleep(wait)
+
+#sends a batch to the target, retrying a few times
+#returns False if the target couldn't be reached
+def rebalance_send(target, args):
+    for attempt in range(RB_RETRIES):
+        response = common.send_receive(target["addr"], target["port"], args,
+                                       RB_SEND_TIMEOUT)
+        if "Error" not in response:
+            return True
+        print(json.dumps(response))
+        time.sleep(RB_RETRY_DELAY)
+    return False
+
+#sends the keys in the (low, high] ranges of ring positions spans to target
+#as cmd ("rb_addKeys" or "rb_removeKeys"), starting from the checkpoint of
+#task, which is transfer n
+#returns False if the target couldn't be reached
+def rebalance_transfer(task, n, target, cmd, spans):
+    state = rbTasks[task]
+    start = time.time()
+    keys = 0
+    size = 0
+    for m, (low, high) in enumerate(spans):
+        transfer, span, position = state["checkpoint"]
+        if (n, m) < (transfer, span):
+            continue
+        if (n, m) == (transfer, span) and position is not None:
+            low = max(low, position)
+        while True:
+            batch = store.scan(low, high, config["rbBatch"])
+            if not batch:
+                break
+            if cmd == "rb_addKeys":
+                items = rebalance_values(batch)
+            else:
+                items = batch
+            #streamed, as a batch is larger than a single message
+            if not rebalance_send(target, {"cmd": cmd, "stream": items}):
+                return False
+            low = common.hash_key(batch[-1])
+            state["checkpoint"] = [n, m, low]
+            rebalance_save()
+            keys += len(batch)
+            if config["rbBandwidth"]:
+                size += len(json.dumps(items))
+            rebalance_throttle(start, keys, size)
+        state["checkpoint"] = [n, m + 1, None]
+        rebalance_save()
+    print("Sent {} keys to {}:{} ({})".format(keys, target["addr"], target["port"], cmd))
+    return True
+
+#runs the transfers of task, then tells the viewleader it is done
+def rebalance_run(task, transfers):
+    for n, (target, cmd, spans) in enumerate(transfers):
+        if not rebalance_transfer(task, n, target, cmd, spans):
+            print("Rebalancing task {} stopped, will resume when retried.".format(task))
+            rbTasks[task]["status"] = "failed"
+            rebalance_save()
+            return
+    rbTasks[task]["status"] = "done"
+    rebalance_save()
+    print("Rebalancing task {} completed.".format(task))
+    rb_end(task)
+
+#starts task in the background, or resumes it from its checkpoint if it
+#was handed out before and failed
+def rebalance_start(msg, transfers):
+    task = msg.get("task") or str(uuid.uuid4())
+    with rbLock:
+        state = rbTasks.setdefault(task, {"status": None, "checkpoint": [0, 0, None]})
+        if state["status"] == "running":
+            return {"Status": "Running"}
+        if state["status"] == "done":
+            return {"Status": "Completed"}
+        state["status"] = "running"
     print("Rebalancing...")
-    
-    #stores keys to be rebalanced in a dict
-    #i.e. send to target server
-    keyAdd = {} #keys to be copied to n+3
-
-    #if dropped server contains primary copies of the keys
-    config["rebalance"] = True
-    for i in store:
-        #for tertiary copies
-        keyAdd = rebalance_aux(i, servers["n"]["ID"], servers["n-1"]["ID"], 
-                          servers["maxN"]["ID"], keyAdd)
-    config["rebalance"] = False
-    
-    #sends keys that are stored as tertiary copies in server n
-    #to server n+1
-    args = {"cmd": "rb_addKeys", "keyAdd": keyAdd}
-    common.send_receive(servers["n+3"]["addr"], servers["n+3"]["port"], args)
-    
-    print("Rebalancing tasks completed.")
-    return {"Status": "Sent keys to be added."}
-
-#adds keys to local store
-def rb_addKeys(msg, addr):
-    #prevents changing of keys while server is iterating through the store
-    while config["rebalance"]:
-        pass
-    for k, v in msg["keyAdd"].items():
-        current = set_val({"key": k, "val": v}, None)
-    thread = threading.Thread(target = rb_end)
+    thread = threading.Thread(target = rebalance_run, args = (task, transfers))
+    thread.daemon = True
     thread.start()
+    return {"Status": "Started"}
+
+#sends the keys of the ranges of the ring that change servers with the view
+#the viewleader streams [target, cmd, low, high] items, and consecutive
+#items for the same target and cmd make up one transfer
+def rebalance(msg, addr):
+    transfers = []
+    for target, cmd, low, high in msg["stream"]:
+        if transfers and transfers[-1][:2] == (target, cmd):
+            transfers[-1][2].append((low, high))
+        else:
+            transfers.append((target, cmd, [(low, high)]))
+    return rebalance_start(msg, transfers)
+
+#adds keys to local store, keeping the newer version of keys it already has
+#keys arrive as a stream of [key, value] or [key, value, version] records,
+#or as a dict from older servers
+def rb_addKeys(msg, addr):
+    if "stream" in msg:
+        records = msg["stream"]
+    else:
+        records = msg["keyAdd"].items()
+    seq = None
+    count = 0
+    for record in records:
+        version = record[2] if len(record) > 2 else None
+        applied, last = store_merge(record[0], record[1], version)
+        seq = last or seq
+        if applied:
+            count += 1
+    log_sync(seq)
+    print("Added {} keys".format(count))
     return {"Status": "Rebalancing completed."}
 
 #removes keys from local store
+#keys arrive as a stream, or as a dict from older servers
 def rb_removeKeys(msg, addr):
-    #prevents changing of keys while server is iterating through the store
-    while config["rebalance"]:
-        pass
-    for k, v in msg["keyRemove"].items():
-        store.pop(k, None)
-    thread = threading.Thread(target = rb_end)
-    thread.start()
+    if "stream" in msg:
+        keys = msg["stream"]
+    else:
+        keys = msg["keyRemove"]
+    seq = None
+    for k in keys:
+        seq = store_remove(k) or seq
+    log_sync(seq)
     return {"Status": "Rebalancing completed."}
 
-#tells viewleader that one rebalancing task has been completed
-def rb_end():
-    args = {"cmd": "rb_end"}
-    for port in range(common2.viewleaderLow, common2.viewleaderHigh):
-        response = common.send_receive(config["viewleader"], port, args)
-        if "Error" in response:
-            print(json.dumps(response))
-            continue
-        break
+#tells viewleader that a rebalancing task has been completed
+def rb_end(task):
+    args = {"cmd": "rb_end", "task": task}
+    response = common.send_receive_any(config["viewleader"], common2.viewleaderLow,
+                                       common2.viewleaderHigh, args, "viewleader")
+    if "Error" in response:
+        print(json.dumps(response))
     return {"Status": "Completed rebalancing task."}
 
-#if i is meant to be hashed in server, add key / remove key
-def rebalance_aux(i, server, predServer, maxServer, keyAdd, keyRemove = None):
-    
-    #for edge case if needs to traverse around circular hashtable
-    #refer to rebalance algorithm readme
-    if predServer == maxServer:
-        if common.hash_key(i) > predServer or common.hash_key(i) < server:
-            keyAdd[i] = store[i]
-            if keyRemove != None:
-                keyRemove[i] = store[i]
-    else:
-        if common.hash_key(i) > predServer and common.hash_key(i) < server:
-            keyAdd[i] = store[i]
-            if keyRemove != None:
-                keyRemove[i] = store[i]
-    
-    if keyRemove != None:
-        return keyAdd, keyRemove
-
-    return keyAdd
+### Anti-entropy ###
+
+#Each server compares the arcs of the ring it is primary for with the
+#servers that hold copies of them, using the merkle trees of their stores, and
+#repairs the keys that differ. Keys missing on either side are copied over,
+#and where both sides have a key with different values the newer version
+#wins. Between two values without a version, the primary's wins.
+
+#seconds between anti-entropy rounds, varied like heartbeats
+ANTI_ENTROPY_INTERVAL = 60
+#seconds to wait for a replica to answer
+ANTI_ENTROPY_TIMEOUT = 30
+
+#only one anti-entropy round runs at a time
+antiEntropyLock = threading.Lock()
+
+#the replicas of the arcs this server is primary for in the given view,
+#as (replica, (low, high] ranges of ring positions) pairs
+def anti_entropy_replicas(view):
+    r = ring.Ring(view["Result"], view.get("Vnodes", 1))
+    spans = {}
+    if config["ID"] in r.servers:
+        for low, high, owners in r.primary(config["ID"]):
+            for i in owners[1:]:
+                spans.setdefault(i, []).append((low, high))
+    return [(common.connectBucket(r.servers[i]), spans[i]) for i in spans]
+
+#compares the keys in spans with replica and repairs those that differ
+#returns a summary of what was repaired
+def anti_entropy_replica(replica, spans):
+    host = replica["addr"]
+    port = replica["port"]
+
+    #sends a streamed request and returns the items of the streamed response
+    def call(cmd, items):
+        response = common.send_receive(host, port, {"cmd": cmd, "stream": items},
+                                       ANTI_ENTROPY_TIMEOUT)
+        if "stream" not in response:
+            print(json.dumps(response))
+            return None
+        return list(response["stream"])
+
+    differ = merkle.diff(store, spans, lambda ranges: call("ae_digests", ranges))
+    if differ is None:
+        return {"Error": "Can't compare with {}:{}".format(host, port)}
+    pushed = fetched = 0
+    if differ:
+        theirs = call("ae_keys", differ)
+        if theirs is None:
+            return {"Error": "Can't compare with {}:{}".format(host, port)}
+        theirs = dict(theirs)
+        mine = {}
+        for low, high in differ:
+            mine.update(store.digests(low, high))
+        #the replica's values replace only older ones here, then every key
+        #that still differs is sent back, for the replica to keep the newer
+        fetch = [k for k in theirs if theirs[k] != mine.get(k)]
+        push = [k for k in mine if theirs.get(k) != mine[k]]
+        if fetch:
+            records = call("ae_fetch", fetch) or []
+            seq = None
+            for record in records:
+                version = record[2] if len(record) > 2 else None
+                applied, last = store_merge(record[0], record[1], version, True)
+                seq = last or seq
+                fetched += applied
+            log_sync(seq)
+        if push:
+            response = common.send_receive(host, port, {"cmd": "rb_addKeys",
+                                           "stream": rebalance_values(push)},
+                                           ANTI_ENTROPY_TIMEOUT)
+            if "Error" not in response:
+                pushed = len(push)
+    summary = {"Replica": "{}:{}".format(host, port), "Ranges": len(differ),
+               "Pushed": pushed, "Fetched": fetched}
+    if differ:
+        print("Anti-entropy: {}".format(json.dumps(summary)))
+    return summary
+
+#runs anti-entropy with each replica, unless the view is being rebalanced,
+#as replicas are then expected to differ
+def anti_entropy():
+    if not antiEntropyLock.acquire(False):
+        return {"Status": "Anti-entropy is already running."}
+    try:
+        view = common.send_receive_any(config["viewleader"], common2.viewleaderLow,
+                                       common2.viewleaderHigh, {"cmd": "query_servers"},
+                                       "viewleader", HEARTBEAT_TIMEOUT)
+        if "Error" in view:
+            return view
+        if view["Rebalance status"]:
+            return {"Status": "Skipped while rebalancing."}
+        return {"Status": "Completed",
+                "Result": [anti_entropy_replica(r, spans)
+                           for r, spans in anti_entropy_replicas(view)]}
+    finally:
+        antiEntropyLock.release()
+
+#runs anti-entropy every ANTI_ENTROPY_INTERVAL seconds while the server is
+#active
+def anti_entropy_loop():
+    while config["status"]:
+        jitter = random.uniform(-HEARTBEAT_JITTER, HEARTBEAT_JITTER)
+        time.sleep(ANTI_ENTROPY_INTERVAL * (1 + jitter))
+        if config["status"]:
+            anti_entropy()
+
+#digests of the given (low, high] ranges of ring positions
+def ae_digests(msg, addr):
+    return {"stream": [store.digest(low, high) for low, high in msg["stream"]]}
+
+#[key, digest] pairs of the keys in the given ranges
+def ae_keys(msg, addr):
+    pairs = []
+    for low, high in msg["stream"]:
+        pairs.extend(store.digests(low, high))
+    return {"stream": pairs}
+
+#records of the given keys that are in the store
+def ae_fetch(msg, addr):
+    return {"stream": rebalance_values(list(msg["stream"]))}
+
+#runs anti-entropy now, rather than waiting for the next round
+def anti_entropy_now(msg, addr):
+    return anti_entropy()
 
 ### Main Program ###
 
@@ -368,6 +830,9 @@ def handler(msg, addr):
         "init": init,
         "set": set_val,
         "get": get_val,
+        "put": put,
+        "mset": mset,
+        "mget": mget,
         "print": print_text,
         
         "query_all_keys": query_all_keys,
@@ -379,16 +844,13 @@ def handler(msg, addr):
         
         "rb_addKeys": rb_addKeys,
         "rb_removeKeys": rb_removeKeys,
-        "rebalance_new": rebalance_new,
-        "rebalance_new2": rebalance_new2,
-        "rebalance_new_simple": rebalance_new_simple,
-        "rebalance_drop": rebalance_drop,
-        "rebalance_drop2": rebalance_drop2,        
-    }
+        "rebalance": rebalance,
 
-    #sends heartbeat if ten seconds have elapsed since last heartbeat
-    if time.time() - config["lastHeartbeat"] >= 10:
-        heartbeat()
+        "ae_digests": ae_digests,
+        "ae_keys": ae_keys,
+        "ae_fetch": ae_fetch,
+        "anti_entropy": anti_entropy_now,
+    }
 
     return cmds[msg["cmd"]](msg, addr)
 
@@ -397,14 +859,30 @@ def main():
     
     parser = argparse.ArgumentParser()
     parser.add_argument('--viewleader', default='localhost')
+    parser.add_argument('--backend', default='threads', choices=['threads', 'eventloop'])
+    parser.add_argument('--workers', type=int, default=common.WORKERS)
+    parser.add_argument('--codec', default=common.CODECS[0], choices=common.CODECS)
+    parser.add_argument('--data-dir', default=None)
+    parser.add_argument('--fsync', default='group', choices=wal.POLICIES)
+    parser.add_argument('--rb-batch', type=int, default=config["rbBatch"])
+    parser.add_argument('--rb-rate', type=float, default=config["rbRate"])
+    parser.add_argument('--rb-bandwidth', type=float, default=config["rbBandwidth"])
+    parser.add_argument('--commit-window', type=float, default=config["commitWindow"])
     args = parser.parse_args()
     config["viewleader"] = args.viewleader
+    config["rbBatch"] = args.rb_batch
+    config["rbRate"] = args.rb_rate
+    config["rbBandwidth"] = args.rb_bandwidth
+    config["commitWindow"] = args.commit_window
+    common.prefer_codec(args.codec)
+    if args.data_dir is not None:
+        recover(args.data_dir, args.fsync)
     
     print("Server ID: {}".format(config["ID"]))
     
     for port in range(common2.serverLow, common2.serverHigh):
         config["serverPort"] = port
-        result = common.listen(port, handler, 10)
+        result = common.listen(port, handler, 10, args.backend, args.workers)
         print result
     print ("Server has failed to bind to any port. Exiting program...")
 
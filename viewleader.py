@@ -8,7 +8,7 @@ View leader
 Processes the following RPC requests from servers continuously.
 
     1) Heartbeat: Store time of receipt time, address and port of the server
-                    If more than 30 seconds have elapsed since heartbeat, server will be marked as failed. Future heartbeats are rejected (until server is restarted with a new ID).
+                    If more than 30 seconds have elapsed since heartbeat, server will be marked as failed. Future heartbeats are rejected (until server is restarted, with a new ID or with the store it recovered from its data directory).
                     
                     returns the server's heartbeat status (accepted / rejected).
                     
@@ -19,9 +19,20 @@ Processes the following RPC requests from clients continuously.
     2) lock_get: if lock is unheld, grant lock to client.
                  if lock is already held by the requester, nothing happens.
                  if lock is held by another client, client is enqueued in a locks' waiter queue.
+                 A lock is asked for exclusively, or shared with other clients asking to share it,
+                 and granted in the order it was asked for. A client sharing a lock may ask for it
+                 exclusively (upgrade), and one holding it exclusively may ask to share it (downgrade).
                  Checks for deadlocks and sends the client a retry status.
+                 A client whose wait would close a cycle of waits is taken out of the queue,
+                 and sent a deadlock status.
+                 A client that asks to wait is only answered once it is granted the lock,
+                 its wait is aborted or the time it asked for has passed, so that it hears
+                 of the lock being handed to it at once rather than the next time it asks.
                  
-    3) lock_release: if client is waiting for the lock, remove client from wait queue
+    3) lock_get_many: as lock_get, for a set of locks that are all granted at once or not at all.
+                      The client waits for the whole set, without holding any of it meanwhile.
+
+    4) lock_release: if client is waiting for the lock, remove client from wait queue
                      if client holds the lock, remove client from queue
                      an error is returned if the lock does not exist or client is not in the queue
 
@@ -37,6 +48,10 @@ If server joins the current server
         b) the target server to copy keys to for rebalancing
         c) the target server to remove keys from for rebalancing
 
+Each of these is a rebalancing task, which the server reports done with
+rb_end. A task not done in time is handed out again, and the server resumes
+it from its last checkpoint.
+
                     
 @author Han Yang, Tay
 """
@@ -44,135 +59,171 @@ If server joins the current server
 import argparse
 import common
 import common2
+import heapq
 import time
 import json
+import locktable
+import ring
 import threading
 
 ### Global variables ###
 config = {
     "epoch": 0,
     "rebalance": False, #True if servers are undergoing rebalancing
-    "pending_rb_tasks": 0, #no. of pending rebalancing tasks
+    "rb_task_count": 0, #no. of rebalancing tasks handed out, for task IDs
+    "vnodes": 1, #positions of each server on the ring
 }
 
+#seconds a rebalancing task may go without completing before its server is
+#asked about it again, and times it is handed out before giving up on it
+RB_TASK_TIMEOUT = 30
+RB_TASK_ATTEMPTS = 5
+#seconds to wait for a server to take a rebalancing task
+RB_ISSUE_TIMEOUT = 5
+#most seconds a lock_get is held waiting for its lock, which has to be
+#below common.CONN_IDLE_TIMEOUT
+LOCK_WAIT_MAX = 30
+#seconds between the timeout ticks of the listening loop
+TICK = 1
+
 servers = {}
-locks = {} #indexed by locks
-locksTrack = {} #indexed by requesters
+rbTasks = {} #pending rebalancing tasks, indexed by task ID
+locks = locktable.LockTable()
+#lock_gets held until their lock is granted, (common.Deferred, deadline)
+#indexed by (lockname, requester), or by (locknames, requester) for a
+#lock_get_many, locknames being a sorted tuple, and a heap of their
+#(deadline, key)
+lockWaits = {}
+lockDeadlines = []
+#locknames of the held lock_get_many of each requester
+lockSets = {}
+#(common.Deferred, response) answers to held lock_gets, sent by handler once
+#it has released stateLock, so that a peer slow to read its answer doesn't
+#hold up every other RPC
+lockReplies = []
+
+#guards config, servers and locks, which are shared by the listen worker
+#threads and the rebalancing threads
+stateLock = threading.RLock()
 
 ### Aux functions ###
 
 ### Rebalancing ###
 
 
-#wraps around the circular distributed hashtable
-def f(v, nServers):
-    if v >= nServers:
-        return v - nServers
-    else:
-        return v
-
 #returns connection parameters from server information    
 def g(s):
-    s = {"IP": servers[s]["IP"], "ID": s}
+    with stateLock:
+        s = {"IP": servers[s]["IP"], "ID": s}
     return common.connectBucket(s)
-    
+
+#creates a rebalancing task run by the server source, and hands it out
+#the server calls rb_end with the task ID once it is done
+#items are [target, cmd, low, high] lists, streamed to the server
+def rebalance_task(source, items):
+    with stateLock:
+        config["rb_task_count"] += 1
+        task = "{}-{}".format(config["epoch"], config["rb_task_count"])
+        rbTasks[task] = {"source": source, "items": items, "attempts": 0,
+                         "deadline": time.time() + RB_TASK_TIMEOUT}
+        config["rebalance"] = True
+    rebalance_issue(task)
+
+#hands task to its server, which runs it in the background
+#a server already running the task says so, and one that stopped resumes
+#it from its last checkpoint
+def rebalance_issue(task):
+    with stateLock:
+        if task not in rbTasks:
+            return None
+        source = rebalance_refresh(rbTasks[task]["source"])
+        items = [[rebalance_refresh(target), cmd, low, high]
+                 for target, cmd, low, high in rbTasks[task]["items"]]
+    args = {"cmd": "rebalance", "task": task, "stream": items}
+    response = common.send_receive(source["addr"], source["port"], args, RB_ISSUE_TIMEOUT)
+    with stateLock:
+        if task not in rbTasks:
+            return None
+        status = response.get("Status")
+        if status == "Completed":
+            rebalance_done(task)
+            return None
+        if status != "Running":
+            rbTasks[task]["attempts"] += 1
+        if "Error" in response:
+            print(json.dumps(response))
+        rbTasks[task]["deadline"] = time.time() + RB_TASK_TIMEOUT
+    return None
+
+#connection parameters of a server in a task, with the address it has now
+#as it may have restarted on another port since the task was created
+def rebalance_refresh(bucket):
+    if bucket["ID"] in servers:
+        return g(bucket["ID"])
+    return bucket
+
+#removes a task that is done or given up on
+def rebalance_done(task):
+    rbTasks.pop(task, None)
+    if not rbTasks and config["rebalance"]:
+        print("Status: Rebalancing is completed")
+        config["rebalance"] = False
+
+#hands out the rebalancing tasks that move keys from the ring of the
+#servers oldIDs to the ring of the servers newIDs
+#for each range of the ring whose keys change servers, a server that holds
+#them in both rings sends them to the servers that gain them, and then to
+#the servers that lose them to be removed. Failed servers are left out.
+def rebalance(oldIDs, newIDs):
+    with stateLock:
+        view = [{"IP": servers[i]["IP"], "ID": i} for i in set(oldIDs) | set(newIDs)]
+        vnodes = config["vnodes"]
+    old = ring.Ring([s for s in view if s["ID"] in oldIDs], vnodes)
+    new = ring.Ring([s for s in view if s["ID"] in newIDs], vnodes)
+
+    adds = {} #source ID -> [target ID, "rb_addKeys", low, high] items
+    removes = {}
+    lost = 0
+    for low, high, before, after in ring.diff(old, new):
+        sources = [i for i in before if i in after]
+        if not sources:
+            lost += 1
+            continue
+        source = sources[0]
+        for i in after:
+            if i not in before:
+                adds.setdefault(source, []).append([i, "rb_addKeys", low, high])
+        for i in before:
+            if i not in after and i in newIDs:
+                removes.setdefault(source, []).append([i, "rb_removeKeys", low, high])
+    if lost:
+        print("Warning: no server is left with the keys of {} ranges of the ring.".format(lost))
+
+    for source in set(adds) | set(removes):
+        items = sorted(adds.get(source, []), key=lambda item: item[0])
+        items += sorted(removes.get(source, []), key=lambda item: item[0])
+        items = [[g(target), cmd, low, high] for target, cmd, low, high in items]
+        rebalance_task(g(source), items)
+    return None
+
 #sends rebalance RPC when server joins 
 def rebalance_new(i):
-    
-    #current view + failed server
-    rbServers = sorted([ j for j in servers if servers[j]["Status"] == "Active"])
-
-    #knows the new server in relation to other active servers 
-    #in distributed hash table
-    index = rbServers.index(i)
-    
+    with stateLock:
+        rbServers = [j for j in servers if servers[j]["Status"] == "Active"]
     if len(rbServers) == 1:
         return None
-    
     print("Update: A server has joined the view. Rebalancing...")
-    config["rebalance"] = True
-    
-    #all servers should have the same copy of store
-    #if no. of servers <= 3
-    if len(rbServers) <= 3:
-        config["pending_rb_tasks"] = 1
-
-        source = g(rbServers[index - 1])
-        target = g(rbServers[index])
-        
-        #copies entire store over to new server
-        args = {"cmd": "rebalance_new_simple",
-                "source": source,
-                "target": target}
-        common.send_receive(source["addr"], source["port"], args)
-        
-    else:
-        config["pending_rb_tasks"] = 4
-        rbIDs = {
-            "n-3": index - 3,
-            "n-2": index - 2,
-            "n-1": index - 1,
-            "n": index,
-            "n+1": index + 1,
-            "n+2": index + 2,
-            "n+3": index + 3,
-            "maxN": len(rbServers) - 1,
-            }
-        #function f wraps around the circular distributed hashtable
-        #ensures index is not out of range
-        #function g returns connection parameters and serverID
-        rbIPs = {k: g(rbServers[f(v, len(rbServers))]) for k, v in rbIDs.items()}
-
-        #rebalances keys
-        #sends RPC for rebalancing instructions to two servers  
-        args = {"cmd": "rebalance_new",
-            "servers": rbIPs}
-        common.send_receive(rbIPs["n-1"]["addr"], rbIPs["n-1"]["port"], args)
-        args["cmd"] = "rebalance_new2"
-        common.send_receive(rbIPs["n+1"]["addr"], rbIPs["n+1"]["port"], args)
-        
+    rebalance([j for j in rbServers if j != i], rbServers)
     return None
         
 #sends rebalance RPC when server leaves
 def rebalance_drop(i):
     #current view + failed server
-    rbServers = [ j for j in servers if servers[j]["Status"] == "Active"]
-    if i not in rbServers:
-        rbServers.append(i)
-    rbServers = sorted(rbServers)
-
-    #knows the failed server in relation to other active servers 
-    #in distributed hash table
-    index = rbServers.index(i)
-    
-    #only needs to rebalance if original number of servers were > 3
-    if len(rbServers) > 3:
-        print("Update: A server has left the view. Rebalancing...")
-        config["rebalance"] = True
-        config["pending_rb_tasks"] = 3
-        rbIDs = {
-            "n-3": index - 3,
-            "n-2": index - 2,
-            "n-1": index - 1,
-            "n": index,
-            "n+1": index + 1,
-            "n+2": index + 2,
-            "n+3": index + 3,
-            "maxN": len(rbServers) - 1,
-            }
-        #function f wraps around the circular distributed hashtable
-        #ensures index is not out of range
-        #function g returns connection parameters and serverID
-        rbIPs = {k: g(rbServers[f(v, len(rbServers))]) for k, v in rbIDs.items()}
-
-        #rebalances keys that are stored as secondary, tertiary copies in failed server
-        #sends RPC for rebalancing instructions to two servers  
-        args = {"cmd": "rebalance_drop",
-            "servers": rbIPs}
-        common.send_receive(rbIPs["n-1"]["addr"], rbIPs["n-1"]["port"], args)
-        args["cmd"] = "rebalance_drop2"
-        common.send_receive(rbIPs["n+1"]["addr"], rbIPs["n+1"]["port"], args)
-        
+    with stateLock:
+        rbServers = [j for j in servers if servers[j]["Status"] == "Active"]
+    rbServers = [j for j in rbServers if j != i]
+    print("Update: A server has left the view. Rebalancing...")
+    rebalance(rbServers + [i], rbServers)
     return None
 
 ###
@@ -193,80 +244,162 @@ def scanFailedServer():
                 servers[i]["Status"] = "Failed"
                 
                 
-                #release any locks held by failed server
-                locksReleased = []
+                #release any locks held by failed server, and stop it
+                #waiting for others
                 requester = servers[i]["IP"]
-                if requester in locksTrack:
-                    for lockname in locksTrack[requester]["hold"]:
-                        locks[lockname].pop(0)
-                        locksReleased.append(lockname)
-                    del locksTrack[requester]
+                for lockname in locks.waits(requester):
+                    key = wait_key(lockname, requester)
+                    lock_answer(key, cancelled(key[0]))
+                locksReleased = sorted(locks.holds(requester))
+                granted = locks.release_all(requester)
+                if locksReleased:
                     print("The following locks, which are held by {}, are released: {}".format(requester, json.dumps(locksReleased)))
+                lock_handed(granted)
                     
                 #increments epoch by 1 if a server fails
                 config["epoch"] += 1
-                              
+
+    scanRebalanceTasks(currentTime)
     return None
 
-#detects for deadlock using depth-first search
-def deadlockDetection(requester, lockname):
-        response = ""
-        to_visit = {"requester": [requester], "lock": [lockname]}
-        visited = {}
-        preds = {}
-        preds[requester] = {"requester": requester, "lock": lockname}
-        cycle = []
-        cycleLock = []
-
-        #not all nodes have been traversed
-        while to_visit["requester"] != []:
-            v = to_visit["requester"].pop()
-            v_lock = to_visit["lock"].pop()
-
-            #deadlock detected
-            if v in visited:
-                u = preds[v]["requester"]
-                u_lock = preds[v]["lock"]
-                cycleLock.append(v_lock)
-                while u!=v:
-                    cycle.append(u)
-                    cycleLock.append(u_lock)
-                    u = preds[u]["requester"]
-                    u_lock = preds[u]["lock"]
-                cycle.append(v)
-                cycle = list(reversed(cycle))
-                cycleLock = list(reversed(cycleLock))
-                break
-
-            #adds all processes that hold locks that v is waiting for
-            for lockname in locksTrack[v]["wait"]:
-                to_visit["requester"].append(locks[lockname][0])
-                to_visit["lock"].append(lockname)
-                          
-                #marks the previous node
-                preds[locks[lockname][0]] = {"requester": v, "lock":v_lock}
-            visited[v] = True
-         
+#asks again about rebalancing tasks that have not completed in time, and
+#drops those whose server failed or that were handed out too many times
+def scanRebalanceTasks(currentTime):
+    for task, info in list(rbTasks.items()):
+        if currentTime < info["deadline"]:
+            continue
+        source = servers.get(info["source"]["ID"], {})
+        if source.get("Status") != "Active" or info["attempts"] >= RB_TASK_ATTEMPTS:
+            print("Gave up on rebalancing task {}.".format(task))
+            rebalance_done(task)
+            continue
+        info["deadline"] = currentTime + RB_TASK_TIMEOUT
+        thread = threading.Thread(target = rebalance_issue, args = ([task]))
+        thread.start()
+    return None
+
+#detects deadlocks through lockname, after it gained the waiter requester
+#or changed hands, and breaks each one by aborting the wait for lockname
+#that closed it (see locktable.py)
+#returns the requesters whose waits were aborted
+def deadlockDetection(lockname, requester=None):
+    victims = []
+    while True:
+        cycle = locks.cycle(lockname, requester)
+        if cycle is None:
+            return victims
+
         #prints processes and locks involved in deadlock to viewleader.py
-        if cycleLock != []:
-            response += "Deadlock detected.\n"   
-            for i in range(len(cycle)-1):
-                response += "{} is waiting on lock {}, which is held by {}.\n".format(cycle[i], cycleLock[i], cycle[i+1])
-            response += "{} is waiting on lock {}, which is held by {}.\n".format(cycle[-1], cycleLock[-1], cycle[0])
+        response = "Deadlock detected.\n"
+        for waiter, waited, blocker in cycle:
+            if locks.mode(waited, blocker) is not None:
+                response += "{} is waiting on lock {}, which is held by {}.\n".format(waiter, waited, blocker)
+            else:
+                response += "{} is waiting on lock {} behind {}.\n".format(waiter, waited, blocker)
+        #a requester waiting for a set of locks gives up the whole set
+        victim = cycle[0][0]
+        waited = locks.group(victim)
+        if waited is None or lockname not in waited:
+            waited = lockname
+        response += "Aborted the wait of {} on {}.\n".format(victim, describe(waited))
         print(response)
-        
-        return None
+
+        granted = locks.abort(lockname, victim)
+        victims.append(victim)
+        #a victim whose lock_get is held is answered now
+        if (waited, victim) in lockWaits:
+            for i in (waited if isinstance(waited, tuple) else [waited]):
+                locks.take_aborted(i, victim)
+            lock_answer((waited, victim), deadlocked(victim, waited))
+        #the requesters the abort handed locks to may close other cycles
+        lock_handed(granted)
+        if requester is not None:
+            return victims
+
+#tells the requesters locks were handed to that they hold them, and looks
+#for the deadlocks their waiters may now be in
+#granted - (lockname, requester) pairs
+def lock_handed(granted):
+    for lockname, holder in granted:
+        lock_granted(lockname, holder)
+    for lockname in sorted(set(lockname for lockname, holder in granted)):
+        deadlockDetection(lockname)
+
+#how lockname, or a tuple of locknames, reads in messages
+def describe(lockname):
+    if isinstance(lockname, tuple):
+        return "locks {}".format(json.dumps(list(lockname)))
+    return "lock {}".format(lockname)
+
+#key of the held lock_get or lock_get_many of requester waiting for
+#lockname in lockWaits
+def wait_key(lockname, requester):
+    locknames = lockSets.get(requester)
+    if locknames is not None and lockname in locknames:
+        return (locknames, requester)
+    return (lockname, requester)
+
+#holds the lock_get of requester until it is granted lockname (or all of
+#the tuple of locknames for a lock_get_many), its wait is aborted, or wait
+#seconds have passed
+def lock_wait(lockname, requester, wait):
+    #a requester asking again, e.g. after its connection timed out, is
+    #answered on its latest request
+    key = (lockname, requester)
+    lock_answer(key, retry(lockname, True))
+    deferred = common.Deferred()
+    deadline = time.time() + min(wait, LOCK_WAIT_MAX)
+    lockWaits[key] = (deferred, deadline)
+    if isinstance(lockname, tuple):
+        lockSets[requester] = lockname
+    heapq.heappush(lockDeadlines, (deadline, key))
+    print("Status: {} is waiting for {}.".format(requester, describe(lockname)))
+    return deferred
+
+#answers the held lock_get with the given key, if there is one
+#the answer goes out once the RPC that gave it is done (see lockReplies)
+def lock_answer(key, response):
+    wait = lockWaits.pop(key, None)
+    if wait is not None:
+        if isinstance(key[0], tuple):
+            del lockSets[key[1]]
+        lockReplies.append((wait[0], response))
+
+#tells requester, which lockname was handed to, that it holds the lock
+#a lock_get_many is answered once it holds all its locks, which it is
+#handed at once
+def lock_granted(lockname, requester):
+    print("Status: Lock {} is granted to {} ({}).".format(lockname, requester,
+                                                         locks.mode(lockname, requester)))
+    lock_answer(wait_key(lockname, requester), {"Status": "Granted"})
+
+#answers the held lock_gets that have waited as long as they asked to
+def lock_timeouts(currentTime):
+    while lockDeadlines and lockDeadlines[0][0] <= currentTime:
+        deadline, key = heapq.heappop(lockDeadlines)
+        wait = lockWaits.get(key)
+        if wait is not None and wait[1] == deadline:
+            lock_answer(key, retry(key[0], True))
     
 ### RPC ###
 def init(msg, addr):
+    common.publish("viewleader", msg["port"])
     return {}
 
-#server notifies viewleader that rebalancing tasks have been completed
+#runs every TICK seconds, so that failed servers release their locks and
+#held lock_gets time out even when no request comes in
+def tick(msg, addr):
+    scanFailedServer()
+    lock_timeouts(time.time())
+    return {}
+
+#server notifies viewleader that a rebalancing task has been completed
+#a task that is reported twice is only counted once
 def rb_end(msg, addr):
-    config["pending_rb_tasks"] -= 1
-    if config["pending_rb_tasks"] == 0:
-        print("Status: Rebalancing is completed")
-        config["rebalance"] = False
+    task = msg.get("task")
+    if task in rbTasks:
+        print("Rebalancing task {} is completed".format(task))
+        rebalance_done(task)
     return {"Status": "Completed"}
 
 #detects heartbeats from servers
@@ -275,12 +408,14 @@ def heartbeat(msg, addr):
     currentTime = time.time()
     serverID = msg["serverID"]
     serverPort = msg["port"]
+    incarnation = msg.get("incarnation")
     addrPort = str(addr) + ":" + str(serverPort)
                           
     #add new server to view and increment epoch by 1
     if serverID not in servers:
         servers[serverID] = {"IP": addrPort, "Status": "Active", 
-                             "Last heartbeat": currentTime}
+                             "Last heartbeat": currentTime,
+                             "Incarnation": incarnation}
         config["epoch"] += 1
         
         ### for rebalancing
@@ -290,6 +425,9 @@ def heartbeat(msg, addr):
         print("Added new server from {} to group view.".format(addrPort))
         return {"\nStatus": "Heartbeat accepted.", "Epoch": config["epoch"]}
     else:
+        #a server that kept its ID across a restart
+        if incarnation is not None and incarnation != servers[serverID].get("Incarnation"):
+            return rejoin(serverID, addrPort, incarnation, currentTime)
         #rejects heartbeat
         if servers[serverID]["Status"] == "Failed":
             print("Rejected heartbeat from {}.".format(addrPort))
@@ -299,14 +437,30 @@ def heartbeat(msg, addr):
             servers[serverID]["Last heartbeat"] = currentTime
             return {"Status": "Heartbeat accepted.", "Epoch": config["epoch"]}
 
+#takes back a server that restarted with its store recovered from disk
+#it may be listening on another port, and if it had been marked as failed
+#it joins the view again like a new server
+def rejoin(serverID, addrPort, incarnation, currentTime):
+    server = servers[serverID]
+    failed = server["Status"] == "Failed"
+    if failed or server["IP"] != addrPort:
+        config["epoch"] += 1
+    server.update({"IP": addrPort, "Status": "Active",
+                   "Last heartbeat": currentTime, "Incarnation": incarnation})
+    if failed:
+        thread = threading.Thread(target = rebalance_new, args = ([serverID]))
+        thread.start()
+    print("Server {} restarted at {}.".format(serverID, addrPort))
+    return {"Status": "Heartbeat accepted.", "Epoch": config["epoch"]}
+
 #returns list of active servers and current epoch
 def query_servers(msg, addr):
     scanFailedServer()
     print ("Function: query_servers from {}".format(addr))
-    activeServers = json.dumps([ {"IP": servers[i]["IP"], "ID": i} 
-                        for i in servers if servers[i]["Status"] == "Active"])
+    activeServers = [ {"IP": servers[i]["IP"], "ID": i} 
+                        for i in servers if servers[i]["Status"] == "Active"]
     return{"Result": activeServers, "Epoch": config["epoch"], 
-           "Rebalance status": config["rebalance"]}
+           "Rebalance status": config["rebalance"], "Vnodes": config["vnodes"]}
 
 #request for a lock to a shared resource                          
 def lock_get(msg, addr):
@@ -314,49 +468,135 @@ def lock_get(msg, addr):
     print ("Function: lock_get")
     lockname = msg["lockname"]
     requester = msg["requester"]
+    mode = msg.get("mode", locktable.EXCLUSIVE)
     isServer = False
     
     #change requester id if it's a server
     if requester[0] == ":":
         requester = str(addr) + requester
                           
-    #add entry to locksTrack if necessary
-    if requester not in locksTrack:
-        locksTrack[requester] = {
-            "hold": [],
-            "wait": []
-        }
-    
-    #creates a new lock if necessary
-    if lockname not in locks:
-        locks[lockname] = []
-        
-    #adds requester to the lock queue if necessary
-    if requester not in locks[lockname]:
-        locks[lockname].append(requester)
-    
-    #grants access if requester is at top of the queue
-    if locks[lockname][0] == requester:
-        
-        #updates locks that are held/requested by the requester
-        if lockname not in locksTrack[requester]["hold"]:
-            locksTrack[requester]["hold"].append(lockname)
-            
-        if lockname in locksTrack[requester]["wait"]:
-            locksTrack[requester]["wait"].remove(lockname)
-                
-        print("Status: Lock {} is granted to {}.".format(lockname, requester))
+    if mode not in locktable.MODES:
+        return {"Status": "Lock mode {} is not one of {}.".format(mode, ", ".join(locktable.MODES))}
+
+    #a wait aborted to break a deadlock is reported once
+    if locks.take_aborted(lockname, requester):
+        return deadlocked(requester, lockname)
+
+    #a lock waited for as part of a set is granted with the set
+    group = locks.group(requester)
+    if group is not None and lockname in group:
+        return {"Status": "{} is already waiting for {}.".format(requester, describe(group))}
+
+    #an exclusive holder asking to share the lock downgrades it, which the
+    #shared requesters at the head of the queue then hold too
+    if mode == locktable.SHARED and locks.mode(lockname, requester) == locktable.EXCLUSIVE:
+        print("Status: Lock {} is downgraded by {}.".format(lockname, requester))
+        lock_handed(locks.downgrade(lockname, requester))
+        return {"Status": "Granted"}
+
+    #adds requester to the lock queue if necessary, and grants access if
+    #requester can hold the lock along with its holders, and no one is
+    #queued before it
+    waiting = locks.wants(lockname, requester) is not None
+    upgrade = mode == locktable.EXCLUSIVE and locks.mode(lockname, requester) == locktable.SHARED
+    if locks.acquire(lockname, requester, mode):
+        print("Status: Lock {} is granted to {} ({}).".format(lockname, requester, mode))
+        #the waiters that could share the lock with requester now wait for it
+        if upgrade:
+            deadlockDetection(lockname)
         return {"Status": "Granted".format(lockname)}
     
     else:
-        #updates entry in locksTrack, checks for deadlock
-        if lockname not in locksTrack[requester]["wait"]:
-            locksTrack[requester]["wait"].append(lockname)
-        deadlockDetection(requester, lockname)
+        #only a new wait can close a cycle, not asking again
+        if not waiting and deadlockDetection(lockname, requester):
+            locks.take_aborted(lockname, requester)
+            return deadlocked(requester, lockname)
+        #the requester may ask to be answered once it gets the lock
+        wait = msg.get("wait")
+        if wait:
+            return lock_wait(lockname, requester, float(wait))
         print("Status: Denied {} access to lock {}.".format(requester, lockname))
-        return{"Retry": "Lock {} is not available.".format(lockname)}
+        return retry(lockname)
+
+#request for a set of locks, all granted at once or none of them
+#the requester waits for the set as a whole, and holds none of it
+#meanwhile, so it can't take part in a deadlock by holding some of the
+#locks while waiting for the others
+def lock_get_many(msg, addr):
+    scanFailedServer()
+    print ("Function: lock_get_many")
+    locknames = sorted(set(msg["locknames"]))
+    requester = msg["requester"]
+    mode = msg.get("mode", locktable.EXCLUSIVE)
+
+    #change requester id if it's a server
+    if requester[0] == ":":
+        requester = str(addr) + requester
+
+    if mode not in locktable.MODES:
+        return {"Status": "Lock mode {} is not one of {}.".format(mode, ", ".join(locktable.MODES))}
+
+    #a wait aborted to break a deadlock is reported once
+    aborted = [lockname for lockname in locknames if locks.take_aborted(lockname, requester)]
+    if aborted:
+        return deadlocked(requester, tuple(locknames))
+
+    #the locks requester doesn't hold in mode yet, which it may only be
+    #waiting for as this same set
+    wanted = tuple(lockname for lockname in locknames
+                   if locks.mode(lockname, requester) not in (locktable.EXCLUSIVE, mode))
+    group = locks.group(requester)
+    if group is not None and group != wanted:
+        return {"Status": "{} is already waiting for {}.".format(requester, describe(group))}
+    for lockname in wanted:
+        if locks.mode(lockname, requester) is not None:
+            return {"Status": "Lock {} is shared by {}, which can only upgrade it with lock_get.".format(lockname, requester)}
+        if group is None and locks.wants(lockname, requester) is not None:
+            return {"Status": "{} is already waiting for lock {}.".format(requester, lockname)}
+
+    if locks.acquire_many(locknames, requester, mode):
+        print("Status: {} are granted to {} ({}).".format(describe(tuple(locknames)), requester, mode))
+        return {"Status": "Granted"}
+
+    #only a new wait can close a cycle, not asking again
+    if group is None and deadlockDetection(wanted[0], requester):
+        for lockname in wanted:
+            locks.take_aborted(lockname, requester)
+        return deadlocked(requester, wanted)
+    #the requester may ask to be answered once it gets the locks
+    wait = msg.get("wait")
+    if wait:
+        return lock_wait(wanted, requester, float(wait))
+    print("Status: Denied {} access to {}.".format(requester, describe(wanted)))
+    return retry(wanted)
+
+#response to a lock_get that didn't get its lock, or to a lock_get_many
+#that didn't get its tuple of locks
+#waited - True if it was held waiting for it, in which case it may be
+#         sent again straight away
+def retry(lockname, waited=False):
+    if isinstance(lockname, tuple):
+        response = {"Retry": "Locks {} are not all available.".format(json.dumps(list(lockname)))}
+    else:
+        response = {"Retry": "Lock {} is not available.".format(lockname)}
+    if waited:
+        response["Waited"] = True
+    return response
             
+#response to a lock_get whose wait was aborted to break a deadlock
+def deadlocked(requester, lockname):
+    print("Status: Denied {} access to {}, to break a deadlock.".format(requester, describe(lockname)))
+    return {"Status": "Deadlock", 
+            "Result": "Waiting for {} would deadlock. Release a lock and try again.".format(describe(lockname))}
+
+#response to a held lock_get whose requester stopped waiting for the lock
+def cancelled(lockname):
+    return {"Status": "Cancelled",
+            "Result": "The wait for {} was cancelled.".format(describe(lockname))}
+
 #releases a lock
+#releasing a lock that is part of a set requester waits for gives up the
+#whole set
 def lock_release(msg, addr):
     lockname = msg["lockname"]
     requester = msg["requester"]
@@ -369,17 +609,16 @@ def lock_release(msg, addr):
         print("Status:" "Lock {} doesn't exist".format(lockname))
         return {"Status": "Lock doesn't exist."}
     
-    elif locks[lockname] == [] or requester not in locks[lockname]:
+    elif not locks.queued(lockname, requester):
         print( "Status: {} is not waiting/holding lock {}.".format(requester, lockname))
         return {"Status": "You are not waiting/holding the lock."}
     
     else:
-        locks[lockname].remove(requester)
-        #removes requester from queue
-        if lockname in locksTrack[requester]["hold"]:  
-            locksTrack[requester]["hold"].remove(lockname)
-        else:
-            locksTrack[requester]["wait"].remove(lockname)
+        #removes requester from queue, handing the lock to the next ones,
+        #whose waiters may now be deadlocked
+        key = wait_key(lockname, requester)
+        lock_answer(key, cancelled(key[0]))
+        lock_handed(locks.release(lockname, requester))
         print("Status: Removed requester from the queue.".format(lockname))
         return {"Status": "Completed."}
     
@@ -389,24 +628,42 @@ def lock_release(msg, addr):
 def handler(msg, addr):
     cmds = {
         "init": init,
+        "timeout": tick,
         "heartbeat": heartbeat,
         "query_servers": query_servers,
         "lock_get": lock_get,
+        "lock_get_many": lock_get_many,
         "lock_release": lock_release,
         "rb_end": rb_end,
     }
 
-    return cmds[msg["cmd"]](msg, addr)
+    #RPCs are short and never block on the network, so they are
+    #simply serialized. A lock_get left waiting returns a common.Deferred
+    #and is answered later, by whichever RPC hands it the lock, after it
+    #has released stateLock.
+    with stateLock:
+        response = cmds[msg["cmd"]](msg, addr)
+        replies = lockReplies[:]
+        del lockReplies[:]
+    for deferred, reply in replies:
+        deferred.reply(reply)
+    return response
 
 #Viewleader entry point                          
 def main():
     
     parser = argparse.ArgumentParser()
     parser.add_argument('--viewleader', default='localhost')
+    parser.add_argument('--backend', default='threads', choices=['threads', 'eventloop'])
+    parser.add_argument('--workers', type=int, default=common.WORKERS)
+    parser.add_argument('--codec', default=common.CODECS[0], choices=common.CODECS)
+    parser.add_argument('--vnodes', type=int, default=config["vnodes"])
     args = parser.parse_args()
+    common.prefer_codec(args.codec)
+    config["vnodes"] = args.vnodes
     
     for port in range(common2.viewleaderLow, common2.viewleaderHigh):
-        result = common.listen(port, handler)
+        result = common.listen(port, handler, TICK, args.backend, args.workers)
         print result
     print ("Viewleader has failed to bind to any port. Exiting program...")
 
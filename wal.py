@@ -0,0 +1,293 @@
+import errno
+import json
+import os
+import struct
+import threading
+import time
+import zlib
+
+#Write-ahead log and snapshots for the server store
+#Changes to the store are appended to the current log segment before they
+#are acknowledged. A snapshot holds the whole store as of the start of a
+#segment, so recovery loads the snapshot and replays the segments from
+#that one on. Older segments are deleted once the snapshot is on disk.
+#
+#Each record is a 4-byte length, a 4-byte CRC-32 and a JSON list:
+#   ["set", key, value], ["set", key, value, version] or ["del", key]
+#Snapshots hold the keys in batches of SNAPSHOT_BATCH:
+#   ["sets", [[key, value], [key, value, version], ...]]
+#A record cut short by a crash, or failing its CRC, ends the log, and the
+#segment is truncated there.
+#
+#fsync policies, from safest to fastest:
+#   always - every change is synced before it is acknowledged
+#   group - changes are acknowledged once synced, and concurrent writers
+#           share a single fsync
+#   interval - changes are synced every SYNC_INTERVAL seconds, so a power
+#              failure loses at most that much
+#   off - changes are only written to the OS and never explicitly synced
+
+POLICIES = ["always", "group", "interval", "off"]
+SYNC_INTERVAL = 1.0
+
+#records appended after which a snapshot is due
+SNAPSHOT_RECORDS = 100000
+SNAPSHOT_BATCH = 1000
+
+RECORD = struct.Struct("!II")
+
+# Encodes a record
+def encode(record):
+    body = json.dumps(record).encode("utf-8")
+    return RECORD.pack(len(body), zlib.crc32(body) & 0xffffffff) + body
+
+# Reads the records of a file, calling f on each one
+# Return value
+#   (number of records, offset just after the last whole record)
+def read_records(path, f):
+    with open(path, "rb") as file:
+        data = file.read()
+    count = 0
+    end = 0
+    while end + RECORD.size <= len(data):
+        n, crc = RECORD.unpack_from(data, end)
+        body = data[end + RECORD.size:end + RECORD.size + n]
+        if len(body) < n or zlib.crc32(body) & 0xffffffff != crc:
+            break
+        f(json.loads(body.decode("utf-8")))
+        count += 1
+        end += RECORD.size + n
+    return count, end
+
+# Applies a record to a store
+# Parameters
+#   versions - dict the versions of the keys go in, or None to ignore them
+def apply(store, record, versions=None):
+    if record[0] == "set":
+        apply_set(store, record[1:], versions)
+    elif record[0] == "del":
+        store.pop(record[1], None)
+        if versions is not None:
+            versions.pop(record[1], None)
+    elif record[0] == "sets":
+        if versions is None:
+            store.update(item[:2] for item in record[1])
+        else:
+            for item in record[1]:
+                apply_set(store, item, versions)
+
+# Sets a [key, value] or [key, value, version] item in a store
+def apply_set(store, item, versions):
+    store[item[0]] = item[1]
+    if versions is not None:
+        if len(item) > 2:
+            versions[item[0]] = item[2]
+        else:
+            versions.pop(item[0], None)
+
+# Writes data to path atomically
+def write_file(path, data):
+    with open(path + ".tmp", "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(path + ".tmp", path)
+    sync_directory(os.path.dirname(path))
+
+# Makes renames and deletions in a directory durable
+def sync_directory(directory):
+    try:
+        fd = os.open(directory or ".", os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+class Log(object):
+    def __init__(self, directory, policy="group"):
+        if policy not in POLICIES:
+            raise ValueError("unknown fsync policy {}".format(policy))
+        self.directory = directory
+        self.policy = policy
+        self.lock = threading.Lock()
+        self.synced = threading.Condition(self.lock)
+        self.file = None
+        self.segment = 0
+        self.appended = 0 #records appended since the log was opened
+        self.durable = 0 #records known to be on disk
+        self.syncing = False #an fsync is running without the lock
+        self.pending = 0 #records appended since the last snapshot
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    #numbers of the segments on disk, in order
+    def segments(self):
+        found = []
+        for name in os.listdir(self.directory):
+            prefix, _, n = name.partition(".")
+            if prefix == "wal" and n.isdigit():
+                found.append(int(n))
+        return sorted(found)
+
+    # Loads the snapshot and replays the log into store, then opens the
+    # log for appending
+    # store can be any mapping, and a dict is fastest
+    # The versions of the keys go in the dict versions, if given
+    # Return value
+    #   number of log records replayed after the snapshot
+    def recover(self, store, versions=None):
+        count = 0
+        start = [0]
+        if os.path.exists(self.path("snapshot")):
+            #the first record is the segment the snapshot was taken at
+            def replay(record):
+                if record[0] == "segment":
+                    start[0] = record[1]
+                else:
+                    apply(store, record, versions)
+            read_records(self.path("snapshot"), replay)
+        start = start[0]
+
+        segments = [i for i in self.segments() if i >= start]
+        for n in segments:
+            path = self.path("wal.{}".format(n))
+            records, end = read_records(path, lambda record: apply(store, record, versions))
+            count += records
+            self.pending += records
+            if end < os.path.getsize(path):
+                #drops the torn record at the end of the log
+                with open(path, "r+b") as f:
+                    f.truncate(end)
+
+        self.segment = segments[-1] if segments else start
+        self.file = open(self.path("wal.{}".format(self.segment)), "ab")
+        if self.policy == "interval":
+            thread = threading.Thread(target = self.sync_periodically)
+            thread.daemon = True
+            thread.start()
+        return count
+
+    # Appends a record to the log
+    # Return value
+    #   position of the record, to pass to sync
+    def append(self, record):
+        return self.append_many([record])
+
+    # Appends records in a single write
+    # Return value
+    #   position of the last one, to pass to sync
+    def append_many(self, records):
+        data = b"".join(encode(record) for record in records)
+        with self.lock:
+            self.file.write(data)
+            self.appended += len(records)
+            self.pending += len(records)
+            if self.policy == "always":
+                self.file.flush()
+                os.fsync(self.file.fileno())
+                self.durable = self.appended
+            elif self.policy != "group":
+                self.file.flush()
+            return self.appended
+
+    # Waits until the record at position seq is as durable as the policy
+    # makes it
+    # Under the group policy, one writer syncs for everyone that is
+    # waiting, and the others wait for it instead of syncing themselves
+    def sync(self, seq):
+        if self.policy != "group" or seq is None:
+            return
+        with self.lock:
+            while self.durable < seq:
+                if self.syncing:
+                    self.synced.wait()
+                else:
+                    self.sync_locked()
+
+    #flushes and syncs the current segment, called with self.lock held
+    #the lock is released during the fsync so that appends can go on
+    def sync_locked(self):
+        self.syncing = True
+        target = self.appended
+        self.file.flush()
+        fd = self.file.fileno()
+        self.lock.release()
+        try:
+            os.fsync(fd)
+        finally:
+            self.lock.acquire()
+            self.syncing = False
+            self.durable = max(self.durable, target)
+            self.synced.notify_all()
+
+    def sync_periodically(self):
+        while True:
+            time.sleep(SYNC_INTERVAL)
+            with self.lock:
+                if self.file is None:
+                    return
+                if self.durable < self.appended and not self.syncing:
+                    self.sync_locked()
+
+    #True if enough records have been appended to make a snapshot worthwhile
+    def snapshot_due(self):
+        return self.pending >= SNAPSHOT_RECORDS
+
+    # Starts a new segment for the changes that follow a snapshot
+    # Must be called while the store can't change, with the store copied
+    # in the same critical section
+    # Return value
+    #   number of the new segment, to pass to write_snapshot
+    def rotate(self):
+        with self.lock:
+            while self.syncing:
+                self.synced.wait()
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.file.close()
+            self.durable = self.appended
+            self.segment += 1
+            self.file = open(self.path("wal.{}".format(self.segment)), "ab")
+            self.pending = 0
+            return self.segment
+
+    # Writes a snapshot of the store as of the start of segment, then
+    # deletes the segments it replaces
+    # Parameters
+    #   items - list of [key, value] or [key, value, version] records copied
+    #           from the store by the caller
+    def write_snapshot(self, items, segment):
+        path = self.path("snapshot")
+        with open(path + ".tmp", "wb") as f:
+            f.write(encode(["segment", segment]))
+            for i in range(0, len(items), SNAPSHOT_BATCH):
+                f.write(encode(["sets", items[i:i + SNAPSHOT_BATCH]]))
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(path + ".tmp", path)
+        #the snapshot has to be in place before the segments go
+        sync_directory(self.directory)
+        for n in self.segments():
+            if n < segment:
+                try:
+                    os.remove(self.path("wal.{}".format(n)))
+                except OSError as e:
+                    if e.errno != errno.ENOENT:
+                        raise
+        sync_directory(self.directory)
+
+    def close(self):
+        with self.lock:
+            while self.syncing:
+                self.synced.wait()
+            if self.file is not None:
+                self.file.flush()
+                if self.policy != "off":
+                    os.fsync(self.file.fileno())
+                self.file.close()
+                self.file = None